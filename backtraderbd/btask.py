@@ -4,15 +4,22 @@ import sys
 
 import datetime as dt
 import math
+import numpy as np
 import pandas as pd
 
 import backtrader as bt
 
 import backtraderbd.data.bdshare as bds
+import backtraderbd.data.utils as bdu
+import backtraderbd.data.shared as bdsh
+from backtraderbd.data.cache import ResultCache
 import backtraderbd.strategies.utils as bsu
 from backtraderbd.settings import settings as conf
+from backtraderbd.libs import profiling
 from backtraderbd.libs.log import get_logger
-from backtraderbd.libs.models import get_or_create_library
+from backtraderbd.libs.models import get_or_create_library, get_staged_symbol
+from backtraderbd.strategies.indicators import IndicatorCache
+from backtraderbd.strategies.vectorized import VectorizedBacktest
 
 from backtraderbd.strategies.rsi import RSIStrategy
 from backtraderbd.strategies.emac import EMACStrategy
@@ -21,6 +28,13 @@ from backtraderbd.strategies.smac import SMACStrategy
 
 logger = get_logger(__name__)
 
+STRATEGY_MAPPING = {
+    "rsi": RSIStrategy,
+    "smac": SMACStrategy,
+    "macd": MACDStrategy,
+    "emac": EMACStrategy,
+}
+
 
 class Btask(object):
     """
@@ -36,9 +50,15 @@ class Btask(object):
         :param coll_name: stock id (string).
         :return: time serials(DataFrame).
         """
-        dse_his_data = bds.DseHisData(coll_name)
+        with profiling.timer('btask.get_data'):
+            # pool workers attach to the data loaded once by the parent process
+            data = bdsh.get_shared_data(coll_name)
+            if data is not None:
+                return data
 
-        return dse_his_data.get_data()
+            dse_his_data = bds.DseHisData(coll_name)
+
+            return dse_his_data.get_data()
 
     @classmethod
     def get_all_data(cls, coll_name=None):
@@ -97,10 +117,11 @@ class Btask(object):
         # Change Data Type [https://www.backtrader.com/docu/dataautoref/#pandasdata]
         #convert_dict = {'date': complex, 'high': float, 'low': float, 'close': float, 'volume': int}
         #data = data.astype(convert_dict)
-        training_data = training_data.apply(pd.to_numeric)
+        training_data = bdu.Utils.to_numeric(training_data)
         training_data.head()
 
-        data = bt.feeds.PandasData(dataname=training_data)
+        with profiling.timer('btask.feed'):
+            data = bt.feeds.PandasData(dataname=training_data)
 
         cerebro.adddata(data)
         cerebro.optstrategy(cls, ma_periods=params_list)
@@ -112,7 +133,10 @@ class Btask(object):
 
         logger.debug(f'Starting train the strategy for stock {stock_id}...')
 
-        results = cerebro.run()
+        profiling.count('backtests', len(params_list))
+        profiling.count('bars', len(training_data) * len(params_list))
+        with profiling.timer('btask.cerebro_run'):
+            results = cerebro.run()
 
         for result in results:
             params = result[0].params
@@ -145,13 +169,190 @@ class Btask(object):
 
         return params
 
+    @classmethod
+    def get_strategy_params_list(cls, training_data, stock_id):
+        """
+        Get the `get_params_list` grid as fast_period/slow_period strategy params.
+        :param training_data(DateFrame): data for training.
+        :param stock_id(string): stock on which strategy works.
+        :return: list(dict)
+        """
+        return [
+            dict(fast_period=p['ma_period_s'], slow_period=p['ma_period_l'])
+            for p in cls.get_params_list(training_data, stock_id)
+        ]
+
+    @classmethod
+    def evaluate_params_cached(cls, Strategy, training_data, params_list, evaluate, **broker_settings):
+        """
+        Serve the param sets from the result cache, back test only the others with `evaluate`.
+        :param Strategy(class): strategy to evaluate, e.g. SMACStrategy.
+        :param training_data(DataFrame): data used to train the strategy.
+        :param params_list(list): dicts of strategy params.
+        :param evaluate(callable): params_list -> list(dict(params, analysis data)).
+        :param broker_settings: broker settings of the back test overriding the global ones.
+        :return: list(dict(params, total_return_rate, max_drawdown, max_drawdown_period))
+        """
+        cache = ResultCache()
+        group = cache.get_group_key(
+            Strategy,
+            ResultCache.get_data_version(training_data),
+            ResultCache.get_broker_settings(**broker_settings)
+        )
+        analyses = cache.get(group, params_list)
+
+        missing = [params for params, analysis in zip(params_list, analyses) if analysis is None]
+        if missing:
+            new_analyses = [
+                {name: value for name, value in al_result.items() if name != 'params'}
+                for al_result in evaluate(missing)
+            ]
+            cache.put(group, missing, new_analyses)
+            new_analyses = iter(new_analyses)
+            analyses = [next(new_analyses) if analysis is None else analysis for analysis in analyses]
+
+        logger.debug(f'{len(params_list) - len(missing)} of {len(params_list)} results from the cache.')
+
+        return [dict(params=params, **analysis) for params, analysis in zip(params_list, analyses)]
+
+    @classmethod
+    def evaluate_params_vectorized(cls, Strategy, training_data, params_list, use_cache=True):
+        """
+        Back test many param sets of the strategy with the vectorized engine,
+        the param sets are simulated in chunks on indicators shared by all of them.
+        :param Strategy(class): strategy to evaluate, e.g. SMACStrategy.
+        :param training_data(DataFrame): data used to train the strategy.
+        :param params_list(list): dicts of strategy params.
+        :param use_cache(bool): use the result cache if `RESULT_CACHE_ENABLED`.
+        :return: list(dict(params, total_return_rate, max_drawdown, max_drawdown_period))
+        """
+        training_data = bdu.Utils.to_numeric(training_data)
+        if use_cache and conf.RESULT_CACHE_ENABLED:
+            return cls.evaluate_params_cached(
+                Strategy, training_data, params_list,
+                lambda missing: cls.evaluate_params_vectorized(Strategy, training_data, missing, use_cache=False),
+                commission=0.0
+            )
+
+        indicators = IndicatorCache(training_data)
+        # same broker as train_strategy: no commission
+        engine = VectorizedBacktest(commission=0.0)
+
+        profiling.count('backtests', len(params_list))
+        profiling.count('bars', len(training_data) * len(params_list))
+        al_results = []
+        chunk_size = conf.VECTORIZED_CHUNK_SIZE
+        for i in range(0, len(params_list), chunk_size):
+            chunk = params_list[i:i + chunk_size]
+            with profiling.timer('btask.signals'):
+                buy_signal, sell_signal = Strategy.get_signals(indicators, chunk)
+            with profiling.timer('btask.vectorized_run'):
+                result = engine.run(training_data['close'], buy_signal, sell_signal,
+                                    open=training_data['open'])
+                analyses = result.get_analysis()
+            for params, analysis in zip(chunk, analyses):
+                al_results.append(dict(params=params, **analysis))
+
+        return al_results
+
+    @classmethod
+    def evaluate_params_cerebro(cls, Strategy, training_data, params_list, maxcpus=1, use_cache=True):
+        """
+        Back test many param sets of the strategy with cerebro in optimization mode:
+        the strategies are built silent and read the precomputed signals.
+        :param Strategy(class): strategy to evaluate, e.g. SMACStrategy.
+        :param training_data(DataFrame): data used to train the strategy.
+        :param params_list(list): dicts of strategy params.
+        :param maxcpus(int): processes of cerebro, None is one per cpu.
+        :param use_cache(bool): use the result cache if `RESULT_CACHE_ENABLED`.
+        :return: list(dict(params, total_return_rate, max_drawdown, max_drawdown_period))
+        """
+        training_data = bdu.Utils.to_numeric(training_data)
+        if use_cache and conf.RESULT_CACHE_ENABLED:
+            # same results as the vectorized engine, the cached ones are shared
+            return cls.evaluate_params_cached(
+                Strategy, training_data, params_list,
+                lambda missing: cls.evaluate_params_cerebro(
+                    Strategy, training_data, missing, maxcpus=maxcpus, use_cache=False),
+                commission=0.0
+            )
+
+        # lightweight results: params and analyzers only, not the strategies
+        cerebro = bt.Cerebro(stdstats=False, maxcpus=maxcpus, optreturn=True)
+        with profiling.timer('btask.feed'):
+            cerebro.adddata(bt.feeds.PandasData(dataname=training_data))
+        with profiling.timer('btask.signals'):
+            param_sets = Strategy.get_param_sets(training_data, params_list)
+        cerebro.optstrategy(Strategy, param_set=param_sets)
+        cerebro.addanalyzer(bt.analyzers.TimeReturn, _name='al_return',
+                            timeframe=bt.analyzers.TimeFrame.NoTimeFrame)
+        cerebro.addanalyzer(bt.analyzers.TimeDrawDown, _name='al_max_drawdown')
+        cerebro.broker.setcash(conf.DEFAULT_CASH)
+
+        profiling.count('backtests', len(params_list))
+        profiling.count('bars', len(training_data) * len(params_list))
+        with profiling.timer('btask.cerebro_run'):
+            results = cerebro.run()
+
+        al_results = []
+        with profiling.timer('btask.analyzers'):
+            for params, result in zip(params_list, results):
+                analyzers = result[0].analyzers
+                al_return_rate = analyzers.al_return.get_analysis()
+                total_return_rate = 0.0
+                for k, v in al_return_rate.items():
+                    total_return_rate = v
+                al_results.append(dict(
+                    params=params,
+                    total_return_rate=total_return_rate,
+                    max_drawdown=analyzers.al_max_drawdown.get_analysis().get('maxdrawdown'),
+                    max_drawdown_period=analyzers.al_max_drawdown.get_analysis().get('maxdrawdownperiod')
+                ))
+
+        return al_results
+
+    @classmethod
+    def train_strategy_vectorized(cls, Strategy, training_data, stock_id, params_list=None):
+        """
+        Find the optimized parameter of the strategy with the vectorized engine.
+        :param Strategy(class): strategy to train, e.g. SMACStrategy.
+        :param training_data(DataFrame): data used to train the strategy.
+        :param stock_id(string): stock on which the strategy works.
+        :param params_list(list): dicts of strategy params, default is `get_strategy_params_list`.
+        :return: params(dict like {fast_period: 1, slow_period: 2, stock_id: '0'})
+        """
+        if params_list is None:
+            params_list = cls.get_strategy_params_list(training_data, stock_id)
+
+        logger.debug(f'Starting vectorized training of {Strategy.__name__} for stock {stock_id}...')
+
+        al_results = cls.evaluate_params_vectorized(Strategy, training_data, params_list)
+
+        return cls.get_best_params(al_results, stock_id)
+
+    @classmethod
+    def get_best_params(cls, al_results, stock_id):
+        """
+        Get the best strategy params of the stock from the analysis data.
+        :param al_results(list): all the optional params and corresponding analysis data.
+        :param stock_id(string): stock on which the strategy works.
+        :return: params(dict like {fast_period: 1, slow_period: 2, stock_id: '0'})
+        """
+        best_al_result = bsu.Utils.get_best_params(al_results)
+        params = dict(best_al_result.get('params'), stock_id=stock_id)
+
+        logger.debug(f'Stock {stock_id} best params is {params}')
+
+        return params
+
     @classmethod
     def run_training(cls, stock_id):
-        # get the data
-        data = cls.get_data(stock_id)
+        with profiling.task('run_training'):
+            # get the data
+            data = cls.get_data(stock_id)
 
-        # train the strategy for this stock_id to get the params
-        params = cls.train_strategy(data, stock_id)
+            # train the strategy for this stock_id to get the params
+            params = cls.train_strategy(data, stock_id)
 
         return params
 
@@ -163,44 +364,105 @@ class Btask(object):
         :param stock_id(string)
         :return(dict): analysis data.
         """
-        STRATEGY_MAPPING = {
-            "rsi": RSIStrategy,
-            "smac": SMACStrategy,
-            "macd": MACDStrategy,
-            "emac": EMACStrategy,
-        }
+        with profiling.task('run_back_testing'):
+            # get the data
+            data = cls.get_data(stock_id)
+            length = len(data)
 
-        # get the data
-        data = cls.get_data(stock_id)
-        length = len(data)
+            print('Data length: {0}'.format(length))
 
-        print('Data length: {0}'.format(length))
+            # Change Data Type [https://www.backtrader.com/docu/dataautoref/#pandasdata]
+            #convert_dict = {'date': complex, 'high': float, 'low': float, 'close': float, 'volume': int}
+            #data = data.astype(convert_dict)
+            data = bdu.Utils.to_numeric(data)
 
-        # Change Data Type [https://www.backtrader.com/docu/dataautoref/#pandasdata]
-        #convert_dict = {'date': complex, 'high': float, 'low': float, 'close': float, 'volume': int}
-        #data = data.astype(convert_dict)
-        data = data.apply(pd.to_numeric)
+            # get the params
 
-        # get the params
+            cerebro = bt.Cerebro()
+            with profiling.timer('btask.feed'):
+                data = bt.feeds.PandasData(dataname=data)
 
-        cerebro = bt.Cerebro()
-        data = bt.feeds.PandasData(dataname=data)
+            cerebro.adddata(data)
+            cerebro.addstrategy(STRATEGY_MAPPING[strategy])
 
-        cerebro.adddata(data)
-        cerebro.addstrategy(STRATEGY_MAPPING[strategy])
+            cerebro.broker.setcommission(commission=conf.COMMISSION_PER_TRANSACTION)
 
-        cerebro.broker.setcommission(commission=conf.COMMISSION_PER_TRANSACTION)
-
-        cerebro.broker.setcash(conf.DEFAULT_CASH)
+            cerebro.broker.setcash(conf.DEFAULT_CASH)
 
-        print('Starting Portfolio Value: %.2f' % cerebro.broker.getvalue())
-        cerebro.run()
-        print('Final Portfolio Value: %.2f' % cerebro.broker.getvalue())
+            print('Starting Portfolio Value: %.2f' % cerebro.broker.getvalue())
+            profiling.count('backtests')
+            profiling.count('bars', length)
+            with profiling.timer('btask.cerebro_run'):
+                cerebro.run()
+            print('Final Portfolio Value: %.2f' % cerebro.broker.getvalue())
 
-        cerebro.plot(figsize=(30, 15))
+            with profiling.timer('btask.plot'):
+                cerebro.plot(figsize=(30, 15))
 
         return True
 
+    @classmethod
+    def evaluate_strategies(cls, data, strategies=None, params=None, **broker_settings):
+        """
+        Back test several strategies on one feed in a single pass: the data is converted once,
+        the base indicators (e.g. the EMAs of EMAC and MACD) are computed once and shared,
+        and every strategy is a column of one vectorized simulation with its own broker.
+        :param data(DataFrame): time serials.
+        :param strategies(list): strategy names of `STRATEGY_MAPPING`, default all.
+        :param params(dict): strategy name -> params, default the strategy defaults,
+            trained params with their `stock_id` are accepted.
+        :param broker_settings: `VectorizedBacktest` settings overriding the broker of `run_back_testing`.
+        :return: dict(strategy name: dict(total_return_rate, max_drawdown, max_drawdown_period, final_value))
+        """
+        strategies = list(strategies or STRATEGY_MAPPING)
+        params = params or {}
+        unknown = set(strategies) - set(STRATEGY_MAPPING)
+        if unknown:
+            raise ValueError(f'unknown strategies: {sorted(unknown)}')
+
+        data = bdu.Utils.to_numeric(data)
+        indicators = IndicatorCache(data)
+        buy_signals, sell_signals = [], []
+        for name in strategies:
+            # trained params, e.g. of `get_best_params`, carry the stock id
+            strategy_params = {key: value for key, value in params.get(name, {}).items() if key != 'stock_id'}
+            with profiling.timer('btask.signals'):
+                buy_signal, sell_signal = STRATEGY_MAPPING[name].get_signals(indicators, [strategy_params])
+            buy_signals.append(buy_signal)
+            sell_signals.append(sell_signal)
+
+        profiling.count('backtests', len(strategies))
+        profiling.count('bars', len(data) * len(strategies))
+        with profiling.timer('btask.vectorized_run'):
+            result = VectorizedBacktest(**broker_settings).run(
+                data['close'], np.hstack(buy_signals), np.hstack(sell_signals), open=data['open'])
+            analyses = result.get_analysis()
+
+        final_values = result.value[-1] if len(data) else np.full(len(strategies), result.init_cash)
+        return {
+            name: dict(analysis, final_value=float(final_value))
+            for name, analysis, final_value in zip(strategies, analyses, final_values)
+        }
+
+    @classmethod
+    def compare_strategies(cls, stock_id, strategies=None, params=None):
+        """
+        Compare strategies on one stock, the multi strategy version of `run_back_testing`:
+        the data is loaded once and the strategies are back tested in a single pass.
+        :param stock_id(string): stock id.
+        :param strategies(list): strategy names of `STRATEGY_MAPPING`, default all.
+        :param params(dict): strategy name -> params, default the strategy defaults.
+        :return: analysis data(DataFrame), one row per strategy,
+            columns: total_return_rate, max_drawdown, max_drawdown_period, final_value.
+        """
+        with profiling.task('compare_strategies'):
+            data = cls.get_data(stock_id)
+            results = cls.evaluate_strategies(data, strategies, params)
+
+        logger.debug(f'{len(results)} strategies compared on stock {stock_id}.')
+
+        return pd.DataFrame.from_dict(results, orient='index')
+
     @classmethod
     def get_params(cls, stock_id):
         """
@@ -211,7 +473,14 @@ class Btask(object):
         lib = get_or_create_library(conf.STRATEGY_PARAMS_LIBNAME)
         symbol = cls.name
 
-        params_list = lib.read(symbol).data
+        # params saved by a concurrent writer and not merged yet are the newest
+        staged_symbol = get_staged_symbol(symbol, stock_id)
+        if lib.has_symbol(staged_symbol):
+            symbol = staged_symbol
+
+        profiling.count('mongo_calls', 2)
+        with profiling.timer('models.read_params'):
+            params_list = lib.read(symbol).data
         params = params_list.loc[stock_id, 'params']
 
         return params
@@ -1,16 +1,27 @@
 # -*- coding: utf-8 -*-
+import threading
+import time
 import datetime as dt
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
 import bdshare as bds
 import pandas as pd
 
 import backtraderbd.data.utils as bdu
+from backtraderbd.data.cache import LocalCache
 from backtraderbd.settings import settings as conf
+from backtraderbd.libs import profiling
 from backtraderbd.libs.log import get_logger
 from backtraderbd.libs.models import get_or_create_library
 
 
 logger = get_logger(__name__)
 
+# version of the normalized schema kept in the symbol metadata with the column dtypes,
+# 1: datetime64 index and numeric columns, 2: compact columns (float32 prices, int64 volume)
+SCHEMA_VERSION = 2
+
+
 class DseHisData(object):
     """
     Mapping one collection in 'dse_his_lib' library, download and
@@ -18,16 +29,23 @@ class DseHisData(object):
     columns: open, high, close, low, volume
     Attributes:
         coll_name(string): stock id like 'ACI'.
+        source(module): provider of `get_basic_hist_data`, default bdshare.
 
     """
 
-    def __init__(self, coll_name):
+    def __init__(self, coll_name, source=None):
         self._lib_name = conf.BD_STOCK_LIBNAME
         self._coll_name = coll_name
         self._library = get_or_create_library(self._lib_name)
+        self._cache = LocalCache(self._lib_name) if conf.LOCAL_CACHE_ENABLED else None
         #self._unused_cols = ['TRADING CODE', 'LTP*', 'YCP', 'TRADE', 'VALUE (mn)']
         self._unused_cols = []
         self._new_added_colls = []
+        self._latest_date = None
+        # metadata of the stored collection as last read or written, the write of the delta reuses it
+        self._metadata = None
+        # bdshare or a stand-in providing `get_basic_hist_data`
+        self._source = source or bds
 
     @classmethod
     def download_one_delta_data(cls, coll_name):
@@ -40,89 +58,310 @@ class DseHisData(object):
         bds_his_data.download_delta_data()
 
     @classmethod
-    def download_all_delta_data(cls):
+    def download_all_delta_data(cls, coll_names=None):
         """
         Download all the collections' delta data.
-        :param coll_names: list of the collections.
-        :return: None
+        :param coll_names: list of the collections, default all the current trading codes.
+        :return: dict(updated, empty, failed), lists of the collections.
         """
+        if coll_names is None:
+            coll_names = list(bds.get_current_trading_code()['symbol'])
 
-        bds_his_data = DseHisData(coll_name=None)
-        bds_his_data.download_delta_data()
+        return DeltaIngestor().run(coll_names)
 
     def download_delta_data(self):
         """
-        Get yesterday's data and append it to collection,
+        Get the data missing since the last stored day and append it to collection,
         this method is planned to be executed at each day's 8:30am to update the data.
         1. Connect to arctic and get the library.
-        2. Get today's history data from bdshare and strip the unused columns.
-        3. Store the data to arctic.
+        2. Get the history data from the last stored day to today from bdshare
+           and strip the unused columns, weekends, holidays and missed runs are caught up.
+        3. Store the data to arctic in one write.
         :return: None
         """
 
-        self._init_coll()
+        his_data = self.fetch_delta_data()
+        self.write_delta_data(his_data)
 
-        if self._coll_name in self._new_added_colls:
-            return
+    def fetch_delta_data(self, exists=None):
+        """
+        Get the bars missing from the collection from bdshare, all the history for a new collection.
+        Only reads arctic, so it can run in any thread.
+        :param exists(bool): whether the collection is stored, None checks it.
+        :return: his_data(DataFrame), normalized, may be empty.
+        """
+
+        if exists is None:
+            profiling.count('mongo_calls')
+            exists = self._library.has_symbol(self._coll_name)
+        if not exists:
+            self._latest_date = None
+            end = dt.datetime.now().date()
+            profiling.count('bdshare_calls')
+            with profiling.timer('dse.download'):
+                his_data = self._source.get_basic_hist_data('2008-01-01', end, code=self._coll_name, index='date')
+            if len(his_data) == 0:
+                logger.warning(
+                    f'data of stock {self._coll_name} when initiation is empty'
+                )
+                return his_data
+
+            return bdu.Utils.normalize(his_data.sort_index())
 
         # 15:00 PM can get today data
-        # start = latest_date + 1 day
-        latest_date = self.get_data().index[-1]
-        start = latest_date + dt.timedelta(days=1)
-        start = dt.datetime.strftime(start, '%Y-%m-%d')
-
-        his_data = bds.get_basic_hist_data(
-            start=start,
-            end=start,
-            code=self._coll_name
-        )
+        # catch up all the missing days at once: [latest_date + 1 day, today]
+        self._latest_date = self.get_data().index[-1]
+        start = (self._latest_date + dt.timedelta(days=1)).date()
+        end = dt.datetime.now().date()
+        if start > end:
+            logger.info(f'stock {self._coll_name} is up to date.')
+            return pd.DataFrame()
+
+        profiling.count('bdshare_calls')
+        with profiling.timer('dse.download'):
+            his_data = self._source.get_basic_hist_data(
+                start=start.strftime('%Y-%m-%d'),
+                end=end.strftime('%Y-%m-%d'),
+                code=self._coll_name,
+                index='date'
+            )
 
         # delta data is empty
         if len(his_data) == 0:
             logger.info(
-                f'delta data of stock {self._coll_name} is empty, after {start}')
-            return
+                f'delta data of stock {self._coll_name} is empty, from {start} to {end}')
+            return his_data
 
         his_data = bdu.Utils.strip_unused_cols(his_data, *self._unused_cols)
+        his_data = bdu.Utils.normalize(his_data.sort_index())
+        # never append a bar already stored
+        his_data = his_data[his_data.index > self._latest_date]
+        logger.info(f'got {len(his_data)} bars of delta data of stock: {self._coll_name}, from {start} to {end}')
+
+        return his_data
 
-        logger.info(f'got delta data of stock: {self._coll_name}, after {start}')
-        self._library.append(self._coll_name, his_data)
+    def write_delta_data(self, his_data):
+        """
+        Store the data got by `fetch_delta_data` to arctic.
+        :param his_data(DataFrame): the new bars.
+        :return: None
+        """
+
+        if len(his_data) == 0:
+            return
+
+        if self._latest_date is None:
+            self._new_added_colls.append(self._coll_name)
+            logger.debug(f'write history data for stock: {self._coll_name}.')
+            self._write(his_data)
+            return
 
-    def get_data(self):
+        # read by `get_data` in `fetch_delta_data`, unless it was served by an unchecked cache
+        metadata = self._metadata if self._metadata is not None else self._read_metadata()
+        if metadata.get('schema') != SCHEMA_VERSION:
+            # legacy symbol with a string index or wide columns, migrate it instead of appending mixed types
+            logger.info(f'normalize the schema of stock: {self._coll_name}.')
+            self._write(pd.concat([self.get_data(compact=False), bdu.Utils.to_numeric(his_data)]))
+            return
+
+        dtypes = metadata['dtypes']
+        if not bdu.Utils.is_compact(his_data, dtypes):
+            # e.g. a price with more decimals than float32 keeps, the columns are widened
+            logger.info(f'new bars of stock {self._coll_name} do not fit {dtypes}, rewrite it.')
+            self._write(pd.concat([self.get_data(compact=False), bdu.Utils.to_numeric(his_data)]))
+            return
+
+        his_data = bdu.Utils.compact(his_data, dtypes)
+        self._metadata = self._get_metadata(his_data)
+        profiling.count('mongo_calls')
+        with profiling.timer('dse.arctic_write'):
+            item = self._library.append(self._coll_name, his_data, metadata=self._metadata)
+
+        if self._cache is not None:
+            self._cache.append(self._coll_name, his_data, item.version, self._latest_date)
+
+    def get_data(self, compact=None):
         """
-        Get all the data of one collection.
+        Get all the data of one collection, served by the local cache when it is enabled
+        and, unless `LOCAL_CACHE_CHECK_VERSION` is off, still at the arctic version.
+        :param compact(bool): return the prices as stored (float32) instead of widened to
+            float64, default `COMPACT_DATA`. Both give the same back test results.
         :return: data(DataFrame)
         """
 
-        data = self._library.read(self._coll_name).data
-        # parse the date
-        data.index = data.index.map(bdu.Utils.parse_date)
+        if compact is None:
+            compact = conf.COMPACT_DATA
+        convert = bdu.Utils.compact if compact else bdu.Utils.widen
+
+        with profiling.timer('dse.get_data'):
+            if self._cache is not None:
+                version = None
+                if conf.LOCAL_CACHE_CHECK_VERSION:
+                    profiling.count('mongo_calls')
+                    item = self._library.read_metadata(self._coll_name)
+                    version, self._metadata = item.version, item.metadata or {}
+                with profiling.timer('dse.cache_read'):
+                    data = self._cache.read(self._coll_name, version=version)
+                if data is not None:
+                    profiling.count('cache_hits')
+                    return convert(data)
+
+            profiling.count('mongo_calls')
+            with profiling.timer('dse.arctic_read'):
+                item = self._library.read(self._coll_name)
+            self._metadata = item.metadata or {}
+            # no-op for the symbols still in their stored schema, vectorized date parsing for the legacy ones
+            data = convert(bdu.Utils.normalize(item.data, self._metadata.get('dtypes')))
+
+            if self._cache is not None:
+                # cached as returned, the next reads are not converted again
+                self._cache.write(self._coll_name, data, item.version)
+
+            return data
+
+    def is_normalized(self):
+        """
+        Whether the collection was written with the normalized schema.
+        :return: bool
+        """
+        return self._read_metadata().get('schema') == SCHEMA_VERSION
+
+    def _read_metadata(self):
+        profiling.count('mongo_calls')
+        return self._library.read_metadata(self._coll_name).metadata or {}
 
-        return data
+    def _get_metadata(self, data):
+        return dict(schema=SCHEMA_VERSION, dtypes={str(col): str(dtype) for col, dtype in data.dtypes.items()})
 
-    def _init_coll(self):
+    def _write(self, data):
         """
-        Get all the history data when initiate the library.
-        1. Connect to arctic and create the library.
-        2. Get all the history data from tushare and strip the unused columns.
-        3. Store the data to arctic.
+        Write the whole collection with the normalized schema.
+        :param data(DataFrame): time serials.
         :return: None
         """
+        data = bdu.Utils.normalize(data)
+        self._metadata = self._get_metadata(data)
+        profiling.count('mongo_calls')
+        with profiling.timer('dse.arctic_write'):
+            self._library.write(self._coll_name, data, metadata=self._metadata)
+        if self._cache is not None:
+            self._cache.invalidate(self._coll_name)
 
-        # if collection is not initialized
-        if self._coll_name not in self._library.list_symbols():
-            self._new_added_colls.append(self._coll_name)
-            #end = dt.datetime.now().strftime('%Y-%m-%d')
-            end = dt.datetime.now().date()
-            #start = end - dt.timedelta(days=2*360)
-            his_data = bds.get_basic_hist_data('2008-01-01', end, code=self._coll_name, index='date').sort_index()
-            if len(his_data) == 0:
-                logger.warning(
-                    f'data of stock {self._coll_name} when initiation is empty'
-                )
-                return
 
-            #his_data = bdu.Utils.strip_unused_cols(his_data, *self._unused_cols)
+class RateLimiter(object):
+    """
+    Spread the calls of many threads to at most `rate` per second.
+    Attributes:
+        rate(float): calls per second, None or 0 is unlimited.
+    """
 
-            logger.debug(f'write history data for stock: {self._coll_name}.')
-            self._library.write(self._coll_name, his_data)
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate else 0.0
+        self._next = 0.0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        if not self.interval:
+            return
+
+        with self._lock:
+            now = time.monotonic()
+            at = max(now, self._next)
+            self._next = at + self.interval
+
+        if at > now:
+            time.sleep(at - now)
+
+
+class DeltaIngestor(object):
+    """
+    Bulk delta download: the network requests run concurrently in a bounded thread pool,
+    rate limited and retried. The fetched data is buffered and the calling thread drains the
+    buffer, one append per collection, while the next requests are in flight. The library
+    is listed once per run, and the write of a collection reuses the metadata read by its fetch.
+    Attributes:
+        workers(int): concurrent requests, default `INGEST_WORKERS`.
+        rate(float): requests per second, default `INGEST_RATE_LIMIT`.
+        retries(int): retries of a failed request, default `INGEST_RETRIES`.
+        batch_size(int): fetched collections buffered before they are written, default `INGEST_BATCH_SIZE`.
+        source(module): provider of `get_basic_hist_data`, default bdshare.
+    """
+
+    def __init__(self, workers=None, rate=None, retries=None, batch_size=None, source=None):
+        self.workers = workers or conf.INGEST_WORKERS
+        self.rate = rate if rate is not None else conf.INGEST_RATE_LIMIT
+        self.retries = retries if retries is not None else conf.INGEST_RETRIES
+        self.batch_size = batch_size or conf.INGEST_BATCH_SIZE
+        self.source = source
+        self._limiter = RateLimiter(self.rate)
+
+    def fetch(self, coll_name, exists=None):
+        """
+        Fetch the delta data of one collection, retried with exponential backoff.
+        :param coll_name(string): stock id.
+        :param exists(bool): whether the collection is stored, None checks it.
+        :return: (DseHisData, DataFrame)
+        """
+        his_data = DseHisData(coll_name, source=self.source)
+        for attempt in range(self.retries + 1):
+            self._limiter.wait()
+            try:
+                return his_data, his_data.fetch_delta_data(exists)
+            except Exception as e:
+                if attempt == self.retries:
+                    raise
+                delay = conf.INGEST_RETRY_DELAY * 2 ** attempt
+                logger.warning(f'fetch delta data of stock {coll_name} failed: {e}, retry in {delay}s.')
+                time.sleep(delay)
+
+    def run(self, coll_names):
+        """
+        Download the delta data of all the collections.
+        :param coll_names(list): stock ids.
+        :return: dict(updated, empty, failed), lists of the collections.
+        """
+        result = dict(updated=[], empty=[], failed=[])
+        batch = []
+        profiling.count('mongo_calls')
+        stored = set(get_or_create_library(conf.BD_STOCK_LIBNAME).list_symbols())
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            futures = {
+                executor.submit(self.fetch, coll_name, coll_name in stored): coll_name
+                for coll_name in coll_names
+            }
+            for future in as_completed(futures):
+                coll_name = futures[future]
+                try:
+                    his_data, data = future.result()
+                except Exception as e:
+                    logger.error(f'download delta data of stock {coll_name} failed: {e}', exc_info=True)
+                    result['failed'].append(coll_name)
+                    continue
+
+                if len(data) == 0:
+                    result['empty'].append(coll_name)
+                    continue
+
+                batch.append((his_data, data))
+                if len(batch) >= self.batch_size:
+                    self._flush(batch, result)
+
+            self._flush(batch, result)
+
+        logger.info(
+            f'delta data downloaded, updated: {len(result["updated"])}, '
+            f'empty: {len(result["empty"])}, failed: {len(result["failed"])}.'
+        )
+        return result
+
+    def _flush(self, batch, result):
+        for his_data, data in batch:
+            try:
+                his_data.write_delta_data(data)
+            except Exception as e:
+                logger.error(f'write delta data of stock {his_data._coll_name} failed: {e}', exc_info=True)
+                result['failed'].append(his_data._coll_name)
+                continue
+            result['updated'].append(his_data._coll_name)
+        del batch[:]
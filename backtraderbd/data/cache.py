@@ -0,0 +1,364 @@
+# -*- coding: utf-8 -*-
+import os
+import json
+import uuid
+import shutil
+import hashlib
+
+import numpy as np
+import pandas as pd
+
+import backtraderbd.data.utils as bdu
+from backtraderbd.settings import settings as conf
+from backtraderbd.libs.log import get_logger
+
+
+logger = get_logger(__name__)
+
+# layout of the cached symbols, a cache of an other layout is read as a miss
+CACHE_FORMAT = 2
+
+
+class LocalCache(object):
+    """
+    Read-through on-disk cache in front of one arctic library, every symbol is kept as
+    typed columnar arrays loaded back with memory mapping:
+        <cache_dir>/<lib_name>/<symbol>/index.npy   datetime64[ns] index
+        <cache_dir>/<lib_name>/<symbol>/<i>.npy     values of the i-th column, in its dtype
+        <cache_dir>/<lib_name>/<symbol>/meta.json   columns, dtypes, arctic version, last bar date
+    Attributes:
+        lib_name(string): arctic library name.
+        cache_dir(string): root directory of the cache.
+    """
+
+    def __init__(self, lib_name, cache_dir=None):
+        self.lib_name = lib_name
+        self.cache_dir = cache_dir or conf.LOCAL_CACHE_DIR
+
+    def _path(self, symbol, name=''):
+        return os.path.join(self.cache_dir, self.lib_name, symbol, name)
+
+    def get_meta(self, symbol):
+        """
+        Get the meta data of a cached symbol.
+        :param symbol(string): arctic symbol.
+        :return: dict(format, columns, dtypes, index_name, rows, version, last_date) or None
+        """
+        try:
+            with open(self._path(symbol, 'meta.json')) as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            return None
+
+        return meta if meta.get('format') == CACHE_FORMAT else None
+
+    def read(self, symbol, version=None):
+        """
+        Get the cached data of a symbol, the arrays are memory mapped (read only).
+        :param symbol(string): arctic symbol.
+        :param version(int): expected arctic version, None does not check it.
+        :return: data(DataFrame) or None if the symbol is not (validly) cached.
+        """
+        meta = self.get_meta(symbol)
+        if meta is None:
+            return None
+        if version is not None and meta['version'] != version:
+            logger.debug(f'cache of {symbol} is version {meta["version"]}, arctic is {version}.')
+            return None
+
+        try:
+            index = np.load(self._path(symbol, 'index.npy'), mmap_mode='r')
+            values = [np.load(self._path(symbol, f'{i}.npy'), mmap_mode='r') for i in range(len(meta['columns']))]
+        except (OSError, ValueError):
+            return None
+        if any(len(array) != meta['rows'] for array in [index] + values):
+            # a writer is in the middle of an update
+            return None
+
+        return pd.DataFrame(
+            dict(zip(meta['columns'], values)),
+            index=pd.DatetimeIndex(index, name=meta['index_name'], copy=False),
+            columns=meta['columns'],
+            copy=False
+        )
+
+    def write(self, symbol, data, version):
+        """
+        Replace the cached data of a symbol.
+        :param symbol(string): arctic symbol.
+        :param data(DataFrame): time serials with a datetime index and numeric columns, kept in their dtypes.
+        :param version(int): arctic version of the data.
+        :return: None
+        """
+        try:
+            index = np.asarray(data.index.values, dtype='datetime64[ns]')
+            data = bdu.Utils.to_numeric(data, widen=False)
+            values = [np.ascontiguousarray(data[col].to_numpy()) for col in data.columns]
+        except (TypeError, ValueError) as e:
+            logger.warning(f'can not cache symbol {symbol}: {e}')
+            self.invalidate(symbol)
+            return
+
+        meta = dict(
+            format=CACHE_FORMAT,
+            columns=[str(c) for c in data.columns],
+            dtypes=[str(array.dtype) for array in values],
+            index_name=data.index.name,
+            rows=len(data),
+            version=version,
+            last_date=str(index[-1])[:10] if len(index) else None,
+        )
+
+        try:
+            os.makedirs(self._path(symbol), exist_ok=True)
+            # meta is written last, it marks the arrays as complete
+            self._replace(symbol, 'meta.json', None)
+            self._replace(symbol, 'index.npy', index)
+            for i, array in enumerate(values):
+                self._replace(symbol, f'{i}.npy', array)
+            self._replace(symbol, 'meta.json', meta)
+        except OSError as e:
+            logger.warning(f'write cache of symbol {symbol} failed: {e}')
+
+    def append(self, symbol, data, version, last_date):
+        """
+        Append new bars to the cached data of a symbol, the cache is dropped
+        if it does not end at `last_date`.
+        :param symbol(string): arctic symbol.
+        :param data(DataFrame): new bars with a datetime index and numeric columns.
+        :param version(int): arctic version after the append.
+        :param last_date(datetime): last bar date before the append.
+        :return: None
+        """
+        cached = self.read(symbol)
+        if cached is None:
+            return
+
+        # the new bars in the dtypes of the cached ones: widened for a wide cache
+        dtypes = {col: dtype for col, dtype in cached.dtypes.items()}
+        data = bdu.Utils.to_numeric(data, widen=np.float32 not in dtypes.values())
+        if len(cached) == 0 or cached.index[-1] != pd.Timestamp(last_date) \
+                or not bdu.Utils.is_compact(data, dtypes):
+            logger.debug(f'cache of {symbol} is stale, drop it.')
+            self.invalidate(symbol)
+            return
+
+        self.write(symbol, pd.concat([cached, bdu.Utils.compact(data, dtypes)]), version)
+
+    def invalidate(self, symbol):
+        """
+        Drop the cached data of a symbol.
+        :param symbol(string): arctic symbol.
+        :return: None
+        """
+        shutil.rmtree(self._path(symbol), ignore_errors=True)
+
+    def _replace(self, symbol, name, content):
+        path = self._path(symbol, name)
+        if content is None:
+            if os.path.exists(path):
+                os.remove(path)
+            return
+
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        if isinstance(content, np.ndarray):
+            with open(tmp_path, 'wb') as f:
+                np.save(f, content)
+        else:
+            with open(tmp_path, 'w') as f:
+                json.dump(content, f)
+        os.replace(tmp_path, path)
+
+
+class ResultCache(object):
+    """
+    Persistent content addressed cache of back test results. A group of results is keyed by the hash of
+    (data content, strategy class, broker settings), each result in the group by its params, so unchanged
+    symbols (no new bar, trading halt) and repeated experiments are not back tested again:
+        <cache_dir>/<group key>/<part>.json    params -> analysis data
+    Every `put` writes its own part, so the workers training chunks of the same stock at once never
+    overwrite each other, the parts of a group are merged into one when a `get` reads more than `MAX_PARTS`.
+    The least recently used groups are evicted when the cache grows over `max_bytes`.
+    Attributes:
+        cache_dir(string): directory of the cache.
+        max_bytes(int): size limit of the cache.
+    """
+
+    # bump to drop the results of older engines
+    VERSION = 1
+    # parts of a group read before they are merged
+    MAX_PARTS = 32
+
+    def __init__(self, cache_dir=None, max_bytes=None):
+        self.cache_dir = cache_dir or conf.RESULT_CACHE_DIR
+        self.max_bytes = max_bytes or conf.RESULT_CACHE_MAX_BYTES
+
+    @classmethod
+    def get_data_version(cls, data):
+        """
+        Hash of the content of the time serials.
+        :param data(DataFrame): time serials with a datetime index and numeric columns.
+        :return: string
+        """
+        digest = hashlib.sha1()
+        digest.update(json.dumps([str(c) for c in data.columns]).encode())
+        digest.update(np.ascontiguousarray(np.asarray(data.index.values, dtype='datetime64[ns]')).tobytes())
+        digest.update(np.ascontiguousarray(bdu.Utils.to_numeric(data).to_numpy(dtype=np.float64)).tobytes())
+
+        return digest.hexdigest()
+
+    @classmethod
+    def get_broker_settings(cls, **kwargs):
+        """
+        Broker settings a back test depends on, from `settings/common.py`.
+        :param kwargs: settings overridden by the back test, e.g. commission=0.0.
+        :return: dict
+        """
+        settings = dict(
+            cash=conf.DEFAULT_CASH,
+            commission=conf.COMMISSION_PER_TRANSACTION,
+            commission_per_transaction=conf.COMMISSION_PER_TRANSACTION,
+            execution_type=conf.EXECUTION_TYPE,
+            buy_prop=conf.BUY_PROP,
+            sell_prop=conf.SELL_PROP,
+        )
+        settings.update(kwargs)
+
+        return settings
+
+    def get_group_key(self, Strategy, data_version, broker_settings):
+        """
+        :param Strategy(class): strategy back tested.
+        :param data_version(string): version of the data, e.g. `get_data_version(data)`.
+        :param broker_settings(dict): see `get_broker_settings`.
+        :return: string
+        """
+        content = json.dumps(
+            [self.VERSION, f'{Strategy.__module__}.{Strategy.__qualname__}', data_version, broker_settings],
+            sort_keys=True, default=str
+        )
+
+        return hashlib.sha1(content.encode()).hexdigest()
+
+    @classmethod
+    def _params_key(cls, params):
+        return json.dumps(params, sort_keys=True, default=str)
+
+    def _path(self, group):
+        return os.path.join(self.cache_dir, group)
+
+    def _read(self, group):
+        """
+        :return: results of all the parts of the group and the parts read(tuple)
+        """
+        try:
+            paths = [entry.path for entry in os.scandir(self._path(group)) if entry.name.endswith('.json')]
+        except OSError:
+            return {}, []
+
+        results, parts = {}, []
+        for path in paths:
+            try:
+                with open(path) as f:
+                    results.update(json.load(f))
+            except (OSError, ValueError):
+                # removed by a concurrent merge, or not written completely
+                continue
+            parts.append(path)
+
+        return results, parts
+
+    def _write_part(self, group, results):
+        group_dir = self._path(group)
+        os.makedirs(group_dir, exist_ok=True)
+        path = os.path.join(group_dir, f'{os.getpid()}-{uuid.uuid4().hex}.json')
+        tmp_path = f'{path}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(results, f)
+        os.replace(tmp_path, path)
+
+        return path
+
+    def _merge(self, group, results, parts):
+        """
+        Replace the parts read by one part holding all their results,
+        the parts written meanwhile are kept.
+        """
+        try:
+            self._write_part(group, results)
+        except OSError as e:
+            logger.warning(f'merge result cache failed: {e}')
+            return
+        for path in parts:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def get(self, group, params_list):
+        """
+        Get the cached results of the param sets.
+        :param group(string): group key, see `get_group_key`.
+        :param params_list(list): dicts of strategy params.
+        :return: list of the analysis data, None for the param sets not cached.
+        """
+        results, parts = self._read(group)
+        if results:
+            # mark as recently used
+            try:
+                os.utime(self._path(group))
+            except OSError:
+                pass
+        if len(parts) > self.MAX_PARTS:
+            self._merge(group, results, parts)
+
+        return [results.get(self._params_key(params)) for params in params_list]
+
+    def put(self, group, params_list, analyses):
+        """
+        Add results to the cache, written as a new part of the group.
+        :param group(string): group key, see `get_group_key`.
+        :param params_list(list): dicts of strategy params.
+        :param analyses(list): analysis data of each param set.
+        :return: None
+        """
+        results = {self._params_key(params): analysis for params, analysis in zip(params_list, analyses)}
+        try:
+            self._write_part(group, results)
+        except OSError as e:
+            logger.warning(f'write result cache failed: {e}')
+            return
+
+        self.evict()
+
+    def evict(self):
+        """
+        Remove the least recently used groups until the cache fits in `max_bytes`.
+        :return: None
+        """
+        try:
+            entries = [entry for entry in os.scandir(self.cache_dir) if entry.is_dir()]
+        except OSError:
+            return
+
+        stats = []
+        for entry in entries:
+            try:
+                size = sum(part.stat().st_size for part in os.scandir(entry.path))
+                stats.append((entry.stat().st_mtime, size, entry.path))
+            except OSError:
+                continue
+
+        total = sum(size for _, size, _ in stats)
+        for _, size, path in sorted(stats):
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+
+    def clear(self):
+        """
+        Remove all the cached results.
+        :return: None
+        """
+        shutil.rmtree(self.cache_dir, ignore_errors=True)
@@ -0,0 +1,234 @@
+# -*- coding: utf-8 -*-
+import sys
+from multiprocessing import shared_memory, resource_tracker
+
+import numpy as np
+import pandas as pd
+
+import backtraderbd.data.bdshare as bds
+import backtraderbd.data.utils as bdu
+from backtraderbd.settings import settings as conf
+from backtraderbd.libs.log import get_logger
+
+
+logger = get_logger(__name__)
+
+# handles known by this process, set in the pool workers by `init_worker`
+_handles = {}
+# shared memory blocks attached by this process, name -> SharedMemory
+_attached = {}
+# attached blocks kept open by a worker before the oldest ones are closed
+MAX_ATTACHED = 16
+
+
+def _aligned(nbytes):
+    return (nbytes + 7) // 8 * 8
+
+
+class SharedOHLCV(object):
+    """
+    Lightweight, picklable handle of one stock's time serials in shared memory.
+    Layout of the block: datetime64[ns] index as int64, then the values of each
+    column in its dtype, every array starting on 8 bytes.
+    Attributes:
+        stock_id(string): stock id like 'ACI'.
+        name(string): name of the shared memory block.
+        length(int): number of bars.
+        columns(list): column names, e.g. ['open', 'high', 'low', 'close', 'volume'].
+        index_name(string): name of the index.
+        dtypes(list): dtype names of the columns, default all float64.
+    """
+
+    def __init__(self, stock_id, name, length, columns, index_name=None, dtypes=None):
+        self.stock_id = stock_id
+        self.name = name
+        self.length = length
+        self.columns = list(columns)
+        self.index_name = index_name
+        self.dtypes = list(dtypes) if dtypes is not None else ['float64'] * len(self.columns)
+
+    @property
+    def offsets(self):
+        """
+        :return: offset of each column in the block(list)
+        """
+        offsets, offset = [], 8 * self.length
+        for dtype in self.dtypes:
+            offsets.append(offset)
+            offset += _aligned(np.dtype(dtype).itemsize * self.length)
+        return offsets
+
+    @property
+    def nbytes(self):
+        return 8 * self.length + sum(_aligned(np.dtype(dtype).itemsize * self.length) for dtype in self.dtypes)
+
+    def attach(self):
+        """
+        Map the block and wrap it as a read only DataFrame, nothing is copied.
+        :return: data(DataFrame)
+        """
+        shm = _attached.get(self.name)
+        if shm is None:
+            shm = _open(self.name)
+            _attached[self.name] = shm
+            _evict()
+
+        return self._wrap(shm)
+
+    def _wrap(self, shm):
+        index = np.ndarray((self.length,), dtype='datetime64[ns]', buffer=shm.buf)
+        index.flags.writeable = False
+        values = {}
+        for col, dtype, offset in zip(self.columns, self.dtypes, self.offsets):
+            values[col] = np.ndarray((self.length,), dtype=dtype, buffer=shm.buf, offset=offset)
+            values[col].flags.writeable = False
+
+        return pd.DataFrame(
+            values,
+            index=pd.DatetimeIndex(index, name=self.index_name, copy=False),
+            columns=self.columns,
+            copy=False
+        )
+
+
+def _open(name):
+    """
+    Attach to an existing block without registering it to the resource tracker,
+    which would unlink it when this process exits, the owner does that.
+    """
+    if sys.version_info >= (3, 13):
+        return shared_memory.SharedMemory(name=name, track=False)
+
+    register = resource_tracker.register
+    resource_tracker.register = lambda name, rtype: None
+    try:
+        return shared_memory.SharedMemory(name=name)
+    finally:
+        resource_tracker.register = register
+
+
+def _evict():
+    # close the oldest attachments, a block still viewed by a DataFrame stays open
+    for name in list(_attached)[:-MAX_ATTACHED]:
+        try:
+            _attached[name].close()
+        except BufferError:
+            continue
+        del _attached[name]
+
+
+def init_worker(handles):
+    """
+    Pool initializer, make the shared time serials known to the worker.
+    :param handles(dict): stock_id -> SharedOHLCV.
+    :return: None
+    """
+    _handles.clear()
+    _handles.update(handles)
+
+
+def get_shared_data(stock_id):
+    """
+    Get the shared time serials of the stock if this process knows a handle for it.
+    :param stock_id(string): stock id.
+    :return: data(DataFrame) or None
+    """
+    handle = _handles.get(stock_id)
+    if handle is None:
+        return None
+
+    return handle.attach()
+
+
+class SharedDataStore(object):
+    """
+    Owner of the shared memory blocks: every stock is loaded once in the parent process,
+    the pool workers get the handles and attach to the blocks without copying.
+    Use it as a context manager, the blocks are unlinked on exit.
+    Attributes:
+        compact(bool): share the data with the compact schema (float32 prices), default `COMPACT_DATA`,
+            widened back exactly by `Utils.to_numeric` in the workers.
+        handles(dict): stock_id -> SharedOHLCV.
+    """
+
+    def __init__(self, compact=None):
+        self.compact = conf.COMPACT_DATA if compact is None else compact
+        self.handles = {}
+        self._blocks = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def put(self, stock_id, data):
+        """
+        Copy the time serials of one stock into shared memory.
+        :param stock_id(string): stock id.
+        :param data(DataFrame): time serials with a datetime index and numeric columns.
+        :return: SharedOHLCV
+        """
+        if stock_id in self.handles:
+            return self.handles[stock_id]
+
+        index = np.asarray(data.index.values, dtype='datetime64[ns]').view(np.int64)
+        data = bdu.Utils.to_numeric(data, widen=not self.compact)
+        if self.compact:
+            data = bdu.Utils.compact(data)
+
+        handle = SharedOHLCV(stock_id, None, len(data), data.columns, data.index.name,
+                             [str(dtype) for dtype in data.dtypes])
+        shm = shared_memory.SharedMemory(create=True, size=max(handle.nbytes, 1))
+        handle.name = shm.name
+        np.ndarray((len(data),), dtype=np.int64, buffer=shm.buf)[:] = index
+        for col, dtype, offset in zip(data.columns, handle.dtypes, handle.offsets):
+            np.ndarray((len(data),), dtype=dtype, buffer=shm.buf, offset=offset)[:] = data[col].to_numpy()
+
+        self._blocks[stock_id] = shm
+        self.handles[stock_id] = handle
+        return handle
+
+    def load(self, stock_ids, get_data=None):
+        """
+        Load the stocks (once each) into shared memory.
+        :param stock_ids(list): stock ids.
+        :param get_data(callable): stock_id -> DataFrame, default reads `DseHisData`.
+        :return: dict(stock_id: SharedOHLCV)
+        """
+        if get_data is None:
+            get_data = lambda stock_id: bds.DseHisData(stock_id).get_data()
+
+        for stock_id in stock_ids:
+            if stock_id in self.handles:
+                continue
+            try:
+                self.put(stock_id, get_data(stock_id))
+            except Exception as e:
+                logger.error(f'load stock {stock_id} to shared memory failed: {e}', exc_info=True)
+
+        logger.debug(
+            f'{len(self.handles)} stocks in shared memory, '
+            f'{sum(h.nbytes for h in self.handles.values()) / 2 ** 20:.1f} MiB.'
+        )
+        return self.handles
+
+    def release(self, stock_id):
+        """
+        Unlink the block of one stock, attached workers keep their mapping until they close it.
+        :param stock_id(string): stock id.
+        :return: None
+        """
+        self.handles.pop(stock_id, None)
+        shm = self._blocks.pop(stock_id, None)
+        if shm is not None:
+            shm.close()
+            shm.unlink()
+
+    def close(self):
+        """
+        Unlink all the blocks.
+        :return: None
+        """
+        for stock_id in list(self._blocks):
+            self.release(stock_id)
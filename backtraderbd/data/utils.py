@@ -1,6 +1,16 @@
 # -*- coding: utf-8 -*-
 import datetime
 
+import numpy as np
+import pandas as pd
+
+from backtraderbd.settings import settings as conf
+from backtraderbd.libs import profiling
+
+# columns of the compact schema: float32 prices, int64 volume
+PRICE_COLUMNS = ('open', 'high', 'low', 'close')
+VOLUME_COLUMNS = ('volume',)
+
 
 class Utils(object):
     """
@@ -23,3 +33,143 @@ class Utils(object):
     @classmethod
     def parse_date(cls, date_string):
         return datetime.datetime.strptime(date_string, '%Y-%m-%d')
+
+    @classmethod
+    def parse_dates(cls, dates):
+        """
+        Vectorized `parse_date` for a whole index.
+        :param dates(Index): dates like '2020-04-08'.
+        :return: DatetimeIndex, datetime64[ns]
+        """
+        with profiling.timer('data.parse_dates'):
+            dates = pd.DatetimeIndex(pd.to_datetime(dates, format='%Y-%m-%d'), name=dates.name)
+            return dates.astype('datetime64[ns]')
+
+    @classmethod
+    def to_numeric(cls, data, widen=True):
+        """
+        Convert the non numeric columns to numbers, data already numeric is returned as is.
+        :param data(DataFrame): input data frame.
+        :param widen(bool): widen the float32 prices of the compact schema to float64, see `widen`.
+        :return: data(DataFrame)
+        """
+        non_numeric = [
+            col for col, dtype in data.dtypes.items()
+            if not pd.api.types.is_numeric_dtype(dtype)
+        ]
+        if non_numeric:
+            with profiling.timer('data.to_numeric'):
+                data = data.copy()
+                for col in non_numeric:
+                    data[col] = pd.to_numeric(data[col])
+
+        return cls.widen(data) if widen else data
+
+    @classmethod
+    def widen_values(cls, values):
+        """
+        Widen float32 values to the float64 values they were compacted from:
+        rounded to `PRICE_DECIMALS`, exact for the values `compact` stored as float32.
+        :param values(ndarray): float32 values.
+        :return: float64 values(ndarray)
+        """
+        return np.round(np.asarray(values, dtype=np.float64), conf.PRICE_DECIMALS)
+
+    @classmethod
+    def widen(cls, data):
+        """
+        Float32 columns back to float64, the prices with `widen_values`,
+        data without float32 columns is returned as is.
+        :param data(DataFrame): time serials, e.g. read with the compact schema.
+        :return: data(DataFrame)
+        """
+        narrow = [col for col, dtype in data.dtypes.items() if dtype == np.float32]
+        if not narrow:
+            return data
+
+        data = data.copy(deep=False)
+        for col in narrow:
+            values = data[col].to_numpy()
+            data[col] = cls.widen_values(values) if col in PRICE_COLUMNS else values.astype(np.float64)
+
+        return data
+
+    @classmethod
+    def get_compact_dtypes(cls, data):
+        """
+        Dtypes of the compact schema of numeric time serials. The prices are float32 only if
+        they are widened back without error: at most `PRICE_DECIMALS` decimals, not too large;
+        the volume is int64 if it has integer values only. The other columns keep their dtype.
+        :param data(DataFrame): numeric time serials.
+        :return: dict(column: dtype)
+        """
+        dtypes = {}
+        for col, dtype in data.dtypes.items():
+            values = data[col].to_numpy()
+            if col in PRICE_COLUMNS and dtype in (np.float32, np.float64):
+                lossless = dtype == np.float32 or np.array_equal(
+                    cls.widen_values(values.astype(np.float32)), values, equal_nan=True)
+                dtypes[col] = np.dtype(np.float32) if lossless else np.dtype(np.float64)
+            elif col in VOLUME_COLUMNS and (pd.api.types.is_integer_dtype(dtype) or (
+                    pd.api.types.is_float_dtype(dtype) and
+                    np.isfinite(values).all() and (values == np.round(values)).all())):
+                dtypes[col] = np.dtype(np.int64)
+            else:
+                dtypes[col] = dtype
+
+        return dtypes
+
+    @classmethod
+    def compact(cls, data, dtypes=None):
+        """
+        Cast the time serials to the compact schema, data already compact is returned as is.
+        :param data(DataFrame): numeric time serials.
+        :param dtypes(dict): column -> dtype, default `get_compact_dtypes`.
+        :return: data(DataFrame)
+        """
+        if dtypes is None:
+            dtypes = cls.get_compact_dtypes(data)
+        changed = {col: dtype for col, dtype in dtypes.items()
+                   if col in data.columns and data[col].dtype != dtype}
+        if not changed:
+            return data
+
+        with profiling.timer('data.compact'):
+            return data.astype(changed)
+
+    @classmethod
+    def is_compact(cls, data, dtypes):
+        """
+        Whether the data can be cast to the dtypes without loss.
+        :param data(DataFrame): numeric time serials.
+        :param dtypes(dict): column -> dtype, e.g. stored in the symbol metadata.
+        :return: bool
+        """
+        if [str(col) for col in data.columns] != list(dtypes):
+            return False
+        compact_dtypes = cls.get_compact_dtypes(data)
+        # a float64 column takes any value, a compact one only the values that fit it
+        return all(np.dtype(dtype) == np.float64 or np.dtype(dtype) == compact_dtypes[col]
+                   for col, dtype in dtypes.items())
+
+    @classmethod
+    def normalize(cls, data, dtypes=None):
+        """
+        Normalize the schema of the time serials: datetime64 index and compact numeric columns,
+        see `compact`. Without `dtypes` the compact dtypes are checked on every call (O(n) for
+        the float64 prices), with the dtypes the data was stored in, data still in them is
+        returned as is.
+        :param data(DataFrame): input data frame.
+        :param dtypes(dict): column -> dtype name of the stored schema, e.g. the symbol metadata.
+        :return: data(DataFrame)
+        """
+        if dtypes is not None and data.index.dtype == 'datetime64[ns]' and \
+                [str(col) for col in data.columns] == list(dtypes) and \
+                all(str(dtype) == dtypes[str(col)] for col, dtype in data.dtypes.items()):
+            return data
+
+        if data.index.dtype != 'datetime64[ns]':
+            data = data.copy(deep=False)
+            data.index = cls.parse_dates(data.index)
+
+        return cls.compact(cls.to_numeric(data, widen=False))
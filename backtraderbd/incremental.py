@@ -0,0 +1,253 @@
+# -*- coding: utf-8 -*-
+import os
+import pickle
+
+import backtraderbd.data.utils as bdu
+from backtraderbd.btask import Btask
+from backtraderbd.strategies.indicators import IndicatorCache
+from backtraderbd.strategies.vectorized import VectorizedBacktest
+from backtraderbd.settings import settings as conf
+from backtraderbd.libs.log import get_logger
+
+logger = get_logger(__name__)
+
+
+class TrainingChunk(object):
+    """
+    Param sets trained together and their state at the end of the history.
+    Attributes:
+        params_list(list): dicts of strategy params.
+        signals(SignalState): indicators and signals on the last bar.
+        engine(EngineState): broker and analyzers on the last bar.
+    """
+
+    def __init__(self, params_list, signals, engine):
+        self.params_list = params_list
+        self.signals = signals
+        self.engine = engine
+
+
+class TrainingState(object):
+    """
+    End of history state of every candidate param set of one strategy on one stock.
+    Attributes:
+        strategy(string): strategy class name.
+        stock_id(string): stock id.
+        bars(int): bars trained on.
+        last_date(Timestamp): date of the last bar trained on.
+        last_close(float): close of the last bar trained on, detects a revised history.
+        chunks(list): TrainingChunk.
+    """
+
+    # bump when the saved states can not be resumed any more
+    VERSION = 1
+
+    def __init__(self, strategy, stock_id, bars, last_date, last_close, chunks):
+        self.version = self.VERSION
+        self.strategy = strategy
+        self.stock_id = stock_id
+        self.bars = bars
+        self.last_date = last_date
+        self.last_close = last_close
+        self.chunks = chunks
+
+    def is_resumable(self, data):
+        """
+        Whether the data is the trained history with bars appended.
+        :param data(DataFrame): time serials of the stock.
+        :return: bool
+        """
+        if self.version != self.VERSION or not 0 < self.bars <= len(data):
+            return False
+
+        return (data.index[self.bars - 1] == self.last_date and
+                float(data['close'].iloc[self.bars - 1]) == self.last_close)
+
+
+class TrainingStateStore(object):
+    """
+    On-disk store of the training states, one pickle per strategy and stock:
+        <state_dir>/<strategy>/<stock_id>.pkl
+    Attributes:
+        state_dir(string): directory of the store.
+    """
+
+    def __init__(self, state_dir=None):
+        self.state_dir = state_dir or conf.TRAINING_STATE_DIR
+
+    def _path(self, Strategy, stock_id):
+        return os.path.join(self.state_dir, Strategy.__name__, f'{stock_id}.pkl')
+
+    def get(self, Strategy, stock_id):
+        """
+        :param Strategy(class): strategy trained.
+        :param stock_id(string): stock id.
+        :return: TrainingState, None if there is no state.
+        """
+        try:
+            with open(self._path(Strategy, stock_id), 'rb') as f:
+                return pickle.load(f)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logger.warning(f'read training state of stock {stock_id} failed: {e}')
+            return None
+
+    def put(self, Strategy, state):
+        """
+        :param Strategy(class): strategy trained.
+        :param state(TrainingState): state to save.
+        :return: None
+        """
+        path = self._path(Strategy, state.stock_id)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f'{path}.{os.getpid()}.tmp'
+            with open(tmp_path, 'wb') as f:
+                pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.warning(f'write training state of stock {state.stock_id} failed: {e}')
+
+    def delete(self, Strategy, stock_id):
+        try:
+            os.remove(self._path(Strategy, stock_id))
+        except FileNotFoundError:
+            pass
+
+
+class IncrementalTrainer(object):
+    """
+    Training that only back tests the bars appended since the last run: the state of every
+    candidate param set (indicators, position, cash, analyzers) is saved at the end of the
+    history and resumed on the new bars, then the candidates are ranked again.
+    A stock without a saved state, or whose history was revised, is trained from the first bar.
+    Same results as `Btask.train_strategy_vectorized` on the whole history.
+    Attributes:
+        Strategy(class): strategy to train, e.g. SMACStrategy.
+        store(TrainingStateStore): saved states, default in `TRAINING_STATE_DIR`.
+        chunk_size(int): param sets simulated together, default `VECTORIZED_CHUNK_SIZE`.
+        on_result(callable): called with (stock_id, params) for every trained stock by `run`.
+    """
+
+    def __init__(self, Strategy, store=None, chunk_size=None, on_result=None):
+        self.Strategy = Strategy
+        self.store = store or TrainingStateStore()
+        self.chunk_size = chunk_size or conf.VECTORIZED_CHUNK_SIZE
+        self.on_result = on_result
+        # same broker as train_strategy: no commission
+        self.engine = VectorizedBacktest(commission=0.0)
+
+    @classmethod
+    def _params_key(cls, params):
+        return tuple(sorted(params.items()))
+
+    def _build(self, data, params_list):
+        """
+        Back test param sets on the whole history.
+        :return: chunks and analysis data of each param set(tuple)
+        """
+        indicators = IndicatorCache(data)
+        chunks, analyses = [], []
+        for i in range(0, len(params_list), self.chunk_size):
+            chunk = params_list[i:i + self.chunk_size]
+            buy_signal, sell_signal = self.Strategy.get_signals(indicators, chunk)
+            result = self.engine.run(data['close'], buy_signal, sell_signal, open=data['open'])
+            chunks.append(TrainingChunk(chunk, self.Strategy.get_signal_state(indicators, chunk), result.state))
+            analyses.extend(result.get_analysis())
+
+        return chunks, analyses
+
+    def _resume(self, chunk, new_data):
+        """
+        Back test the param sets of a chunk on the new bars.
+        :return: analysis data of each param set(list)
+        """
+        if not len(new_data):
+            return chunk.engine.get_analysis()
+
+        buy_signal, sell_signal = chunk.signals.run(new_data['close'].to_numpy())
+        result = self.engine.run(new_data['close'], buy_signal, sell_signal,
+                                 open=new_data['open'], state=chunk.engine)
+        chunk.engine = result.state
+
+        return result.get_analysis()
+
+    def evaluate(self, data, stock_id, params_list):
+        """
+        Back test the param sets on the whole history, resuming from the saved state.
+        :param data(DataFrame): time serials of the stock.
+        :param stock_id(string): stock id.
+        :param params_list(list): dicts of strategy params.
+        :return: list(dict(params, total_return_rate, max_drawdown, max_drawdown_period))
+        """
+        data = bdu.Utils.to_numeric(data)
+        state = self.store.get(self.Strategy, stock_id)
+        if state is not None and not state.is_resumable(data):
+            logger.debug(f'history of stock {stock_id} was revised, train {self.Strategy.__name__} again.')
+            state = None
+
+        chunks, analyses = [], {}
+        if state is not None:
+            new_data = data.iloc[state.bars:]
+            for chunk in state.chunks:
+                if not chunk.signals.warm:
+                    # indicators not seeded yet, built again on the longer history
+                    continue
+                chunks.append(chunk)
+                for params, analysis in zip(chunk.params_list, self._resume(chunk, new_data)):
+                    analyses[self._params_key(params)] = analysis
+            logger.debug(f'{self.Strategy.__name__} of stock {stock_id} resumed on {len(new_data)} new bars.')
+
+        missing = [params for params in params_list if self._params_key(params) not in analyses]
+        if missing:
+            new_chunks, new_analyses = self._build(data, missing)
+            chunks.extend(new_chunks)
+            for params, analysis in zip(missing, new_analyses):
+                analyses[self._params_key(params)] = analysis
+            logger.debug(f'{len(missing)} param sets of {self.Strategy.__name__} trained on the whole history.')
+
+        if len(data):
+            self.store.put(self.Strategy, TrainingState(
+                self.Strategy.__name__, stock_id, len(data), data.index[-1],
+                float(data['close'].iloc[-1]), chunks
+            ))
+
+        return [dict(params=params, **analyses[self._params_key(params)]) for params in params_list]
+
+    def train(self, stock_id, data=None, params_list=None):
+        """
+        Find the best params of the strategy for one stock.
+        :param stock_id(string): stock id.
+        :param data(DataFrame): time serials, default `Btask.get_data(stock_id)`.
+        :param params_list(list): dicts of strategy params, default is `get_strategy_params_list`.
+        :return: params(dict like {fast_period: 1, slow_period: 2, stock_id: '0'})
+        """
+        if data is None:
+            data = Btask.get_data(stock_id)
+        if params_list is None:
+            params_list = Btask.get_strategy_params_list(data, stock_id)
+
+        al_results = self.evaluate(data, stock_id, params_list)
+
+        return Btask.get_best_params(al_results, stock_id)
+
+    def run(self, stock_ids):
+        """
+        Train all the stocks.
+        :param stock_ids(list): stock ids.
+        :return: dict(stock_id: params)
+        """
+        best_params = {}
+        for stock_id in stock_ids:
+            try:
+                params = self.train(stock_id)
+            except Exception as e:
+                logger.error(f'incremental training of stock {stock_id} failed: {e}', exc_info=True)
+                continue
+
+            best_params[stock_id] = params
+            if self.on_result is not None:
+                self.on_result(stock_id, params)
+
+        return best_params
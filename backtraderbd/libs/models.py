@@ -1,22 +1,66 @@
 # -*- coding: utf-8 -*-
+import os
+import threading
+
 import arctic
 import pandas as pd
+from backtraderbd.libs import profiling
 from backtraderbd.libs.log import get_logger
 from backtraderbd.settings import settings as conf
 
 
 logger = get_logger(__name__)
 
+# connection and library handles shared by the whole process,
+# a forked child must not reuse the sockets of its parent
+_store = None
+_store_pid = None
+_libraries = {}
+_lock = threading.RLock()
+
+
+def _reset_store():
+    global _store, _store_pid
+    _store = None
+    _store_pid = None
+    _libraries.clear()
+
+
+def reset_store():
+    """
+    Close the arctic store connection of this process, the next call reconnects.
+    :return: None
+    """
+
+    with _lock:
+        if _store is not None and _store_pid == os.getpid():
+            _store.reset()
+        _reset_store()
+
 
 def get_store():
     """
-    get Arctic store connection
+    get Arctic store connection, one pooled connection per process
     :return: arctic connection
     """
 
-    mongo_host = conf.MONGO_HOST
-    store = arctic.Arctic(mongo_host)
-    return store
+    global _store, _store_pid
+
+    with _lock:
+        if _store_pid != os.getpid():
+            # first call, or a forked child holding the parent's connection
+            _reset_store()
+            profiling.count('mongo_connections')
+            _store = arctic.Arctic(
+                conf.MONGO_HOST,
+                maxPoolSize=conf.MONGO_MAX_POOL_SIZE,
+                connectTimeoutMS=conf.MONGO_CONNECT_TIMEOUT_MS,
+                socketTimeoutMS=conf.MONGO_SOCKET_TIMEOUT_MS,
+                serverSelectionTimeoutMS=conf.MONGO_SERVER_SELECTION_TIMEOUT_MS
+            )
+            _store_pid = os.getpid()
+
+        return _store
 
 
 def get_library(lib_name):
@@ -28,11 +72,16 @@ def get_library(lib_name):
 
     store = get_store()
 
-    lib = None
-    if lib_name not in store.list_libraries():
-        logger.debug(f'can not find library: {lib_name}.')
-    else:
-        lib = store.get_library(lib_name)
+    with _lock:
+        lib = _libraries.get(lib_name)
+        if lib is not None:
+            return lib
+
+        profiling.count('mongo_calls', 2)
+        if lib_name not in store.list_libraries():
+            logger.debug(f'can not find library: {lib_name}.')
+        else:
+            lib = _libraries[lib_name] = store.get_library(lib_name)
 
     return lib
 
@@ -45,16 +94,21 @@ def create_library(lib_name):
     """
 
     store = get_store()
-    if lib_name not in store.list_libraries():
-        logger.info(f'initialize library: {lib_name}')
-        try:
-            store.initialize_library(lib_name)
-        except Exception as e:
-            logger.error(f'initialize library failed: {e}', exc_info=True)
-    else:
-        logger.debug(f'library: {lib_name} exist, skip.')
 
-    return store.get_library(lib_name)
+    with _lock:
+        profiling.count('mongo_calls', 3)
+        if lib_name not in store.list_libraries():
+            logger.info(f'initialize library: {lib_name}')
+            try:
+                store.initialize_library(lib_name)
+            except Exception as e:
+                logger.error(f'initialize library failed: {e}', exc_info=True)
+        else:
+            logger.debug(f'library: {lib_name} exist, skip.')
+
+        lib = _libraries[lib_name] = store.get_library(lib_name)
+
+    return lib
 
 
 def get_or_create_library(lib_name):
@@ -79,6 +133,10 @@ def drop_library(lib_name):
     """
 
     store = get_store()
+
+    with _lock:
+        _libraries.pop(lib_name, None)
+
     if lib_name in store.list_libraries():
         logger.info(f'drop library: {lib_name}')
         store.delete_library(lib_name)
@@ -93,37 +151,177 @@ def get_bd_stocks():
     """
 
     lib = get_library(conf.BD_STOCK_LIBNAME)
+    profiling.count('mongo_calls')
     return lib.list_symbols()
 
 
-def save_training_params(symbol, params):
+def _get_params_stock_id(params):
+    if isinstance(params, dict):
+        # params of the vectorized training, e.g.: {"fast_period": 1, "slow_period": 2, "stock_id": "ACI"}
+        return params['stock_id']
+    return params.ma_periods['stock_id']
+
+
+def _params_frame(params_list):
+    stock_ids = [_get_params_stock_id(params) for params in params_list]
+    return pd.DataFrame({'params': list(params_list)}, columns=['params'], index=stock_ids)
+
+
+def upsert_training_params(symbol, params_list):
     """
-    save training params to library.
+    save the training params of many stocks to library in one write,
+    the params of the other stocks in the symbol are kept.
+    the read and the write are not atomic: the symbol must have one writer at a time,
+    e.g. the process running the training, not each of its workers.
     :param symbol: str, arctic symbol
-    :param params: dict, e.g.: {"ma_period_s": 1, "ma_period_l": 2, "stock_id": "600909"}
+    :param params_list: list of params, see `save_training_params`
     :return: None
     """
 
-    stock_id = params.ma_periods['stock_id']
-    params_to_save = dict(params=params)
-    df = pd.DataFrame([params_to_save], columns=params_to_save.keys(), index=[stock_id])
+    if not params_list:
+        return
+
+    df = _params_frame(params_list)
+    # the last params of a stock win
+    df = df[~df.index.duplicated(keep='last')]
 
     # write to database
     # if library does not exist, create it
     lib = get_or_create_library(conf.STRATEGY_PARAMS_LIBNAME)
 
-    if lib.has_symbol(symbol):
-        logger.debug(
-            f'symbol: {symbol} already exists, '
-            f'change the params of stock {stock_id}, '
-            f'then delete and write symbol: {symbol}.'
-        )
-        params_df = lib.read(symbol).data
-        params_df.loc[stock_id, 'params'] = params
-        lib.delete(symbol)
-        lib.write(symbol, params_df)
-    else:
-        logger.debug(
-            f'write the params of stock {stock_id} to symbol: {symbol}'
-        )
+    with profiling.timer('models.write_params'):
+        profiling.count('mongo_calls', 2)
+        if lib.has_symbol(symbol):
+            logger.debug(f'change the params of {len(df)} stocks in symbol: {symbol}.')
+            profiling.count('mongo_calls')
+            params_df = lib.read(symbol).data
+            df = pd.concat([params_df[~params_df.index.isin(df.index)], df])
+        else:
+            logger.debug(f'write the params of {len(df)} stocks to symbol: {symbol}')
+
         lib.write(symbol, df)
+
+
+def save_training_params(symbol, params):
+    """
+    save training params to library.
+    :param symbol: str, arctic symbol
+    :param params: dict, e.g.: {"ma_period_s": 1, "ma_period_l": 2, "stock_id": "600909"}
+    :return: None
+    """
+
+    upsert_training_params(symbol, [params])
+
+
+def get_training_params(symbol, stock_ids=None):
+    """
+    get the training params of many stocks in one read, the staged params not merged yet win.
+    :param symbol: str, arctic symbol of the params
+    :param stock_ids: list of stock ids, None is every stock of the symbol
+    :return: dict, stock id -> params
+    """
+
+    lib = get_or_create_library(conf.STRATEGY_PARAMS_LIBNAME)
+    params = {}
+    with profiling.timer('models.read_params'):
+        profiling.count('mongo_calls', 2)
+        if lib.has_symbol(symbol):
+            profiling.count('mongo_calls')
+            params.update(lib.read(symbol).data['params'].to_dict())
+
+        prefix = get_staged_symbol(symbol, '')
+        staged = [s for s in lib.list_symbols() if s.startswith(prefix)]
+        if stock_ids is not None:
+            wanted = set(stock_ids)
+            staged = [s for s in staged if s[len(prefix):] in wanted]
+        profiling.count('mongo_calls', len(staged))
+        for s in staged:
+            params.update(lib.read(s).data['params'].to_dict())
+
+    if stock_ids is not None:
+        params = {stock_id: params[stock_id] for stock_id in stock_ids if stock_id in params}
+
+    return params
+
+
+def get_staged_symbol(symbol, stock_id):
+    """
+    symbol of the params of one stock saved by a concurrent `ParamsWriter`.
+    :param symbol: str, arctic symbol of the params
+    :param stock_id: str, stock id
+    :return: str
+    """
+
+    return f'{symbol}.staged.{stock_id}'
+
+
+class ParamsWriter(object):
+    """
+    Collect the training params of a run and save them together.
+    batch mode: the params are kept in memory and written in one write by `flush`.
+    concurrent mode: every stock is written at once to its own staged symbol, so parallel
+    trainers never race on the params symbol, `flush` merges the staged symbols in one write.
+    `flush` must run from one process at a time (see `upsert_training_params`), a staged symbol
+    written again while it is merged is kept for the next flush.
+    Use it as a context manager to flush on exit.
+    Attributes:
+        symbol(string): arctic symbol of the params, e.g. 'smac_trend'.
+        concurrent(bool): use the concurrent mode.
+    """
+
+    def __init__(self, symbol, concurrent=False):
+        self.symbol = symbol
+        self.concurrent = concurrent
+        self._params_list = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.flush()
+
+    def add(self, params):
+        """
+        add the params of one stock.
+        :param params: dict, see `save_training_params`
+        :return: None
+        """
+
+        if not self.concurrent:
+            self._params_list.append(params)
+            return
+
+        lib = get_or_create_library(conf.STRATEGY_PARAMS_LIBNAME)
+        stock_id = _get_params_stock_id(params)
+        profiling.count('mongo_calls')
+        with profiling.timer('models.write_params'):
+            lib.write(get_staged_symbol(self.symbol, stock_id), _params_frame([params]))
+
+    def flush(self):
+        """
+        write the collected params to the params symbol.
+        :return: None
+        """
+
+        if not self.concurrent:
+            params_list, self._params_list = self._params_list, []
+            upsert_training_params(self.symbol, params_list)
+            return
+
+        lib = get_or_create_library(conf.STRATEGY_PARAMS_LIBNAME)
+        prefix = get_staged_symbol(self.symbol, '')
+        profiling.count('mongo_calls')
+        staged = sorted(s for s in lib.list_symbols() if s.startswith(prefix))
+        if not staged:
+            return
+
+        profiling.count('mongo_calls', len(staged))
+        items = [lib.read(s) for s in staged]
+        upsert_training_params(self.symbol, [item.data['params'].iloc[0] for item in items])
+        profiling.count('mongo_calls', 2 * len(staged))
+        for s, item in zip(staged, items):
+            # a trainer wrote the stock again since it was read, merged by the next flush
+            if lib.read_metadata(s).version != item.version:
+                logger.debug(f'staged symbol {s} changed while merged, kept.')
+                continue
+            lib.delete(s)
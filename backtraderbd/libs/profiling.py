@@ -0,0 +1,394 @@
+# -*- coding: utf-8 -*-
+import atexit
+import contextlib
+import cProfile
+import datetime as dt
+import glob
+import json
+import os
+import sys
+import threading
+import time
+
+from backtraderbd.settings import settings as conf
+from backtraderbd.libs.log import get_logger
+
+try:
+    import resource
+except ImportError:
+    # not available on windows, the peak rss is not reported
+    resource = None
+
+logger = get_logger(__name__)
+
+__all__ = ['enable', 'disable', 'is_enabled', 'timer', 'timed', 'count', 'task',
+           'get_snapshot', 'merge_snapshots', 'write_report']
+
+# run directory inherited by the spawned pool workers
+RUN_DIR_ENV = 'BACKTRADERBD_PROFILING_RUN_DIR'
+PROFILER_ENV = 'BACKTRADERBD_PROFILING_PROFILER'
+
+# disabled, the default: `timer` and `task` return this shared no-op context manager
+_NULL = contextlib.nullcontext()
+
+_recorder = None
+_lock = threading.Lock()
+
+
+def get_peak_rss_mb():
+    """
+    :return: peak resident set size of this process in MB(float), None if unknown.
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, KB on linux
+    return peak / 2 ** 20 if sys.platform == 'darwin' else peak / 2 ** 10
+
+
+class Recorder(object):
+    """
+    Timers, counters and peak rss of one process. The pool workers started after `enable`
+    record into their own recorder, saved to the run directory after each task
+    and merged into the report of the run by `write_report`.
+    Attributes:
+        run_dir(string): directory of the run, the snapshots, profiles and report are written there.
+        profiler(string or callable): None, 'cprofile', or a callable(path) returning
+            a context manager profiling its block into files starting with `path`.
+        owner(bool): the process that enabled the profiling and writes the report.
+    """
+
+    def __init__(self, run_dir, profiler=None, owner=True):
+        self.run_dir = run_dir
+        self.profiler = profiler
+        self.owner = owner
+        self.pid = os.getpid()
+        self.started = dt.datetime.now()
+        self.timers = {}
+        self.counters = {}
+        self.peak_rss_mb = None
+        self.reported = False
+        self._tasks = 0
+        self._in_task = False
+        self._lock = threading.Lock()
+
+    def add_time(self, name, seconds):
+        with self._lock:
+            stat = self.timers.get(name)
+            if stat is None:
+                self.timers[name] = [1, seconds, seconds]
+            else:
+                stat[0] += 1
+                stat[1] += seconds
+                if seconds > stat[2]:
+                    stat[2] = seconds
+
+    def add_count(self, name, n):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def sample_rss(self):
+        peak = get_peak_rss_mb()
+        if peak is not None and (self.peak_rss_mb is None or peak > self.peak_rss_mb):
+            self.peak_rss_mb = peak
+
+    def snapshot(self):
+        """
+        :return: dict(pid, started, timers, counters, peak_rss_mb), json serializable.
+        """
+        self.sample_rss()
+        with self._lock:
+            return dict(
+                pid=self.pid,
+                started=self.started.isoformat(),
+                timers={
+                    name: dict(calls=calls, seconds=seconds, max_seconds=max_seconds)
+                    for name, (calls, seconds, max_seconds) in sorted(self.timers.items())
+                },
+                counters=dict(sorted(self.counters.items())),
+                peak_rss_mb=self.peak_rss_mb,
+            )
+
+    def write_snapshot(self):
+        """
+        Save the snapshot of a worker process to the run directory.
+        :return: None
+        """
+        _write_json(os.path.join(self.run_dir, f'worker-{self.pid}.json'), self.snapshot())
+
+    def profile(self, name):
+        """
+        Profiler of one task, a no-op context manager if no profiler is set.
+        :param name(string): task name.
+        :return: context manager
+        """
+        if not self.profiler:
+            return _NULL
+
+        self._tasks += 1
+        path = os.path.join(self.run_dir, f'{name}-{self.pid}-{self._tasks}')
+        if callable(self.profiler):
+            return self.profiler(path)
+        if self.profiler == 'cprofile':
+            return _cprofile(f'{path}.prof')
+
+        logger.warning(f'unknown profiler: {self.profiler}, the task is not profiled.')
+        return _NULL
+
+
+class _Timer(object):
+    __slots__ = ('recorder', 'name', 'start')
+
+    def __init__(self, recorder, name):
+        self.recorder = recorder
+        self.name = name
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.recorder.add_time(self.name, time.perf_counter() - self.start)
+        self.recorder.sample_rss()
+
+
+@contextlib.contextmanager
+def _cprofile(path):
+    profile = cProfile.Profile()
+    profile.enable()
+    try:
+        yield profile
+    finally:
+        profile.disable()
+        try:
+            profile.dump_stats(path)
+        except OSError as e:
+            logger.warning(f'write profile {path} failed: {e}')
+
+
+def _write_json(path, data):
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    try:
+        with open(tmp_path, 'w') as f:
+            json.dump(data, f, indent=2, default=str)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        logger.warning(f'write {path} failed: {e}')
+
+
+def _get_recorder():
+    global _recorder
+
+    recorder = _recorder
+    if recorder is None or recorder.pid == os.getpid():
+        return recorder
+
+    with _lock:
+        if _recorder.pid != os.getpid():
+            # forked pool worker: its own counters, written next to the parent's
+            _recorder = Recorder(_recorder.run_dir, _recorder.profiler, owner=False)
+        return _recorder
+
+
+def enable(run_dir=None, profiler=None):
+    """
+    Start recording in this process and the pool workers started from now on,
+    the report is written at exit if `write_report` was not called.
+    :param run_dir(string): directory of the run, default a new directory in `PROFILING_DIR`.
+    :param profiler(string or callable): profiler of each task, default `PROFILING_PROFILER`,
+        see `Recorder`.
+    :return: run directory(string)
+    """
+    global _recorder
+
+    if run_dir is None:
+        run_dir = os.path.join(conf.PROFILING_DIR, f'{dt.datetime.now().strftime("%Y%m%d-%H%M%S")}-{os.getpid()}')
+    if profiler is None:
+        profiler = conf.PROFILING_PROFILER
+    os.makedirs(run_dir, exist_ok=True)
+
+    with _lock:
+        _recorder = Recorder(run_dir, profiler)
+    os.environ[RUN_DIR_ENV] = run_dir
+    if isinstance(profiler, str):
+        os.environ[PROFILER_ENV] = profiler
+    atexit.register(_write_report_at_exit, _recorder)
+    logger.debug(f'profiling enabled, run directory: {run_dir}')
+
+    return run_dir
+
+
+def disable():
+    """
+    Stop recording, the data not reported is dropped.
+    :return: None
+    """
+    global _recorder
+
+    with _lock:
+        _recorder = None
+    os.environ.pop(RUN_DIR_ENV, None)
+    os.environ.pop(PROFILER_ENV, None)
+
+
+def is_enabled():
+    return _recorder is not None
+
+
+def timer(name):
+    """
+    Time a block.
+    :param name(string): timer name, e.g. 'btask.cerebro_run'.
+    :return: context manager
+    """
+    recorder = _get_recorder()
+    if recorder is None:
+        return _NULL
+
+    return _Timer(recorder, name)
+
+
+def timed(name):
+    """
+    Decorator timing every call of the function.
+    :param name(string): timer name.
+    """
+    def decorator(func):
+        def wrapper(*args, **kwargs):
+            with timer(name):
+                return func(*args, **kwargs)
+
+        wrapper.__name__ = func.__name__
+        wrapper.__doc__ = func.__doc__
+        return wrapper
+
+    return decorator
+
+
+def count(name, n=1):
+    """
+    Increment a counter.
+    :param name(string): counter name, e.g. 'bars', 'backtests', 'mongo_calls'.
+    :param n(int): increment.
+    :return: None
+    """
+    if _recorder is None:
+        return
+
+    _get_recorder().add_count(name, n)
+
+
+@contextlib.contextmanager
+def _task(recorder, name):
+    recorder._in_task = True
+    try:
+        with recorder.profile(name), _Timer(recorder, f'task.{name}'):
+            yield
+    finally:
+        recorder._in_task = False
+        recorder.add_count(f'tasks.{name}', 1)
+        if not recorder.owner:
+            recorder.write_snapshot()
+
+
+def task(name):
+    """
+    One unit of work (a back test, a training chunk...): timed, profiled with the profiler
+    of the run, and the snapshot of a worker process is saved when it ends.
+    A task inside a task is only timed.
+    :param name(string): task name, e.g. 'run_back_testing'.
+    :return: context manager
+    """
+    recorder = _get_recorder()
+    if recorder is None:
+        return _NULL
+    if recorder._in_task:
+        return _Timer(recorder, f'task.{name}')
+
+    return _task(recorder, name)
+
+
+def get_snapshot():
+    """
+    :return: snapshot of this process, see `Recorder.snapshot`, None if disabled.
+    """
+    recorder = _get_recorder()
+    return recorder.snapshot() if recorder is not None else None
+
+
+def merge_snapshots(snapshots):
+    """
+    Aggregate the snapshots of several processes: the timers and counters are summed,
+    the peak rss is the max and the sum of the processes.
+    :param snapshots(list): snapshots, see `Recorder.snapshot`.
+    :return: dict(processes, timers, counters, peak_rss_mb, total_peak_rss_mb)
+    """
+    timers, counters, peaks = {}, {}, []
+    for snapshot in snapshots:
+        for name, stat in snapshot['timers'].items():
+            merged = timers.setdefault(name, dict(calls=0, seconds=0.0, max_seconds=0.0))
+            merged['calls'] += stat['calls']
+            merged['seconds'] += stat['seconds']
+            merged['max_seconds'] = max(merged['max_seconds'], stat['max_seconds'])
+        for name, n in snapshot['counters'].items():
+            counters[name] = counters.get(name, 0) + n
+        if snapshot.get('peak_rss_mb') is not None:
+            peaks.append(snapshot['peak_rss_mb'])
+
+    return dict(
+        processes=len(snapshots),
+        timers=dict(sorted(timers.items())),
+        counters=dict(sorted(counters.items())),
+        peak_rss_mb=max(peaks, default=None),
+        total_peak_rss_mb=sum(peaks) if peaks else None,
+    )
+
+
+def write_report(path=None):
+    """
+    Merge this process and the snapshots of its workers into the report of the run.
+    :param path(string): report file, default `report.json` in the run directory.
+    :return: report(dict), None if disabled.
+    """
+    recorder = _get_recorder()
+    if recorder is None:
+        return None
+
+    snapshots = [recorder.snapshot()]
+    for worker_path in sorted(glob.glob(os.path.join(recorder.run_dir, 'worker-*.json'))):
+        try:
+            with open(worker_path) as f:
+                snapshot = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.warning(f'read {worker_path} failed: {e}')
+            continue
+        if snapshot['pid'] != recorder.pid:
+            snapshots.append(snapshot)
+
+    report = dict(
+        run_dir=recorder.run_dir,
+        started=recorder.started.isoformat(),
+        finished=dt.datetime.now().isoformat(),
+        argv=sys.argv,
+        **merge_snapshots(snapshots),
+        per_process=snapshots,
+    )
+    path = path or os.path.join(recorder.run_dir, 'report.json')
+    _write_json(path, report)
+    recorder.reported = True
+    logger.debug(f'profiling report written to {path}')
+
+    return report
+
+
+def _write_report_at_exit(recorder):
+    if recorder is _recorder and recorder.pid == os.getpid() and not recorder.reported:
+        write_report()
+
+
+if os.environ.get(RUN_DIR_ENV) and _recorder is None:
+    # spawned pool worker of a profiled run
+    _recorder = Recorder(os.environ[RUN_DIR_ENV], os.environ.get(PROFILER_ENV), owner=False)
+elif conf.PROFILING_ENABLED:
+    enable()
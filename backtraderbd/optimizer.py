@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+import os
+import json
+import heapq
+import itertools
+
+import numpy as np
+import pandas as pd
+
+from backtraderbd.btask import Btask
+from backtraderbd.settings import settings as conf
+from backtraderbd.libs.log import get_logger
+
+logger = get_logger(__name__)
+
+# analysis columns of a back test result
+RESULT_COLUMNS = ['total_return_rate', 'max_drawdown', 'max_drawdown_period']
+
+
+class TopK(object):
+    """
+    Bounded heap keeping the k best back test results: the largest total return rate,
+    then the smallest max drawdown, then the first pushed.
+    Attributes:
+        k(int): number of results kept.
+    """
+
+    def __init__(self, k):
+        self.k = k
+        self.count = 0
+        self._heap = []
+
+    def __len__(self):
+        return len(self._heap)
+
+    def push(self, al_result):
+        """
+        :param al_result(dict): params and analysis data of one back test.
+        :return: None
+        """
+        total_return_rate = al_result['total_return_rate']
+        max_drawdown = al_result['max_drawdown']
+        key = (
+            total_return_rate if total_return_rate == total_return_rate else -np.inf,
+            -max_drawdown if max_drawdown == max_drawdown else -np.inf,
+            -self.count
+        )
+        self.count += 1
+
+        if len(self._heap) < self.k:
+            heapq.heappush(self._heap, (key, al_result))
+        elif key > self._heap[0][0]:
+            heapq.heapreplace(self._heap, (key, al_result))
+
+    def results(self):
+        """
+        :return: the kept results, best first(list of dict)
+        """
+        return [al_result for _, al_result in sorted(self._heap, key=lambda item: item[0], reverse=True)]
+
+
+class ResultSpill(object):
+    """
+    Columnar on-disk store of all the back test results of a run, rows are buffered
+    and appended in blocks, so memory does not grow with the grid:
+        <path>/<column>.f8      float64 values of each analysis column
+        <path>/params.jsonl     params of each row
+    Attributes:
+        path(string): directory of the spill.
+        buffer_size(int): rows kept in memory before they are appended.
+    """
+
+    def __init__(self, path, buffer_size=4096):
+        self.path = path
+        self.buffer_size = buffer_size
+        self._rows = []
+        os.makedirs(path, exist_ok=True)
+        for name in RESULT_COLUMNS + ['params']:
+            open(self._file(name), 'w').close()
+
+    def _file(self, name):
+        return os.path.join(self.path, f'{name}.jsonl' if name == 'params' else f'{name}.f8')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.flush()
+
+    def append(self, al_result):
+        """
+        :param al_result(dict): params and analysis data of one back test.
+        :return: None
+        """
+        self._rows.append(al_result)
+        if len(self._rows) >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        rows, self._rows = self._rows, []
+        if not rows:
+            return
+
+        for name in RESULT_COLUMNS:
+            with open(self._file(name), 'ab') as f:
+                np.array([row[name] for row in rows], dtype=np.float64).tofile(f)
+        with open(self._file('params'), 'a') as f:
+            f.writelines(json.dumps(row['params'], default=str) + '\n' for row in rows)
+
+    @classmethod
+    def load(cls, path, columns=None):
+        """
+        Load a spill, the analysis columns are memory mapped.
+        :param path(string): directory of the spill.
+        :param columns(list): columns to load, default all, 'params' included.
+        :return: results(DataFrame)
+        """
+        columns = columns or RESULT_COLUMNS + ['params']
+        data = {}
+        for name in columns:
+            if name == 'params':
+                with open(os.path.join(path, 'params.jsonl')) as f:
+                    data[name] = [json.loads(line) for line in f]
+            else:
+                data[name] = np.memmap(os.path.join(path, f'{name}.f8'), dtype=np.float64, mode='r')
+
+        return pd.DataFrame(data, columns=columns)
+
+
+class OptimizationRunner(object):
+    """
+    Memory bounded optimization of one strategy: the param sets are consumed lazily in chunks,
+    back tested with the vectorized engine or with cerebro in optimization mode
+    (lightweight `optreturn` results), and streamed into a top-k heap and optionally a spill.
+    Attributes:
+        Strategy(class): strategy to optimize, e.g. SMACStrategy.
+        k(int): best results kept, default `OPTIMIZATION_TOP_K`.
+        engine(string): 'vectorized' or 'cerebro', default `OPTIMIZATION_ENGINE`.
+        chunk_size(int): param sets back tested together, default `VECTORIZED_CHUNK_SIZE`.
+        spill_path(string): directory to spill all the results to, None keeps only the top k.
+    """
+
+    def __init__(self, Strategy, k=None, engine=None, chunk_size=None, spill_path=None):
+        self.Strategy = Strategy
+        self.k = k or conf.OPTIMIZATION_TOP_K
+        self.engine = engine or conf.OPTIMIZATION_ENGINE
+        self.chunk_size = chunk_size or conf.VECTORIZED_CHUNK_SIZE
+        self.spill_path = spill_path
+
+    def evaluate(self, training_data, params_list):
+        """
+        Back test one chunk of param sets.
+        :param training_data(DataFrame): data used to train the strategy.
+        :param params_list(list): dicts of strategy params.
+        :return: list(dict(params, total_return_rate, max_drawdown, max_drawdown_period))
+        """
+        if self.engine == 'cerebro':
+            return Btask.evaluate_params_cerebro(self.Strategy, training_data, params_list)
+        if self.engine == 'vectorized':
+            return Btask.evaluate_params_vectorized(self.Strategy, training_data, params_list)
+
+        raise ValueError(f'unknown optimization engine: {self.engine}')
+
+    def run(self, training_data, params_iter):
+        """
+        Back test all the param sets.
+        :param training_data(DataFrame): data used to train the strategy.
+        :param params_iter(iterable): dicts of strategy params, e.g. a generator.
+        :return: the k best results, best first(list of dict)
+        """
+        top = TopK(self.k)
+        spill = ResultSpill(self.spill_path) if self.spill_path else None
+
+        params_iter = iter(params_iter)
+        while True:
+            chunk = list(itertools.islice(params_iter, self.chunk_size))
+            if not chunk:
+                break
+            for al_result in self.evaluate(training_data, chunk):
+                top.push(al_result)
+                if spill is not None:
+                    spill.append(al_result)
+
+        if spill is not None:
+            spill.flush()
+
+        logger.debug(f'{top.count} param sets of {self.Strategy.__name__} back tested.')
+        return top.results()
+
+    def optimize(self, training_data, stock_id, params_iter=None):
+        """
+        Find the best params of the strategy for one stock.
+        :param training_data(DataFrame): data used to train the strategy.
+        :param stock_id(string): stock on which the strategy works.
+        :param params_iter(iterable): dicts of strategy params, default is `get_strategy_params_list`.
+        :return: params(dict like {fast_period: 1, slow_period: 2, stock_id: '0'})
+        """
+        if params_iter is None:
+            params_iter = Btask.get_strategy_params_list(training_data, stock_id)
+
+        results = self.run(training_data, params_iter)
+        if not results:
+            raise ValueError(f'no params to optimize for stock {stock_id}')
+
+        params = dict(results[0]['params'], stock_id=stock_id)
+        logger.debug(f'Stock {stock_id} best params is {params}')
+
+        return params
@@ -0,0 +1,386 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+import pandas as pd
+
+import backtraderbd.data.utils as bdu
+from backtraderbd.btask import Btask
+from backtraderbd.signals import get_strategy_params
+from backtraderbd.strategies.indicators import IndicatorCache
+from backtraderbd.strategies.vectorized import COMMISSION_ALLOWANCE
+from backtraderbd.settings import settings as conf
+from backtraderbd.libs import profiling
+from backtraderbd.libs.log import get_logger
+
+logger = get_logger(__name__)
+
+
+class PortfolioState(object):
+    """
+    State of a portfolio simulation on its last bar, resumes it on the next date window.
+    Attributes:
+        cash(float): broker cash.
+        position(ndarray): size held of each stock.
+        pprice(ndarray): average price of each position.
+        last_close(ndarray): last known close of each stock, values the halted stocks.
+        pending_buy(ndarray): buy size of the orders created on the last bar.
+        pending_sell(ndarray): sell size of the orders created on the last bar.
+        value(float): portfolio value.
+        peak(float): highest value so far.
+        max_drawdown(float): max draw down so far, in percent.
+        max_drawdown_period(int): longest draw down so far, in bars.
+        streak(int): bars of the draw down running on the last bar.
+        init_cash(float): starting cash.
+        stats(dict): buys, sells, rejected orders and commission so far.
+    """
+
+    def __init__(self, cash, position, pprice, last_close, pending_buy, pending_sell, value, peak,
+                 max_drawdown, max_drawdown_period, streak, init_cash, stats):
+        self.cash = cash
+        self.position = position
+        self.pprice = pprice
+        self.last_close = last_close
+        self.pending_buy = pending_buy
+        self.pending_sell = pending_sell
+        self.value = value
+        self.peak = peak
+        self.max_drawdown = max_drawdown
+        self.max_drawdown_period = max_drawdown_period
+        self.streak = streak
+        self.init_cash = init_cash
+        self.stats = stats
+
+    @classmethod
+    def start(cls, cash, n_stocks):
+        """
+        :param cash(float): starting cash.
+        :param n_stocks(int): stocks of the portfolio.
+        :return: PortfolioState before the first bar
+        """
+        return cls(
+            cash=float(cash),
+            position=np.zeros(n_stocks, dtype=np.int64),
+            pprice=np.zeros(n_stocks),
+            last_close=np.full(n_stocks, np.nan),
+            pending_buy=np.zeros(n_stocks, dtype=np.int64),
+            pending_sell=np.zeros(n_stocks, dtype=np.int64),
+            value=float(cash),
+            peak=float(cash),
+            max_drawdown=0.0,
+            max_drawdown_period=0,
+            streak=0,
+            init_cash=float(cash),
+            stats=dict(buys=0, sells=0, rejected=0, commission=0.0),
+        )
+
+    def get_analysis(self):
+        """
+        :return: dict(total_return_rate, max_drawdown, max_drawdown_period, final_value,
+            positions, buys, sells, rejected, commission)
+        """
+        return dict(
+            total_return_rate=self.value / self.init_cash - 1.0,
+            max_drawdown=self.max_drawdown,
+            max_drawdown_period=self.max_drawdown_period,
+            final_value=self.value,
+            positions=int((self.position > 0).sum()),
+            **self.stats
+        )
+
+
+class PortfolioBacktest(object):
+    """
+    Back test of one portfolio sharing its cash across many stocks, the stocks are the
+    columns of aligned (bars, stocks) arrays: the bars are walked one by one (the cash is
+    path dependent), all the stocks of a bar are handled by the same array operations.
+    The orders follow `BaseStrategy.next`, with a shared cash:
+        - an order created on a bar is executed on the next one, the buys at the open,
+          the sells at the close ('close' execution type) or at the open.
+        - a stock is bought on a buy signal if the cash covers one share at the close,
+          the cash is split evenly between the stocks bought on the same bar, sized at the close
+          with the commission allowance of `BaseStrategy` and `buy_prop`.
+        - a held stock is sold on a sell signal, `sell_prop` of its position, never short.
+        - a buy costing more than the cash when it is executed is rejected (order margin),
+          an order on a stock without price on the next bar (halted) is canceled.
+    With the 'close' execution type a one stock portfolio gives the results of `VectorizedBacktest`,
+    with 'open' it differs on purpose: `BaseStrategy` sizes on the next open (look ahead)
+    and may sell more than it holds.
+    Attributes:
+        cash(float): starting cash of the broker.
+        commission(float): broker commission, default `COMMISSION_PER_TRANSACTION`.
+        buy_prop(float): same as `BUY_PROP`.
+        sell_prop(float): same as `SELL_PROP`.
+        execution_type(string): same as `EXECUTION_TYPE`, 'close' or 'open'.
+        max_positions(int): most stocks held at once, default `PORTFOLIO_MAX_POSITIONS`, None is no limit.
+    """
+
+    def __init__(self, cash=None, commission=None, buy_prop=None, sell_prop=None,
+                 execution_type=None, max_positions=None):
+        self.cash = conf.DEFAULT_CASH if cash is None else cash
+        self.commission = conf.COMMISSION_PER_TRANSACTION if commission is None else commission
+        self.buy_prop = conf.BUY_PROP if buy_prop is None else buy_prop
+        self.sell_prop = conf.SELL_PROP if sell_prop is None else sell_prop
+        self.execution_type = conf.EXECUTION_TYPE if execution_type is None else execution_type
+        self.max_positions = conf.PORTFOLIO_MAX_POSITIONS if max_positions is None else max_positions
+
+    def run(self, close, open, buy_signal, sell_signal, state=None):
+        """
+        Simulate one date window.
+        :param close(array): close prices, shape (bars, stocks), nan when a stock has no bar.
+        :param open(array): open prices, same shape.
+        :param buy_signal(array): bool, same shape.
+        :param sell_signal(array): bool, same shape.
+        :param state(PortfolioState): state on the last bar of the previous window, None starts the portfolio.
+        :return: value and cash on each bar(tuple of ndarray) and the state on the last bar(PortfolioState)
+        """
+        close = np.asarray(close, dtype=np.float64)
+        open_ = np.asarray(open, dtype=np.float64)
+        buy_signal = np.asarray(buy_signal, dtype=bool)
+        sell_signal = np.asarray(sell_signal, dtype=bool)
+        n_bars, n_stocks = close.shape
+        if state is None:
+            state = PortfolioState.start(self.cash, n_stocks)
+
+        cash = state.cash
+        position, pprice = state.position.copy(), state.pprice.copy()
+        pending_buy, pending_sell = state.pending_buy.copy(), state.pending_sell.copy()
+        stats = dict(state.stats)
+
+        # the halted stocks are valued at their last close
+        valuation = self._fill_forward(close, state.last_close)
+        out_value = np.empty(n_bars)
+        out_cash = np.empty(n_bars)
+        sell_at_close = self.execution_type == 'close'
+        sizing = close * (1 + self.commission + COMMISSION_ALLOWANCE)
+
+        for t in range(n_bars):
+            if pending_buy.any() or pending_sell.any():
+                sell_price = close[t] if sell_at_close else open_[t]
+                if not sell_at_close:
+                    # the market sells are filled at the open, before the buys
+                    cash = self._sell(cash, position, pprice, pending_sell, sell_price, stats)
+                cash = self._buy(cash, position, pprice, pending_buy, open_[t], stats)
+                if sell_at_close:
+                    cash = self._sell(cash, position, pprice, pending_sell, sell_price, stats)
+                pending_buy[:] = 0
+                pending_sell[:] = 0
+
+            out_cash[t] = cash
+            out_value[t] = cash + (position * np.where(position > 0, valuation[t], 0.0)).sum()
+
+            traded = ~np.isnan(close[t])
+            # Only sell what is held, never short
+            can_sell = traded & sell_signal[t] & (position > 0)
+            if can_sell.any():
+                pending_sell = np.where(can_sell, self._trunc(position * self.sell_prop), 0)
+
+            # Only buy if there is enough cash for at least one stock
+            can_buy = traded & buy_signal[t] & ~can_sell & (cash >= np.where(traded, close[t], np.inf))
+            if can_buy.any():
+                can_buy = self._limit_positions(can_buy, position, pending_sell)
+                budget = cash / max(int(can_buy.sum()), 1)
+                with np.errstate(invalid='ignore'):
+                    afforded_size = self._trunc(np.where(can_buy, budget / sizing[t], 0.0))
+                buy_prop_size = self._trunc(afforded_size * self.buy_prop)
+                pending_buy = np.where(can_buy, np.minimum(buy_prop_size, afforded_size), 0)
+
+        # draw down statistics of `TimeDrawDown` carried over the windows
+        peak = np.maximum(np.maximum.accumulate(out_value), state.peak)
+        drawdown = 100.0 * (peak - out_value) / peak
+        in_drawdown = peak > out_value
+        idx = np.arange(n_bars)
+        last_reset = np.maximum.accumulate(np.where(in_drawdown, -1 - state.streak, idx))
+        streak = np.where(in_drawdown, idx - last_reset, 0)
+
+        new_state = PortfolioState(
+            cash=cash,
+            position=position,
+            pprice=pprice,
+            last_close=valuation[-1].copy() if n_bars else state.last_close,
+            pending_buy=pending_buy,
+            pending_sell=pending_sell,
+            value=float(out_value[-1]) if n_bars else state.value,
+            peak=float(peak[-1]) if n_bars else state.peak,
+            max_drawdown=max(float(drawdown.max(initial=0.0)), state.max_drawdown),
+            max_drawdown_period=max(int(streak.max(initial=0)), state.max_drawdown_period),
+            streak=int(streak[-1]) if n_bars else state.streak,
+            init_cash=state.init_cash,
+            stats=stats,
+        )
+
+        return out_value, out_cash, new_state
+
+    @classmethod
+    def _trunc(cls, x):
+        return np.trunc(x).astype(np.int64)
+
+    @classmethod
+    def _fill_forward(cls, close, last_close):
+        filled = np.vstack([last_close[None], close])
+        idx = np.where(np.isnan(filled), 0, np.arange(len(filled))[:, None])
+        np.maximum.accumulate(idx, axis=0, out=idx)
+        return np.take_along_axis(filled, idx, axis=0)[1:]
+
+    def _limit_positions(self, can_buy, position, pending_sell):
+        if self.max_positions is None:
+            return can_buy
+        held = int(((position > 0) & (position > pending_sell)).sum())
+        slots = max(self.max_positions - held, 0)
+        # new stocks in the column order, the stocks already held may be bought again
+        new = can_buy & (position == 0)
+        keep = new & (np.cumsum(new) <= slots)
+        return (can_buy & (position > 0)) | keep
+
+    def _sell(self, cash, position, pprice, size, price, stats):
+        sold = (size > 0) & ~np.isnan(price)
+        if not sold.any():
+            return cash
+        size = np.where(sold, np.minimum(size, position), 0)
+        proceeds = size * np.where(sold, price, 0.0)
+        comm = np.abs(proceeds) * self.commission
+        position -= size
+        pprice[position == 0] = 0.0
+        stats['sells'] += int(sold.sum())
+        stats['commission'] += float(comm.sum())
+        return cash + float(proceeds.sum() - comm.sum())
+
+    def _buy(self, cash, position, pprice, size, price, stats):
+        # checked one by one against the cash, in the order the orders were created
+        for i in np.flatnonzero(size > 0):
+            if np.isnan(price[i]):
+                continue
+            cost = size[i] * price[i]
+            comm = cost * self.commission
+            if cost + comm > cash:
+                stats['rejected'] += 1
+                continue
+            pprice[i] = (pprice[i] * position[i] + cost) / (position[i] + size[i])
+            position[i] += size[i]
+            cash -= cost + comm
+            stats['buys'] += 1
+            stats['commission'] += float(comm)
+        return cash
+
+
+class Portfolio(object):
+    """
+    Portfolio back test of one strategy over many stocks, e.g. the whole DSE universe,
+    simulated in (dates, stocks) arrays instead of one cerebro feed per stock.
+    Every stock is loaded once and kept as its own arrays (no padding, prices as float32 when
+    they are widened back exactly, see `Utils.compact`), the dense panels aligned on the union
+    of the dates are only built for one date window of `window` bars at a time.
+    The signals of each stock are the ones of `Strategy.get_signals` on its own bars
+    with its training params.
+    Attributes:
+        Strategy(class): strategy, e.g. SMACStrategy.
+        engine(PortfolioBacktest): broker and sizing, default `PortfolioBacktest()`.
+        window(int): bars of one date window, default `PORTFOLIO_WINDOW`.
+    """
+
+    def __init__(self, Strategy, engine=None, window=None):
+        self.Strategy = Strategy
+        self.engine = engine or PortfolioBacktest()
+        self.window = window or conf.PORTFOLIO_WINDOW
+
+    def load(self, stock_ids, data=None, params=None):
+        """
+        Load the stocks one by one.
+        :param stock_ids(list): stock ids.
+        :param data(dict): stock_id -> time serials, default `Btask.get_data`.
+        :param params(dict): stock_id -> strategy params, default the training params.
+        :return: dict(stock_ids, dates, stocks), the dates are the union of the dates of the stocks,
+            stocks: one dict(rows, prices, buy_signal, sell_signal) per stock, `rows` the positions
+            of its bars in the dates and `prices` its close and open, shape (bars, 2).
+        """
+        if params is None:
+            params = get_strategy_params(self.Strategy, stock_ids)
+
+        loaded, stocks, indexes = [], [], []
+        for stock_id in stock_ids:
+            try:
+                stock_data = data[stock_id] if data is not None else Btask.get_data(stock_id)
+                stock_data = bdu.Utils.to_numeric(stock_data)
+                if not len(stock_data):
+                    continue
+                buy_signal, sell_signal = self.Strategy.get_signals(
+                    IndicatorCache(stock_data), [params.get(stock_id, {})])
+            except Exception as e:
+                logger.error(f'load stock {stock_id} failed: {e}', exc_info=True)
+                continue
+
+            prices = stock_data[['close', 'open']]
+            dtypes = bdu.Utils.get_compact_dtypes(prices)
+            compact = dtypes['close'] == np.float32 and dtypes['open'] == np.float32
+            loaded.append(stock_id)
+            indexes.append(np.asarray(stock_data.index.values, dtype='datetime64[ns]'))
+            stocks.append(dict(
+                prices=prices.to_numpy(dtype=np.float32 if compact else np.float64),
+                buy_signal=buy_signal[:, 0], sell_signal=sell_signal[:, 0]
+            ))
+
+        dates = np.unique(np.concatenate(indexes)) if indexes else np.array([], dtype='datetime64[ns]')
+        for stock, index in zip(stocks, indexes):
+            stock['rows'] = np.searchsorted(dates, index)
+
+        logger.debug(f'{len(loaded)} stocks loaded, {len(dates)} dates.')
+
+        return dict(stock_ids=loaded, dates=pd.DatetimeIndex(dates), stocks=stocks)
+
+    @classmethod
+    def get_window(cls, panel, start, end):
+        """
+        Aligned panels of the dates [start, end).
+        :param panel(dict): see `load`.
+        :param start(int): first date.
+        :param end(int): date after the last one.
+        :return: close, open(float64, nan when a stock has no bar), buy_signal, sell_signal(bool),
+            shaped (end - start, stocks)
+        """
+        shape = (end - start, len(panel['stocks']))
+        close, open_ = np.full(shape, np.nan), np.full(shape, np.nan)
+        buy, sell = np.zeros(shape, dtype=bool), np.zeros(shape, dtype=bool)
+        for j, stock in enumerate(panel['stocks']):
+            lo, hi = np.searchsorted(stock['rows'], [start, end])
+            if lo == hi:
+                continue
+            rows = stock['rows'][lo:hi] - start
+            prices = stock['prices'][lo:hi]
+            if prices.dtype == np.float32:
+                prices = bdu.Utils.widen_values(prices)
+            close[rows, j], open_[rows, j] = prices[:, 0], prices[:, 1]
+            buy[rows, j], sell[rows, j] = stock['buy_signal'][lo:hi], stock['sell_signal'][lo:hi]
+
+        return close, open_, buy, sell
+
+    def run(self, stock_ids, data=None, params=None):
+        """
+        Back test the portfolio over the whole history of the stocks.
+        :param stock_ids(list): stock ids.
+        :param data(dict): stock_id -> time serials, default `Btask.get_data`.
+        :param params(dict): stock_id -> strategy params, default the training params.
+        :return: dict(analysis, value(Series), cash(Series), positions(Series), state(PortfolioState))
+        """
+        with profiling.task('portfolio'):
+            panel = self.load(stock_ids, data, params)
+            n_bars = len(panel['dates'])
+            value, cash = np.empty(n_bars), np.empty(n_bars)
+            state = None
+            for start in range(0, n_bars, self.window):
+                end = min(start + self.window, n_bars)
+                with profiling.timer('portfolio.window'):
+                    value[start:end], cash[start:end], state = self.engine.run(
+                        *self.get_window(panel, start, end), state=state)
+            profiling.count('backtests')
+            profiling.count('bars', sum(len(stock['rows']) for stock in panel['stocks']))
+
+        if state is None:
+            state = PortfolioState.start(self.engine.cash, len(panel['stock_ids']))
+        logger.debug(f'portfolio of {self.Strategy.__name__} on {len(panel["stock_ids"])} stocks, '
+                     f'{n_bars} dates: {state.get_analysis()}')
+
+        return dict(
+            analysis=state.get_analysis(),
+            value=pd.Series(value, index=panel['dates'], name='value'),
+            cash=pd.Series(cash, index=panel['dates'], name='cash'),
+            positions=pd.Series(state.position, index=panel['stock_ids'], name='position'),
+            state=state,
+        )
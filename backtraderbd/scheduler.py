@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+import os
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+from backtraderbd.btask import Btask
+from backtraderbd.data.shared import SharedDataStore, SharedOHLCV
+from backtraderbd.settings import settings as conf
+from backtraderbd.libs import profiling
+from backtraderbd.libs.log import get_logger
+
+logger = get_logger(__name__)
+
+
+def train_chunk(Strategy, stock_id, data, params_list):
+    """
+    Work unit of the scheduler, back test one chunk of param sets of one stock.
+    :param Strategy(class): strategy to train.
+    :param stock_id(string): stock id.
+    :param data(DataFrame or SharedOHLCV): training data of the stock or its shared memory handle.
+    :param params_list(list): dicts of strategy params.
+    :return: analysis data of the chunk(list)
+    """
+    with profiling.task('train_chunk'):
+        if isinstance(data, SharedOHLCV):
+            data = data.attach()
+
+        return Btask.evaluate_params_vectorized(Strategy, data, params_list)
+
+
+class TrainingScheduler(object):
+    """
+    Train one strategy over many stocks, (stock x param chunk) work units are spread
+    over a process pool, so a long series is trained by several workers at once.
+    A stock is reduced to its best params as soon as all its chunks are back.
+    Attributes:
+        Strategy(class): strategy to train, e.g. SMACStrategy.
+        workers(int): number of processes, default `TRAINING_WORKERS` or one per cpu.
+        chunk_size(int): param sets in one work unit, default `TRAINING_CHUNK_SIZE`.
+        on_result(callable): called in the parent with (stock_id, params) for every trained stock.
+    """
+
+    def __init__(self, Strategy, workers=None, chunk_size=None, on_result=None):
+        self.Strategy = Strategy
+        self.workers = workers or conf.TRAINING_WORKERS or os.cpu_count() or 1
+        self.chunk_size = chunk_size or conf.TRAINING_CHUNK_SIZE
+        self.on_result = on_result
+        self._remaining = {}
+        self._al_results = {}
+        self._store = None
+
+    def get_params_list(self, data, stock_id):
+        """
+        Get the param sets to try for one stock.
+        :param data(DataFrame): training data of the stock.
+        :param stock_id(string): stock id.
+        :return: list(dict)
+        """
+        return Btask.get_strategy_params_list(data, stock_id)
+
+    def get_work_units(self, stock_ids):
+        """
+        Load the stocks one by one and split their param sets into chunks.
+        :param stock_ids(list): stock ids.
+        :return: generator of (chunk index, (Strategy, stock_id, shared data handle, params_list))
+        """
+        for stock_id in stock_ids:
+            try:
+                data = Btask.get_data(stock_id)
+            except Exception as e:
+                logger.error(f'load data of stock {stock_id} failed: {e}', exc_info=True)
+                continue
+
+            params_list = self.get_params_list(data, stock_id)
+            if not params_list:
+                logger.warning(f'no params to train for stock {stock_id}, skip.')
+                continue
+
+            # the chunks of the stock share one copy of the data
+            handle = self._store.put(stock_id, data)
+            chunks = [params_list[i:i + self.chunk_size]
+                      for i in range(0, len(params_list), self.chunk_size)]
+            self._remaining[stock_id] = len(chunks)
+            self._al_results[stock_id] = [None] * len(chunks)
+            for i, chunk in enumerate(chunks):
+                yield i, (self.Strategy, stock_id, handle, chunk)
+
+    def run(self, stock_ids):
+        """
+        Train all the stocks.
+        :param stock_ids(list): stock ids.
+        :return: dict(stock_id: params)
+        """
+        best_params = {}
+        # keep the pool busy without loading every stock up front
+        max_pending = self.workers * 2
+
+        with SharedDataStore() as self._store, \
+                ProcessPoolExecutor(max_workers=self.workers) as executor:
+            pending = {}
+            for i, unit in self.get_work_units(stock_ids):
+                pending[executor.submit(train_chunk, *unit)] = unit[1], i
+                if len(pending) >= max_pending:
+                    self._collect(pending, best_params)
+
+            while pending:
+                self._collect(pending, best_params)
+
+        return best_params
+
+    def _collect(self, pending, best_params):
+        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            stock_id, i = pending.pop(future)
+            if stock_id not in self._remaining:
+                # an other chunk of this stock failed
+                continue
+
+            try:
+                al_results = future.result()
+            except Exception as e:
+                logger.error(f'training stock {stock_id} failed: {e}', exc_info=True)
+                del self._remaining[stock_id]
+                del self._al_results[stock_id]
+                self._store.release(stock_id)
+                continue
+
+            # keep the chunks in the order of the params list, ties resolve as in a serial run
+            self._al_results[stock_id][i] = al_results
+            self._remaining[stock_id] -= 1
+            if self._remaining[stock_id]:
+                continue
+
+            del self._remaining[stock_id]
+            self._store.release(stock_id)
+            al_results = [r for chunk in self._al_results.pop(stock_id) for r in chunk]
+            params = Btask.get_best_params(al_results, stock_id)
+            best_params[stock_id] = params
+            if self.on_result is not None:
+                self.on_result(stock_id, params)
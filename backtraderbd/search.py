@@ -0,0 +1,238 @@
+# -*- coding: utf-8 -*-
+import math
+
+import numpy as np
+
+from backtraderbd.btask import Btask
+from backtraderbd.optimizer import TopK
+from backtraderbd.settings import settings as conf
+from backtraderbd.libs.log import get_logger
+
+logger = get_logger(__name__)
+
+
+class ParamSearch(object):
+    """
+    Base of the param searches: the param sets proposed by `search` are back tested once each,
+    ranked like `TopK` and the search stops early when the best result levels off.
+    Attributes:
+        Strategy(class): strategy to train, its `get_param_space` is the default space.
+        evaluate(callable): (data, params_list) -> list of results, default the vectorized engine.
+        k(int): best results kept, default `OPTIMIZATION_TOP_K`.
+        patience(int): rounds without improvement before stopping, default `SEARCH_PATIENCE`.
+        tol(float): improvement of the best total return rate counted as progress, default `SEARCH_TOL`.
+        seed(int): seed of the random sampling, default `SEARCH_SEED`.
+    """
+
+    def __init__(self, Strategy, evaluate=None, k=None, patience=None, tol=None, seed=None):
+        self.Strategy = Strategy
+        self.evaluate = evaluate or (
+            lambda data, params_list: Btask.evaluate_params_vectorized(Strategy, data, params_list))
+        self.k = k or conf.OPTIMIZATION_TOP_K
+        self.patience = patience if patience is not None else conf.SEARCH_PATIENCE
+        self.tol = tol if tol is not None else conf.SEARCH_TOL
+        self.seed = seed if seed is not None else conf.SEARCH_SEED
+        self.evaluations = 0
+        self._seen = {}
+
+    def _evaluate(self, data, params_list, top=None):
+        """
+        Back test the param sets not back tested yet on this data.
+        :param data(DataFrame): training data.
+        :param params_list(list): dicts of strategy params.
+        :param top(TopK): results are pushed to it.
+        :return: results of all the param sets(list of dict), in order.
+        """
+        keys = [(len(data), tuple(sorted(params.items()))) for params in params_list]
+        new = {}
+        for key, params in zip(keys, params_list):
+            if key not in self._seen and key not in new:
+                new[key] = params
+
+        if new:
+            for key, al_result in zip(new, self.evaluate(data, list(new.values()))):
+                self._seen[key] = al_result
+                if top is not None:
+                    top.push(al_result)
+            self.evaluations += len(new)
+
+        return [self._seen[key] for key in keys]
+
+    def _progress(self, best, top):
+        """
+        :return: the new best total return rate and whether it improved(tuple)
+        """
+        results = top.results()
+        current = results[0]['total_return_rate'] if results else -np.inf
+        return current, current > best + self.tol
+
+    def search(self, data, space, top):
+        """
+        Propose and back test param sets, subclasses implement it.
+        :param data(DataFrame): training data.
+        :param space(ParamSpace): search space.
+        :param top(TopK): best results.
+        :return: None
+        """
+        raise NotImplementedError
+
+    def run(self, data, space=None):
+        """
+        Search the best param sets.
+        :param data(DataFrame): training data.
+        :param space(ParamSpace): search space, default `Strategy.get_param_space(data)`.
+        :return: the k best results, best first(list of dict)
+        """
+        space = space or self.Strategy.get_param_space(data)
+        self.evaluations = 0
+        self._seen = {}
+
+        top = TopK(self.k)
+        self.search(data, space, top)
+        logger.debug(
+            f'{type(self).__name__} of {self.Strategy.__name__}: {self.evaluations} back tests, '
+            f'space of {space.size()} points.'
+        )
+
+        return top.results()
+
+    def optimize(self, data, stock_id, space=None):
+        """
+        Find the best params of the strategy for one stock.
+        :param data(DataFrame): training data.
+        :param stock_id(string): stock on which the strategy works.
+        :param space(ParamSpace): search space, default `Strategy.get_param_space(data)`.
+        :return: params(dict like {fast_period: 1, slow_period: 2, stock_id: '0'})
+        """
+        results = self.run(data, space)
+        if not results:
+            raise ValueError(f'no params to search for stock {stock_id}')
+
+        params = dict(results[0]['params'], stock_id=stock_id)
+        logger.debug(f'Stock {stock_id} best params is {params}')
+
+        return params
+
+
+class GridSearch(ParamSearch):
+    """
+    Exhaustive search of a regular grid, the reference of the other searches.
+    Attributes:
+        points(int): values per param, None is every value.
+    """
+
+    def __init__(self, Strategy, points=None, **kwargs):
+        super().__init__(Strategy, **kwargs)
+        self.points = points
+
+    def search(self, data, space, top):
+        # a zero step is every value
+        steps = space.coarse_steps(self.points) if self.points else {name: 0 for name in space.names}
+        self._evaluate(data, space.grid(steps), top)
+
+
+class CoarseToFineSearch(ParamSearch):
+    """
+    Back test a coarse grid, then refine around the best param sets with halved steps
+    until the steps are 1 or the best result levels off.
+    Attributes:
+        budget(int): about the number of points of the coarse grid.
+        keep(int): best param sets refined at each level.
+    """
+
+    # values per param of the coarse grid at least, 3 keeps a center point in every dimension
+    MIN_POINTS = 3
+
+    def __init__(self, Strategy, budget=128, keep=3, **kwargs):
+        super().__init__(Strategy, **kwargs)
+        self.budget = budget
+        self.keep = keep
+
+    def search(self, data, space, top):
+        points = max(int(round(self.budget ** (1.0 / len(space.names)), 6)), self.MIN_POINTS)
+        steps = space.coarse_steps(points)
+        self._evaluate(data, space.grid(steps), top)
+        best, _ = self._progress(-np.inf, top)
+
+        stale = 0
+        while not all(space.is_fine(steps, al_result['params']) for al_result in top.results()[:self.keep]):
+            steps = {name: step / 2.0 for name, step in steps.items()}
+            candidates = []
+            for al_result in top.results()[:self.keep]:
+                candidates.extend(space.neighbours(al_result['params'], steps))
+            self._evaluate(data, candidates, top)
+
+            best, improved = self._progress(best, top)
+            stale = 0 if improved else stale + 1
+            if stale > self.patience:
+                break
+
+
+class RandomSearch(ParamSearch):
+    """
+    Uniform random sampling in batches, stops after `n_iter` param sets
+    or when `patience` batches in a row do not improve the best result.
+    Attributes:
+        n_iter(int): maximum number of param sets.
+        batch_size(int): param sets sampled and back tested together.
+    """
+
+    def __init__(self, Strategy, n_iter=256, batch_size=32, **kwargs):
+        super().__init__(Strategy, **kwargs)
+        self.n_iter = n_iter
+        self.batch_size = batch_size
+
+    def search(self, data, space, top):
+        rng = np.random.default_rng(self.seed)
+        best = -np.inf
+        stale = 0
+        while self.evaluations < self.n_iter:
+            candidates = space.sample(rng, min(self.batch_size, self.n_iter - self.evaluations))
+            if not candidates:
+                break
+            before = self.evaluations
+            self._evaluate(data, candidates, top)
+            if self.evaluations == before:
+                # the space is exhausted
+                break
+
+            best, improved = self._progress(best, top)
+            stale = 0 if improved else stale + 1
+            if stale > self.patience:
+                break
+
+
+class SuccessiveHalvingSearch(ParamSearch):
+    """
+    Successive halving: many random param sets are back tested on the most recent part of the data,
+    only the best 1 / eta of them go on to a longer window, up to the whole data.
+    Attributes:
+        n(int): param sets of the first rung.
+        eta(int): reduction factor between rungs.
+        min_fraction(float): data fraction of the first rung.
+    """
+
+    def __init__(self, Strategy, n=81, eta=3, min_fraction=0.25, **kwargs):
+        super().__init__(Strategy, **kwargs)
+        self.n = n
+        self.eta = eta
+        self.min_fraction = min_fraction
+
+    def search(self, data, space, top):
+        rng = np.random.default_rng(self.seed)
+        candidates = space.sample(rng, self.n)
+        rungs = max(int(math.ceil(math.log(1.0 / self.min_fraction, self.eta))), 0)
+
+        for rung in range(rungs + 1):
+            fraction = min(self.min_fraction * self.eta ** rung, 1.0)
+            last = rung == rungs or len(candidates) <= 1
+            if last:
+                # the finalists are ranked on the whole data
+                self._evaluate(data, candidates, top)
+                return
+
+            window = data.iloc[-max(int(len(data) * fraction), 1):]
+            rung_top = TopK(max(len(candidates) // self.eta, 1))
+            for al_result in self._evaluate(window, candidates):
+                rung_top.push(al_result)
+            candidates = [al_result['params'] for al_result in rung_top.results()]
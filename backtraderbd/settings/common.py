@@ -1,4 +1,6 @@
 # -*- coding: utf-8 -*-
+import os
+
 PROJECT_NAME = 'backtraderbd'
 
 # log setting
@@ -15,15 +17,59 @@ STRATEGY_PARAMS_SMAC_SYMBOL = 'smac_trend'
 STRATEGY_PARAMS_MACD_SYMBOL = 'macd_trend'
 STRATEGY_PARAMS_EMAC_SYMBOL = 'emac_trend'
 LZ4_N_PARALLEL = 8
+MONGO_MAX_POOL_SIZE = 10                    # connections of the pool of one process
+MONGO_CONNECT_TIMEOUT_MS = 2 * 1000
+MONGO_SOCKET_TIMEOUT_MS = 10 * 60 * 1000
+MONGO_SERVER_SELECTION_TIMEOUT_MS = 30 * 1000
+
+# data schema setting
+PRICE_DECIMALS = 2      # prices with at most these decimals are stored as float32 and widened back exactly
+COMPACT_DATA = False    # `DseHisData.get_data` returns the float32 prices as stored instead of float64
+
+# local cache setting
+LOCAL_CACHE_ENABLED = True
+LOCAL_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.backtraderbd', 'cache')
+LOCAL_CACHE_CHECK_VERSION = True    # compare the arctic version on every read (one small mongo query),
+                                    # False trusts the cache, only safe when this host writes all the data
+RESULT_CACHE_ENABLED = True         # reuse the back test results of unchanged data, strategy, params and broker
+RESULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.backtraderbd', 'results')
+RESULT_CACHE_MAX_BYTES = 512 * 2 ** 20
+
+# delta download setting
+INGEST_WORKERS = 8          # concurrent bdshare requests
+INGEST_RATE_LIMIT = 4       # bdshare requests per second, 0 is unlimited
+INGEST_RETRIES = 3
+INGEST_RETRY_DELAY = 1.0    # seconds, doubled on every retry
+INGEST_BATCH_SIZE = 50      # fetched collections buffered before the calling thread writes them
+
+# profiling setting
+PROFILING_ENABLED = False       # timers, counters and peak rss of the run, see `libs.profiling`
+PROFILING_DIR = os.path.join(os.path.expanduser('~'), '.backtraderbd', 'profiles')
+PROFILING_PROFILER = None       # profiler of each task: None or 'cprofile'
 
 # Global arguments
 DEFAULT_CASH = 50000.0
 COMMISSION_PER_TRANSACTION = 0.004
 EXECUTION_TYPE = 'close'
 PERIODIC_LOGGING = False
-TRANSACTION_LOGGING = True
+TRANSACTION_LOGGING = True          # record the order and trade events in the trade journal
+TRANSACTION_JOURNAL_DIR = None      # directory of the csv trade journals, None only logs their event counts
 BUY_PROP = 1
 SELL_PROP = 1
+PORTFOLIO_WINDOW = 250          # dates simulated together by the portfolio back test
+PORTFOLIO_MAX_POSITIONS = None  # most stocks held at once by the portfolio back test, None is no limit
+
+# optimization setting
+VECTORIZED_CHUNK_SIZE = 512     # param sets simulated together by the vectorized engine
+TRAINING_WORKERS = None         # training processes, None is one per cpu
+TRAINING_CHUNK_SIZE = 512       # param sets of one stock in one training work unit
+OPTIMIZATION_TOP_K = 10         # best results kept by the optimization runner
+OPTIMIZATION_ENGINE = 'vectorized'  # 'vectorized' or 'cerebro'
+SEARCH_PATIENCE = 2             # param search rounds without improvement before stopping
+SEARCH_TOL = 1e-3               # improvement of the best total return rate counted as progress
+SEARCH_SEED = None              # seed of the random param sampling
+TRAINING_STATE_DIR = os.path.join(os.path.expanduser('~'), '.backtraderbd', 'states')  # incremental training
+SIGNAL_STATE_DIR = os.path.join(os.path.expanduser('~'), '.backtraderbd', 'signals')   # daily signals
 
 # constant
 HOLD_THRESHOLD = 1
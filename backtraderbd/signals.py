@@ -0,0 +1,229 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+import pandas as pd
+
+import backtraderbd.data.utils as bdu
+import backtraderbd.strategies.utils as bsu
+from backtraderbd.btask import Btask, STRATEGY_MAPPING
+from backtraderbd.incremental import TrainingStateStore
+from backtraderbd.libs.models import get_training_params
+from backtraderbd.strategies.indicators import IndicatorCache, PanelIndicators
+from backtraderbd.settings import settings as conf
+from backtraderbd.libs.log import get_logger
+
+logger = get_logger(__name__)
+
+
+def get_strategy_params(Strategy, stock_ids):
+    """
+    Get the training params of the strategy for many stocks in one read,
+    the strategy defaults for the stocks not trained.
+    :param Strategy(class): strategy, e.g. SMACStrategy.
+    :param stock_ids(list): stock ids.
+    :return: dict(stock_id: params)
+    """
+    trained = get_training_params(Strategy.name, stock_ids)
+    params = {}
+    for stock_id in stock_ids:
+        stock_params = trained.get(stock_id, {})
+        if not isinstance(stock_params, dict):
+            logger.warning(f'legacy params of stock {stock_id} are ignored, default params used.')
+            stock_params = {}
+        params[stock_id] = {name: value for name, value in stock_params.items() if name != 'stock_id'}
+
+    return params
+
+
+class DailySignalState(object):
+    """
+    Rolling indicator state of one strategy on one stock, with the params it was built for.
+    Attributes:
+        stock_id(string): stock id.
+        params(dict): strategy params.
+        bars(int): bars seen.
+        last_date(Timestamp): date of the last bar seen.
+        last_close(float): close of the last bar seen, detects a revised history.
+        signals(SignalState): indicators and signals on the last bar.
+    """
+
+    def __init__(self, stock_id, params, bars, last_date, last_close, signals):
+        self.stock_id = stock_id
+        self.params = params
+        self.bars = bars
+        self.last_date = last_date
+        self.last_close = last_close
+        self.signals = signals
+
+    def is_resumable(self, data, params):
+        """
+        Whether the state can be updated with the bars appended to the data.
+        :param data(DataFrame): time serials of the stock.
+        :param params(dict): current strategy params of the stock.
+        :return: bool
+        """
+        if params != self.params or not self.signals.warm or not 0 < self.bars <= len(data):
+            return False
+
+        return (data.index[self.bars - 1] == self.last_date and
+                float(data['close'].iloc[self.bars - 1]) == self.last_close)
+
+
+class DailySignals(object):
+    """
+    Daily buy/sell signals of one strategy over many stocks without replaying the history:
+    the rolling indicator state of every stock is saved and updated in O(1) per new bar,
+    the signals of the last bar are written as daily alerts.
+    The params of each stock are its training params, the strategy defaults if it was not trained.
+    Attributes:
+        Strategy(class): strategy, e.g. SMACStrategy.
+        store(TrainingStateStore): saved states, default in `SIGNAL_STATE_DIR`.
+        symbol(string): alert symbol, default the strategy name.
+    """
+
+    def __init__(self, Strategy, store=None, symbol=None):
+        self.Strategy = Strategy
+        self.store = store or TrainingStateStore(conf.SIGNAL_STATE_DIR)
+        self.symbol = symbol or Strategy.name
+
+    def get_params(self, stock_ids):
+        """
+        Get the params of the stocks.
+        :param stock_ids(list): stock ids.
+        :return: dict(stock_id: params)
+        """
+        return get_strategy_params(self.Strategy, stock_ids)
+
+    def update(self, stock_id, params, data=None):
+        """
+        Bring the state of one stock up to its last bar.
+        :param stock_id(string): stock id.
+        :param params(dict): strategy params.
+        :param data(DataFrame): time serials, default `Btask.get_data(stock_id)`.
+        :return: the state and the number of new bars(tuple), None if there is no data.
+        """
+        if data is None:
+            data = Btask.get_data(stock_id)
+        data = bdu.Utils.to_numeric(data)
+        if not len(data):
+            return None
+
+        state = self.store.get(self.Strategy, stock_id)
+        if state is not None and state.is_resumable(data, params):
+            new_close = data['close'].to_numpy()[state.bars:]
+            for close in new_close:
+                state.signals.update(close)
+            new_bars = len(new_close)
+        else:
+            # first run, new params or revised history: built from the whole history once
+            signals = self.Strategy.get_signal_state(IndicatorCache(data), [params])
+            state = DailySignalState(stock_id, params, len(data), None, None, signals)
+            new_bars = len(data)
+
+        state.bars = len(data)
+        state.last_date = data.index[-1]
+        state.last_close = float(data['close'].iloc[-1])
+        if new_bars:
+            self.store.put(self.Strategy, state)
+
+        return state, new_bars
+
+    def run(self, stock_ids, write_alerts=True):
+        """
+        Signal pass over the stocks, the alerts of the stocks with a new bar are written
+        with one append.
+        :param stock_ids(list): stock ids.
+        :param write_alerts(bool): write the alerts to the daily alert library.
+        :return: signals of the last bar(DataFrame), columns: stock, date, buy, sell.
+        """
+        rows = []
+        with bsu.AlertWriter() as writer:
+            for stock_id, params in self.get_params(stock_ids).items():
+                try:
+                    updated = self.update(stock_id, params)
+                except Exception as e:
+                    logger.error(f'daily signal of stock {stock_id} failed: {e}', exc_info=True)
+                    continue
+                if updated is None:
+                    continue
+
+                state, new_bars = updated
+                buy = bool(state.signals.buy_signal[0])
+                sell = bool(state.signals.sell_signal[0])
+                rows.append(dict(stock=stock_id, date=state.last_date, buy=buy, sell=sell))
+                if not write_alerts or not new_bars:
+                    # the alerts of this bar were already written
+                    continue
+                if buy:
+                    writer.add(self.symbol, stock_id, 'buy')
+                if sell:
+                    writer.add(self.symbol, stock_id, 'sell')
+
+        logger.debug(f'daily signals of {self.Strategy.__name__}: {len(rows)} stocks.')
+
+        return pd.DataFrame(rows, columns=['stock', 'date', 'buy', 'sell'])
+
+
+class UniverseScanner(object):
+    """
+    Signals of the last bar of many strategies over the whole universe in one pass:
+    the stocks are loaded once into a close panel aligned on their last bar, and the indicators
+    of all the stocks are computed together, each stock with its training params.
+    Same signals as `Strategy.get_signals` on each stock.
+    Attributes:
+        strategies(dict): strategy name -> strategy class, default `STRATEGY_MAPPING`.
+    """
+
+    def __init__(self, strategies=None):
+        self.strategies = strategies or STRATEGY_MAPPING
+
+    @classmethod
+    def load(cls, stock_ids, data=None):
+        """
+        Load the closes of the stocks into one panel.
+        :param stock_ids(list): stock ids.
+        :param data(dict): stock_id -> time serials, default `Btask.get_data`.
+        :return: stock ids loaded, closes(ndarray) shape (bars, stocks) and the last dates(tuple)
+        """
+        loaded, closes, dates = [], [], []
+        for stock_id in stock_ids:
+            try:
+                stock_data = data[stock_id] if data is not None else Btask.get_data(stock_id)
+            except Exception as e:
+                logger.error(f'load data of stock {stock_id} failed: {e}', exc_info=True)
+                continue
+            if not len(stock_data):
+                continue
+            loaded.append(stock_id)
+            closes.append(np.asarray(bdu.Utils.to_numeric(stock_data)['close'], dtype=np.float64))
+            dates.append(stock_data.index[-1])
+
+        panel = np.full((max((len(close) for close in closes), default=0), len(closes)), np.nan)
+        for j, close in enumerate(closes):
+            panel[len(panel) - len(close):, j] = close
+
+        return loaded, panel, dates
+
+    def scan(self, stock_ids, data=None):
+        """
+        Signals of the last bar of every (stock, strategy).
+        :param stock_ids(list): stock ids.
+        :param data(dict): stock_id -> time serials, default `Btask.get_data`.
+        :return: signals(DataFrame), columns: stock, strategy, date, buy, sell.
+        """
+        stock_ids, panel, dates = self.load(stock_ids, data)
+        indicators = PanelIndicators(panel)
+
+        frames = []
+        for name, Strategy in self.strategies.items():
+            params = get_strategy_params(Strategy, stock_ids)
+            buy_signal, sell_signal = Strategy.get_signals(indicators, [params[s] for s in stock_ids])
+            frames.append(pd.DataFrame(dict(
+                stock=stock_ids,
+                strategy=name,
+                date=dates,
+                buy=buy_signal[-1] if len(panel) else False,
+                sell=sell_signal[-1] if len(panel) else False,
+            ), columns=['stock', 'strategy', 'date', 'buy', 'sell']))
+            logger.debug(f'{name} scanned on {len(stock_ids)} stocks.')
+
+        return pd.concat(frames, ignore_index=True)
@@ -4,15 +4,18 @@ import sys
 
 import datetime as dt
 import math
+import numpy as np
 import pandas as pd
 
 import backtrader as bt
 
 import backtraderbd.data.bdshare as bds
 import backtraderbd.strategies.utils as bsu
+import backtraderbd.strategies.journal as bsj
 from backtraderbd.settings import settings as conf
 from backtraderbd.libs.log import get_logger
 from backtraderbd.libs.models import get_or_create_library
+from backtraderbd.strategies.indicators import IndicatorCache
 
 logger = get_logger(__name__)
 
@@ -20,8 +23,36 @@ logger = get_logger(__name__)
 class BaseStrategy(bt.Strategy):
     """
     Base Strategy template for all strategies to be added
+
+    Optimization mode parameters
+    ----------
+    silent : bool
+        No prints when the strategy is built, e.g. for every grid point of `optstrategy`
+    signals : tuple
+        Precomputed (buy, sell) signal arrays, one value per bar, used instead of the indicators
+    param_set : dict
+        Params overriding the others, zips whole param sets under `optstrategy`
     """
+    params = (
+        ("silent", False),
+        ("signals", None),
+        ("param_set", None),
+    )
+    # params of the optimization mode, not params of the strategy
+    mode_params = ("silent", "signals", "param_set")
+
     def __init__(self):
+        if self.params.param_set:
+            for name, value in self.params.param_set.items():
+                setattr(self.params, name, value)
+        self.silent = self.params.silent
+        # signals are read from the precomputed arrays, the strategies skip their indicators
+        self.precomputed = self.params.signals is not None
+        if self.precomputed:
+            self._buy_signals, self._sell_signals = self.params.signals
+            self.buy_signal = self._precomputed_buy_signal
+            self.sell_signal = self._precomputed_sell_signal
+
         # Global variables
         self.init_cash = conf.DEFAULT_CASH
         self.buy_prop = conf.BUY_PROP
@@ -29,16 +60,88 @@ class BaseStrategy(bt.Strategy):
         self.execution_type = conf.EXECUTION_TYPE
         self.periodic_logging = conf.PERIODIC_LOGGING
         self.transaction_logging = conf.TRANSACTION_LOGGING
-        print("===Global level arguments===")
-        print("init_cash : {}".format(self.init_cash))
-        print("buy_prop : {}".format(self.buy_prop))
-        print("sell_prop : {}".format(self.sell_prop))
+        if not self.silent:
+            print("===Global level arguments===")
+            print("init_cash : {}".format(self.init_cash))
+            print("buy_prop : {}".format(self.buy_prop))
+            print("sell_prop : {}".format(self.sell_prop))
         self.dataclose = self.datas[0].close    # Keep a reference to the "close" line in the data[0] dataseries
         self.dataopen = self.datas[0].open
         self.order = None   # To keep track of pending orders
         self.buyprice = None
         self.buycomm = None
-        self.len_data = len(list(self.datas[0]))    # Number of ticks in the input data
+        # Number of ticks in the input data, same as len(list(self.datas[0])) without materializing the line
+        buflen = self.datas[0].buflen()
+        self.len_data = buflen + 1 if buflen else 0
+        # order and trade events, written out in bulk at the end of the run, none in optimization mode
+        self.journal = None
+        if self.transaction_logging and not self.silent and not self.precomputed:
+            self.journal = bsj.TradeJournal(self.len_data // 8)
+
+    @classmethod
+    def get_params_dicts(cls, params_list):
+        """
+        Complete each param set with the default params of the strategy.
+        :param params_list(list): dicts of strategy params.
+        :return: list(dict)
+        """
+        defaults = {name: value for name, value in cls.params._getitems()
+                    if name not in cls.mode_params}
+        params_dicts = []
+        for params in params_list:
+            unknown = set(params) - set(defaults)
+            if unknown:
+                raise ValueError(f'unknown params for {cls.__name__}: {sorted(unknown)}')
+            params_dicts.append(dict(defaults, **params))
+
+        return params_dicts
+
+    @classmethod
+    def get_signals(cls, indicators, params_list):
+        """
+        Vectorized `buy_signal` and `sell_signal` of many param sets, one column per set.
+        :param indicators(IndicatorCache): shared indicators of the time serials.
+        :param params_list(list): dicts of strategy params.
+        :return: buy and sell signals(tuple of ndarray), shape (bars, len(params_list)).
+        """
+        shape = (len(indicators.close), len(params_list))
+        return np.ones(shape, dtype=bool), np.ones(shape, dtype=bool)
+
+    @classmethod
+    def get_signal_state(cls, indicators, params_list):
+        """
+        Resumable state of `get_signals` at the end of the time serials,
+        the signals of the bars appended later are computed from it in O(1) per bar.
+        :param indicators(IndicatorCache): shared indicators of the time serials.
+        :param params_list(list): dicts of strategy params.
+        :return: SignalState
+        """
+        raise NotImplementedError(f'{cls.__name__} has no signal state')
+
+    @classmethod
+    def get_param_space(cls, data):
+        """
+        Search space of the strategy params for the adaptive param search.
+        :param data(DataFrame): training data.
+        :return: ParamSpace
+        """
+        raise NotImplementedError(f'{cls.__name__} has no param space')
+
+    @classmethod
+    def get_param_sets(cls, data, params_list):
+        """
+        Param sets for `optstrategy` in optimization mode: silent, with the precomputed signals,
+        e.g. cerebro.optstrategy(Strategy, param_set=Strategy.get_param_sets(data, params_list)).
+        :param data(DataFrame): the time serials fed to cerebro.
+        :param params_list(list): dicts of strategy params.
+        :return: list(dict)
+        """
+        buy_signal, sell_signal = cls.get_signals(IndicatorCache(data), params_list)
+
+        return [
+            dict(params, silent=True, signals=(buy_signal[:, j], sell_signal[:, j]))
+            for j, params in enumerate(cls.get_params_dicts(params_list))
+        ]
 
     def buy_signal(self):
         return True
@@ -46,6 +149,12 @@ class BaseStrategy(bt.Strategy):
     def sell_signal(self):
         return True
 
+    def _precomputed_buy_signal(self):
+        return self._buy_signals[len(self) - 1]
+
+    def _precomputed_sell_signal(self):
+        return self._sell_signals[len(self) - 1]
+
     def notify_order(self, order):
         if order.status in [order.Submitted, order.Accepted]:
             # Buy/Sell order submitted/accepted to/by broker - Nothing to do
@@ -54,40 +163,34 @@ class BaseStrategy(bt.Strategy):
         # Check if an order has been completed
         # Attention: broker could reject order if not enough cash
         if order.status in [order.Completed]:
-            if order.isbuy():
-                if self.transaction_logging:
-                    bsu.Utils.log(
-                        "BUY EXECUTED, Price: %.2f, Cost: %.2f, Comm %.2f"
-                        % (
-                            order.executed.price,
-                            order.executed.value,
-                            order.executed.comm,
-                        )
-                    )
+            if self.journal is not None:
+                self.journal.record(
+                    bsj.BUY_EXECUTED if order.isbuy() else bsj.SELL_EXECUTED,
+                    len(self), order.executed.dt,
+                    price=order.executed.price,
+                    size=order.executed.size,
+                    value=order.executed.value,
+                    comm=order.executed.comm
+                )
 
+            if order.isbuy():
                 self.buyprice = order.executed.price
                 self.buycomm = order.executed.comm
-            else:  # Sell
-                if self.transaction_logging:
-                    bsu.Utils.log(
-                        "SELL EXECUTED, Price: %.2f, Cost: %.2f, Comm %.2f"
-                        % (
-                            order.executed.price,
-                            order.executed.value,
-                            order.executed.comm,
-                        )
-                    )
 
             self.bar_executed = len(self)
 
         elif order.status in [order.Canceled, order.Margin, order.Rejected]:
-            if self.transaction_logging:
-                if not self.periodic_logging:
-                    bsu.Utils.log("Cash %s Value %s" % (self.cash, self.value))
-                bsu.Utils.log("Order Canceled/Margin/Rejected")
-                bsu.Utils.log("Canceled: {}".format(order.status == order.Canceled))
-                bsu.Utils.log("Margin: {}".format(order.status == order.Margin))
-                bsu.Utils.log("Rejected: {}".format(order.status == order.Rejected))
+            if self.journal is not None:
+                if order.status == order.Canceled:
+                    event = bsj.CANCELED
+                elif order.status == order.Margin:
+                    event = bsj.MARGIN
+                else:
+                    event = bsj.REJECTED
+                self.journal.record(
+                    event, len(self), self.datas[0].datetime[0],
+                    size=order.created.size, value=self.value, cash=self.cash
+                )
 
         # Write down: no pending order
         self.order = None
@@ -95,12 +198,16 @@ class BaseStrategy(bt.Strategy):
     def notify_trade(self, trade):
         if not trade.isclosed:
             return
-        if self.transaction_logging:
-            bsu.Utils.log(
-                "OPERATION PROFIT, GROSS %.2f, NET %.2f"
-                % (trade.pnl, trade.pnlcomm)
+        if self.journal is not None:
+            self.journal.record(
+                bsj.TRADE_CLOSED, len(self), trade.dtclose,
+                pnl=trade.pnl, pnlcomm=trade.pnlcomm
             )
 
+    def stop(self):
+        if self.journal is not None:
+            self.journal.flush(type(self).__name__)
+
     def notify_cashvalue(self, cash, value):
         # Update cash and value every period
         if self.periodic_logging:
@@ -111,7 +218,7 @@ class BaseStrategy(bt.Strategy):
     def next(self):
         # Simply log the closing price of the series from the reference
         if self.periodic_logging:
-            bsu.Utils.log("Close, %.2f" % self.dataclose[0])
+            bsu.Utils.log("Close, %.2f" % self.dataclose[0], self.datas[0].datetime.datetime(0))
         
         # Check if an order is pending ... if yes, we cannot send a 2nd one
         if self.order:
@@ -122,13 +229,11 @@ class BaseStrategy(bt.Strategy):
             return
 
         if self.periodic_logging:
-            bsu.Utils.log("CURRENT POSITION SIZE: {}".format(self.position.size))
+            bsu.Utils.log("CURRENT POSITION SIZE: {}".format(self.position.size), self.datas[0].datetime.datetime(0))
         # Only buy if there is enough cash for at least one stock
         if self.cash >= self.dataclose[0]:
             if self.buy_signal():
 
-                if self.transaction_logging:
-                    bsu.Utils.log("BUY CREATE, %.2f" % self.dataclose[0])
                 # Take a 10% long position every time it's a buy signal (or whatever is afforded by the current cash position)
                 # "size" refers to the number of stocks to purchase
                 # Afforded size is based on closing price for the current trading day
@@ -145,12 +250,6 @@ class BaseStrategy(bt.Strategy):
                 # Buy based on the closing price of the next closing day
                 if self.execution_type == "close":
                     final_size = min(buy_prop_size, afforded_size)
-                    if self.transaction_logging:
-                        bsu.Utils.log("Cash: {}".format(self.cash))
-                        bsu.Utils.log("Price: {}".format(self.dataclose[0]))
-                        bsu.Utils.log("Buy prop size: {}".format(buy_prop_size))
-                        bsu.Utils.log("Afforded size: {}".format(afforded_size))
-                        bsu.Utils.log("Final size: {}".format(final_size))
                     # Explicitly setting exectype=bt.Order.Close will make the next day's closing the reference price
                     self.order = self.buy(size=final_size)
                 # Buy based on the opening price of the next closing day (only works "open" data exists in the dataset)
@@ -164,18 +263,18 @@ class BaseStrategy(bt.Strategy):
                         )
                     )
                     final_size = min(buy_prop_size, afforded_size)
-                    if self.transaction_logging:
-                        bsu.Utils.log("Buy prop size: {}".format(buy_prop_size))
-                        bsu.Utils.log("Afforded size: {}".format(afforded_size))
-                        bsu.Utils.log("Final size: {}".format(final_size))
                     self.order = self.buy(size=final_size)
 
+                if self.journal is not None and self.order is not None:
+                    self.journal.record(
+                        bsj.BUY_CREATE, len(self), self.datas[0].datetime[0],
+                        price=self.dataclose[0], size=final_size, cash=self.cash
+                    )
+
         # Only sell if you hold least one unit of the stock (and sell only that stock, so no short selling)
         stock_value = self.value - self.cash
         if stock_value > 0:
             if self.sell_signal():
-                if self.transaction_logging:
-                    bsu.Utils.log("SELL CREATE, %.2f" % self.dataclose[1])
                 # Sell a 5% sell position (or whatever is afforded by the current stock holding)
                 # "size" refers to the number of stocks to purchase
                 if self.execution_type == "close":
@@ -199,4 +298,11 @@ class BaseStrategy(bt.Strategy):
                             (self.init_cash / self.dataopen[1])
                             * self.sell_prop
                         )
-                    )
\ No newline at end of file
+                    )
+
+                # no order is created for a zero size
+                if self.journal is not None and self.order is not None:
+                    self.journal.record(
+                        bsj.SELL_CREATE, len(self), self.datas[0].datetime[0],
+                        price=self.dataclose[0], size=self.order.created.size, cash=self.cash
+                    )
@@ -1,5 +1,10 @@
+import math
+
 import backtrader as bt
 from backtraderbd.strategies.base import BaseStrategy
+from backtraderbd.strategies.space import ParamSpace
+from backtraderbd.strategies.indicators import BatchIndicators
+from backtraderbd.strategies.streaming import SignalState, StreamingSmoothing, StreamingCrossOver
 from backtraderbd.settings import settings as conf
 
 class EMACStrategy(BaseStrategy):
@@ -28,17 +33,72 @@ class EMACStrategy(BaseStrategy):
         self.fast_period = self.params.fast_period
         self.slow_period = self.params.slow_period
 
-        print("===Strategy level arguments===")
-        print("fast_period :", self.fast_period)
-        print("slow_period :", self.slow_period)
+        if not self.silent:
+            print("===Strategy level arguments===")
+            print("fast_period :", self.fast_period)
+            print("slow_period :", self.slow_period)
+        if self.precomputed:
+            # the signals are given, no indicator to compute
+            return
         ema_fast = bt.ind.EMA(period=self.fast_period)  # fast moving average
         ema_slow = bt.ind.EMA(period=self.slow_period)  # slow moving average
         self.crossover = bt.ind.CrossOver(
             ema_fast, ema_slow
         )  # crossover signal
 
+    @classmethod
+    def get_param_space(cls, data):
+        # same bounds as `Btask.get_params_list`: fast up to 10%, slow up to 20% of the data length
+        fast_high = max(math.floor(len(data) * 0.1) - 1, 1)
+        slow_high = max(math.floor(len(data) * 0.2) - 1, fast_high + 1)
+        return ParamSpace(
+            dict(fast_period=(1, fast_high), slow_period=(2, slow_high)),
+            less_than=[('fast_period', 'slow_period')],
+            log_scale=['fast_period', 'slow_period']
+        )
+
+    @classmethod
+    def get_signals(cls, indicators, params_list):
+        params_list = cls.get_params_dicts(params_list)
+        ema_fast = indicators.ema([p['fast_period'] for p in params_list])
+        ema_slow = indicators.ema([p['slow_period'] for p in params_list])
+        crossover = BatchIndicators.crossover(ema_fast, ema_slow)
+
+        return crossover > 0, crossover < 0
+
+    @classmethod
+    def get_signal_state(cls, indicators, params_list):
+        return EMACSignalState(indicators, cls.get_params_dicts(params_list))
+
     def buy_signal(self):
         return self.crossover > 0
 
     def sell_signal(self):
-        return self.crossover < 0
\ No newline at end of file
+        return self.crossover < 0
+
+
+class EMACSignalState(SignalState):
+    """
+    Signal state of `EMACStrategy`: the last EMA values and the last cross over difference.
+    """
+
+    def __init__(self, indicators, params_list):
+        buy_signal, sell_signal = EMACStrategy.get_signals(indicators, params_list)
+        super().__init__(params_list, len(indicators.close), buy_signal[-1], sell_signal[-1])
+        fast = [p['fast_period'] for p in params_list]
+        slow = [p['slow_period'] for p in params_list]
+        periods = sorted(set(fast) | set(slow))
+        self.fast = [periods.index(p) for p in fast]
+        self.slow = [periods.index(p) for p in slow]
+        self.ema = StreamingSmoothing.ema(indicators.ema(periods)[-1], periods)
+        self.crossover = StreamingCrossOver(indicators.ema(fast), indicators.ema(slow))
+
+    @property
+    def warm(self):
+        return self.ema.warm and self.crossover.warm
+
+    def next(self, close):
+        ema = self.ema.update(close)
+        crossover = self.crossover.update(ema[self.fast], ema[self.slow])
+
+        return crossover > 0, crossover < 0
@@ -0,0 +1,343 @@
+# -*- coding: utf-8 -*-
+import math
+
+import numpy as np
+
+from backtraderbd.libs.log import get_logger
+
+logger = get_logger(__name__)
+
+
+class BatchIndicators(object):
+    """
+    Indicators computed for a whole family of periods in one pass, one column per period.
+    Values match the backtrader indicators bar for bar (bars before the minimum period are nan):
+    the sums are exact like `math.fsum` and the smoothing runs the same float operations.
+    """
+
+    @classmethod
+    def window_sums(cls, data, periods):
+        """
+        Exact (correctly rounded, same as `math.fsum`) moving sums from a single cumulative sum.
+        :param data(array): input series, shape (bars,).
+        :param periods(list): window lengths.
+        :return: sums(ndarray), shape (bars, len(periods)).
+        """
+        data = np.asarray(data, dtype=np.float64)
+        out = np.full((len(data), len(periods)), np.nan)
+
+        if not np.isfinite(data).all():
+            # nan/inf can not be summed as integers, fall back to fsum per window
+            for j, period in enumerate(periods):
+                for i in range(period - 1, len(data)):
+                    out[i, j] = math.fsum(data[i - period + 1:i + 1])
+            return out
+
+        # scale every value to an integer over a common power of 2 denominator,
+        # integer sums are exact and `int / int` is correctly rounded
+        ratios = [x.as_integer_ratio() for x in data.tolist()]
+        denominator = max((den for _, den in ratios), default=1)
+        csum = np.empty(len(data) + 1, dtype=object)
+        csum[0] = 0
+        csum[1:] = np.cumsum(
+            np.array([num * (denominator // den) for num, den in ratios], dtype=object))
+
+        for j, period in enumerate(periods):
+            if period > len(data):
+                continue
+            window = csum[period:] - csum[:-period]
+            out[period - 1:, j] = (window / denominator).astype(np.float64)
+
+        return out
+
+    @classmethod
+    def sma(cls, data, periods):
+        """
+        Simple moving averages, same as `bt.ind.SMA`.
+        :param data(array): input series, shape (bars,).
+        :param periods(list): SMA periods.
+        :return: sma(ndarray), shape (bars, len(periods)).
+        """
+        periods = list(periods)
+        return cls.window_sums(data, periods) / np.array(periods, dtype=np.float64)
+
+    @classmethod
+    def smoothing(cls, data, periods, alphas, first=0):
+        """
+        Exponential smoothing seeded with the arithmetic mean of the first `period` values,
+        same as `bt.ind.ExponentialSmoothing`.
+        :param data(array): input, shape (bars,) shared by all periods or (bars, len(periods)).
+        :param periods(list): smoothing periods.
+        :param alphas(list): smoothing factor of each period.
+        :param first(int or array): index of the first valid value of each input column.
+        :return: smoothed series(ndarray), shape (bars, len(periods)).
+        """
+        data = np.asarray(data, dtype=np.float64)
+        n_sets = len(periods)
+        if data.ndim == 1:
+            data = np.broadcast_to(data[:, None], (len(data), n_sets))
+        periods = np.asarray(periods, dtype=np.int64)
+        alpha = np.asarray(alphas, dtype=np.float64)
+        alpha1 = 1.0 - alpha
+        first = np.broadcast_to(np.asarray(first, dtype=np.int64), (n_sets,))
+
+        n_bars = len(data)
+        out = np.full((n_bars, n_sets), np.nan)
+        start = first + periods - 1
+        seed = np.full(n_sets, np.nan)
+        for j in range(n_sets):
+            if start[j] < n_bars:
+                seed[j] = math.fsum(data[first[j]:start[j] + 1, j]) / periods[j]
+
+        if n_sets == 0 or start.min() >= n_bars:
+            return out
+
+        prev = np.full(n_sets, np.nan)
+        for i in range(int(start.min()), n_bars):
+            prev = np.where(i == start, seed, prev * alpha1 + data[i] * alpha)
+            out[i] = prev
+
+        return out
+
+    @classmethod
+    def ema(cls, data, periods, first=0):
+        """
+        Exponential moving averages, same as `bt.ind.EMA`.
+        :param data(array): input, shape (bars,) or (bars, len(periods)).
+        :param periods(list): EMA periods.
+        :param first(int or array): index of the first valid value of each input column.
+        :return: ema(ndarray), shape (bars, len(periods)).
+        """
+        alphas = [2.0 / (1.0 + period) for period in periods]
+        return cls.smoothing(data, periods, alphas, first=first)
+
+    @classmethod
+    def smma(cls, data, periods, first=0):
+        """
+        Smoothed (Wilder) moving averages, same as `bt.ind.SmoothedMovingAverage`.
+        :param data(array): input, shape (bars,) or (bars, len(periods)).
+        :param periods(list): SMMA periods.
+        :param first(int or array): index of the first valid value of each input column.
+        :return: smma(ndarray), shape (bars, len(periods)).
+        """
+        alphas = [1.0 / period for period in periods]
+        return cls.smoothing(data, periods, alphas, first=first)
+
+    @classmethod
+    def rsi(cls, data, periods):
+        """
+        Relative strength index, same as `bt.ind.RSI` (Wilder smoothing, lookback 1).
+        Where backtrader would raise ZeroDivisionError the result is 100 (or nan if flat).
+        :param data(array): input series, shape (bars,).
+        :param periods(list): RSI periods.
+        :return: rsi(ndarray), shape (bars, len(periods)).
+        """
+        data = np.asarray(data, dtype=np.float64)
+        diff = np.full(len(data), np.nan)
+        diff[1:] = data[1:] - data[:-1]
+        upday = np.maximum(diff, 0.0)
+        downday = np.full(len(data), np.nan)
+        downday[1:] = np.maximum(data[:-1] - data[1:], 0.0)
+
+        maup = cls.smma(upday, periods, first=1)
+        madown = cls.smma(downday, periods, first=1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            rs = maup / madown
+            return 100.0 - 100.0 / (1.0 + rs)
+
+    @classmethod
+    def macd(cls, data, fast_periods, slow_periods, signal_periods):
+        """
+        MACD and signal lines for each (fast, slow, signal) combination, same as `bt.ind.MACD`.
+        The EMAs of the distinct fast/slow periods are computed once and shared.
+        :param data(array): input series, shape (bars,).
+        :param fast_periods(list): `period_me1` of each combination.
+        :param slow_periods(list): `period_me2` of each combination.
+        :param signal_periods(list): `period_signal` of each combination.
+        :return: macd and signal(tuple of ndarray), shape (bars, combinations).
+        """
+        periods = sorted(set(fast_periods) | set(slow_periods))
+        emas = dict(zip(periods, cls.ema(data, periods).T))
+
+        return cls.macd_from_ema(emas, fast_periods, slow_periods, signal_periods)
+
+    @classmethod
+    def macd_from_ema(cls, emas, fast_periods, slow_periods, signal_periods):
+        """
+        MACD and signal lines built from already computed EMAs.
+        :param emas(dict): EMA column of each fast/slow period.
+        :param fast_periods(list): `period_me1` of each combination.
+        :param slow_periods(list): `period_me2` of each combination.
+        :param signal_periods(list): `period_signal` of each combination.
+        :return: macd and signal(tuple of ndarray), shape (bars, combinations).
+        """
+        macd = (np.column_stack([emas[p] for p in fast_periods])
+                - np.column_stack([emas[p] for p in slow_periods]))
+        first = np.maximum(fast_periods, slow_periods) - 1
+        signal = cls.ema(macd, signal_periods, first=first)
+
+        return macd, signal
+
+    @classmethod
+    def crossover(cls, data0, data1):
+        """
+        Cross over of two lines, same as `bt.ind.CrossOver`: 1.0 up, -1.0 down, 0.0 none.
+        :param data0(array): first line(s), shape (bars,) or (bars, sets).
+        :param data1(array): second line(s), broadcastable with `data0`.
+        :return: crossover(ndarray), nan while the lines are not yet valid.
+        """
+        data0, data1 = np.broadcast_arrays(np.asarray(data0, dtype=np.float64),
+                                           np.asarray(data1, dtype=np.float64))
+        if data0.ndim == 1:
+            data0, data1 = data0[:, None], data1[:, None]
+        diff = data0 - data1
+
+        # non zero difference: a zero difference keeps the previous one, seeded on the first bar
+        valid = ~np.isnan(diff)
+        index = np.arange(len(diff))[:, None]
+        start = np.where(valid.any(axis=0), valid.argmax(axis=0), len(diff))
+        keep = (diff != 0.0) | (index == start) | ~valid
+        last = np.maximum.accumulate(np.where(keep, index, 0), axis=0)
+        nzd = np.take_along_axis(diff, last, axis=0)
+
+        crossover = np.full(diff.shape, np.nan)
+        prev = nzd[:-1]
+        up = (prev < 0.0) & (data0[1:] > data1[1:])
+        down = (prev > 0.0) & (data0[1:] < data1[1:])
+        crossover[1:] = up.astype(np.float64) - down.astype(np.float64)
+        crossover[index <= start] = np.nan
+
+        return crossover
+
+
+class IndicatorCache(object):
+    """
+    Indicators of one price series shared across a parameter grid, every period is
+    computed once, missing periods of a request are computed together in one pass.
+    Attributes:
+        data(DataFrame): the time serials, columns: open, high, low, close, volume.
+    """
+
+    def __init__(self, data):
+        self.data = data
+        self.close = np.asarray(data['close'], dtype=np.float64)
+        self._columns = {}
+
+    def _get(self, name, periods, compute):
+        cache = self._columns.setdefault(name, {})
+        missing = sorted(set(periods) - set(cache))
+        if missing:
+            values = compute(missing)
+            for j, period in enumerate(missing):
+                cache[period] = values[:, j]
+
+        if not periods:
+            return np.empty((len(self.close), 0))
+
+        return np.column_stack([cache[period] for period in periods])
+
+    def sma(self, periods):
+        """
+        :param periods(list): SMA periods.
+        :return: sma(ndarray), shape (bars, len(periods)).
+        """
+        return self._get('sma', periods, lambda p: BatchIndicators.sma(self.close, p))
+
+    def ema(self, periods):
+        """
+        :param periods(list): EMA periods.
+        :return: ema(ndarray), shape (bars, len(periods)).
+        """
+        return self._get('ema', periods, lambda p: BatchIndicators.ema(self.close, p))
+
+    def rsi(self, periods):
+        """
+        :param periods(list): RSI periods.
+        :return: rsi(ndarray), shape (bars, len(periods)).
+        """
+        return self._get('rsi', periods, lambda p: BatchIndicators.rsi(self.close, p))
+
+    def macd(self, fast_periods, slow_periods, signal_periods):
+        """
+        :param fast_periods(list): `period_me1` of each combination.
+        :param slow_periods(list): `period_me2` of each combination.
+        :param signal_periods(list): `period_signal` of each combination.
+        :return: macd and signal(tuple of ndarray), shape (bars, combinations).
+        """
+        periods = sorted(set(fast_periods) | set(slow_periods))
+        emas = dict(zip(periods, self.ema(periods).T))
+
+        return BatchIndicators.macd_from_ema(emas, fast_periods, slow_periods, signal_periods)
+
+
+class PanelIndicators(object):
+    """
+    Indicators of many price series at once, same interface as `IndicatorCache` but column j
+    is the series j with the j-th period, so `Strategy.get_signals(PanelIndicators(panel), params_list)`
+    gives the signals of every stock with its own params.
+    The series are aligned on their last bar, the bars before the first one of a series are nan.
+    Values match `IndicatorCache` of each series bar for bar.
+    Attributes:
+        close(ndarray): closes, shape (bars, series).
+        start(ndarray): first bar of each series.
+    """
+
+    def __init__(self, close):
+        self.close = np.asarray(close, dtype=np.float64)
+        valid = ~np.isnan(self.close)
+        self.start = np.where(valid.any(axis=0), valid.argmax(axis=0), len(self.close))
+
+    def _check(self, periods):
+        if len(periods) != self.close.shape[1]:
+            raise ValueError(f'{len(periods)} periods for {self.close.shape[1]} series')
+
+    def sma(self, periods):
+        """
+        :param periods(list): SMA period of each series.
+        :return: sma(ndarray), shape (bars, series).
+        """
+        self._check(periods)
+        out = np.full(self.close.shape, np.nan)
+        # exact window sums are not vectorized across series
+        for j, period in enumerate(periods):
+            out[self.start[j]:, j] = BatchIndicators.sma(self.close[self.start[j]:, j], [period])[:, 0]
+
+        return out
+
+    def ema(self, periods):
+        """
+        :param periods(list): EMA period of each series.
+        :return: ema(ndarray), shape (bars, series).
+        """
+        self._check(periods)
+        return BatchIndicators.ema(self.close, periods, first=self.start)
+
+    def rsi(self, periods):
+        """
+        :param periods(list): RSI period of each series.
+        :return: rsi(ndarray), shape (bars, series).
+        """
+        self._check(periods)
+        diff = np.full(self.close.shape, np.nan)
+        diff[1:] = self.close[1:] - self.close[:-1]
+        upday = np.maximum(diff, 0.0)
+        downday = np.maximum(-diff, 0.0)
+
+        maup = BatchIndicators.smma(upday, periods, first=self.start + 1)
+        madown = BatchIndicators.smma(downday, periods, first=self.start + 1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            rs = maup / madown
+            return 100.0 - 100.0 / (1.0 + rs)
+
+    def macd(self, fast_periods, slow_periods, signal_periods):
+        """
+        :param fast_periods(list): `period_me1` of each series.
+        :param slow_periods(list): `period_me2` of each series.
+        :param signal_periods(list): `period_signal` of each series.
+        :return: macd and signal(tuple of ndarray), shape (bars, series).
+        """
+        macd = self.ema(fast_periods) - self.ema(slow_periods)
+        first = self.start + np.maximum(fast_periods, slow_periods) - 1
+        signal = BatchIndicators.ema(macd, signal_periods, first=first)
+
+        return macd, signal
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+import os
+
+import numpy as np
+import pandas as pd
+
+import backtrader as bt
+
+from backtraderbd.settings import settings as conf
+from backtraderbd.libs.log import get_logger
+
+logger = get_logger(__name__)
+
+# journal events
+BUY_CREATE = 0
+SELL_CREATE = 1
+BUY_EXECUTED = 2
+SELL_EXECUTED = 3
+CANCELED = 4
+MARGIN = 5
+REJECTED = 6
+TRADE_CLOSED = 7
+
+EVENT_NAMES = [
+    'BUY CREATE', 'SELL CREATE', 'BUY EXECUTED', 'SELL EXECUTED',
+    'CANCELED', 'MARGIN', 'REJECTED', 'TRADE CLOSED'
+]
+
+JOURNAL_DTYPE = np.dtype([
+    ('bar', np.int32),
+    ('datetime', np.float64),   # backtrader date number
+    ('event', np.int8),
+    ('price', np.float64),
+    ('size', np.float64),
+    ('value', np.float64),
+    ('comm', np.float64),
+    ('pnl', np.float64),
+    ('pnlcomm', np.float64),
+    ('cash', np.float64),
+])
+
+
+class TradeJournal(object):
+    """
+    Compact journal of the order and trade events of one strategy run, recorded into a
+    preallocated structured array (nothing is formatted while the run is going on),
+    written out in bulk with `flush` at the end of the run.
+    Attributes:
+        capacity(int): initial number of records, grows by doubling.
+    """
+
+    def __init__(self, capacity=64):
+        self._records = np.zeros(max(capacity, 1), dtype=JOURNAL_DTYPE)
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def record(self, event, bar, dt, price=np.nan, size=np.nan, value=np.nan,
+               comm=np.nan, pnl=np.nan, pnlcomm=np.nan, cash=np.nan):
+        """
+        Record one event.
+        :param event(int): one of the journal events, e.g. BUY_EXECUTED.
+        :param bar(int): bar number, `len(strategy)`.
+        :param dt(float): backtrader date number of the event.
+        :return: None
+        """
+        if self._size == len(self._records):
+            self._records = np.concatenate([self._records, np.zeros_like(self._records)])
+
+        self._records[self._size] = (bar, dt, event, price, size, value, comm, pnl, pnlcomm, cash)
+        self._size += 1
+
+    @property
+    def records(self):
+        """
+        :return: the recorded events(structured ndarray)
+        """
+        return self._records[:self._size]
+
+    def to_frame(self):
+        """
+        :return: the recorded events(DataFrame), one row per event.
+        """
+        records = self.records
+        df = pd.DataFrame({name: records[name] for name in JOURNAL_DTYPE.names})
+        df['datetime'] = [bt.num2date(x) if np.isfinite(x) else pd.NaT for x in records['datetime']]
+        df['event'] = [EVENT_NAMES[x] for x in records['event']]
+
+        return df
+
+    def flush(self, name):
+        """
+        Write the journal out in one go: a one line debug summary and, if `TRANSACTION_JOURNAL_DIR`
+        is set, the events in a csv file.
+        :param name(string): name of the run, e.g. the strategy name.
+        :return: None
+        """
+        if not self._size:
+            return
+
+        if conf.TRANSACTION_JOURNAL_DIR:
+            os.makedirs(conf.TRANSACTION_JOURNAL_DIR, exist_ok=True)
+            path = os.path.join(conf.TRANSACTION_JOURNAL_DIR, f'{name}-{os.getpid()}-{id(self)}.csv')
+            self.to_frame().to_csv(path, index=False)
+
+        logger.debug('trade journal of %s, %d events.', name, self._size)
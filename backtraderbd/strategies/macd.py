@@ -1,5 +1,9 @@
 import backtrader as bt
+import numpy as np
 from backtraderbd.strategies.base import BaseStrategy
+from backtraderbd.strategies.space import ParamSpace
+from backtraderbd.strategies.indicators import BatchIndicators
+from backtraderbd.strategies.streaming import SignalState, StreamingSMA, StreamingSmoothing, StreamingCrossOver
 from backtraderbd.settings import settings as conf
 
 class MACDStrategy(BaseStrategy):
@@ -44,12 +48,16 @@ class MACDStrategy(BaseStrategy):
         self.sma_period = self.params.sma_period
         self.dir_period = self.params.dir_period
 
-        print("===Strategy level arguments===")
-        print("fast_period :", self.fast_period)
-        print("slow_period :", self.slow_period)
-        print("signal_period :", self.signal_period)
-        print("sma_period :", self.sma_period)
-        print("dir_period :", self.dir_period)
+        if not self.silent:
+            print("===Strategy level arguments===")
+            print("fast_period :", self.fast_period)
+            print("slow_period :", self.slow_period)
+            print("signal_period :", self.signal_period)
+            print("sma_period :", self.sma_period)
+            print("dir_period :", self.dir_period)
+        if self.precomputed:
+            # the signals are given, no indicator to compute
+            return
         macd_ind = bt.ind.MACD(
             period_me1=self.fast_period,
             period_me2=self.slow_period,
@@ -65,8 +73,97 @@ class MACDStrategy(BaseStrategy):
         self.sma = bt.indicators.SMA(period=self.sma_period)
         self.smadir = self.sma - self.sma(-self.dir_period)
 
+    @classmethod
+    def get_param_space(cls, data):
+        # the longest indicator needs slow_period + signal_period bars
+        high = max(len(data) // 4, 12)
+        return ParamSpace(
+            dict(
+                fast_period=(2, min(20, high - 2)),
+                slow_period=(5, min(50, high)),
+                signal_period=(3, min(15, high)),
+                sma_period=(10, min(60, high)),
+                dir_period=(2, min(20, high)),
+            ),
+            less_than=[('fast_period', 'slow_period')],
+            log_scale=['fast_period', 'slow_period', 'signal_period', 'sma_period', 'dir_period']
+        )
+
+    @classmethod
+    def get_signals(cls, indicators, params_list):
+        params_list = cls.get_params_dicts(params_list)
+        macd, signal = indicators.macd(
+            [p['fast_period'] for p in params_list],
+            [p['slow_period'] for p in params_list],
+            [p['signal_period'] for p in params_list],
+        )
+        crossover = BatchIndicators.crossover(macd, signal)
+
+        # Control market trend: sma - sma(-dir_period)
+        sma = indicators.sma([p['sma_period'] for p in params_list])
+        dir_period = np.array([p['dir_period'] for p in params_list])
+        ago = np.arange(len(sma))[:, None] - dir_period
+        smadir = sma - np.take_along_axis(sma, np.maximum(ago, 0), axis=0)
+        smadir[ago < 0] = np.nan
+
+        return ((crossover > 0) & (smadir < 0.0),
+                (crossover < 0) & (smadir > 0.0))
+
+    @classmethod
+    def get_signal_state(cls, indicators, params_list):
+        return MACDSignalState(indicators, cls.get_params_dicts(params_list))
+
     def buy_signal(self):
         return self.crossover > 0 and self.smadir < 0.0
 
     def sell_signal(self):
-        return self.crossover < 0 and self.smadir > 0.0
\ No newline at end of file
+        return self.crossover < 0 and self.smadir > 0.0
+
+
+class MACDSignalState(SignalState):
+    """
+    Signal state of `MACDStrategy`: the last EMA and signal line values, the last cross over difference,
+    the SMA window sums and the last `dir_period` SMA values.
+    """
+
+    def __init__(self, indicators, params_list):
+        buy_signal, sell_signal = MACDStrategy.get_signals(indicators, params_list)
+        super().__init__(params_list, len(indicators.close), buy_signal[-1], sell_signal[-1])
+        fast = [p['fast_period'] for p in params_list]
+        slow = [p['slow_period'] for p in params_list]
+        signal_periods = [p['signal_period'] for p in params_list]
+        periods = sorted(set(fast) | set(slow))
+        self.fast = [periods.index(p) for p in fast]
+        self.slow = [periods.index(p) for p in slow]
+        self.ema = StreamingSmoothing.ema(indicators.ema(periods)[-1], periods)
+        macd, signal = indicators.macd(fast, slow, signal_periods)
+        self.signal = StreamingSmoothing.ema(signal[-1], signal_periods)
+        self.crossover = StreamingCrossOver(macd, signal)
+
+        sma_periods = sorted(set(p['sma_period'] for p in params_list))
+        self.sma_columns = [sma_periods.index(p['sma_period']) for p in params_list]
+        self.dir_period = np.array([p['dir_period'] for p in params_list])
+        self.sma = StreamingSMA(indicators.close, sma_periods)
+        # SMA values of the last max(dir_period) + 1 bars, nan before the first bar
+        size = int(self.dir_period.max()) + 1
+        history = indicators.sma(sma_periods)[-size:]
+        self.sma_history = np.vstack([np.full((size - len(history), len(sma_periods)), np.nan), history])
+
+    @property
+    def warm(self):
+        return self.ema.warm and self.signal.warm and self.crossover.warm
+
+    def next(self, close):
+        ema = self.ema.update(close)
+        macd = ema[self.fast] - ema[self.slow]
+        signal = self.signal.update(macd)
+        crossover = self.crossover.update(macd, signal)
+
+        # Control market trend: sma - sma(-dir_period)
+        self.sma_history = np.roll(self.sma_history, -1, axis=0)
+        self.sma_history[-1] = self.sma.update(close)
+        sma = self.sma_history[-1, self.sma_columns]
+        smadir = sma - self.sma_history[-1 - self.dir_period, self.sma_columns]
+
+        return ((crossover > 0) & (smadir < 0.0),
+                (crossover < 0) & (smadir > 0.0))
@@ -1,5 +1,8 @@
 import backtrader as bt
+import numpy as np
 from backtraderbd.strategies.base import BaseStrategy
+from backtraderbd.strategies.space import ParamSpace
+from backtraderbd.strategies.streaming import SignalState, StreamingRSI
 from backtraderbd.settings import settings as conf
 
 class RSIStrategy(BaseStrategy):
@@ -28,14 +31,67 @@ class RSIStrategy(BaseStrategy):
         self.rsi_period = self.params.rsi_period
         self.rsi_upper = self.params.rsi_upper
         self.rsi_lower = self.params.rsi_lower
-        print("===Strategy level arguments===")
-        print("rsi_period :", self.rsi_period)
-        print("rsi_upper :", self.rsi_upper)
-        print("rsi_lower :", self.rsi_lower)
+        if not self.silent:
+            print("===Strategy level arguments===")
+            print("rsi_period :", self.rsi_period)
+            print("rsi_upper :", self.rsi_upper)
+            print("rsi_lower :", self.rsi_lower)
+        if self.precomputed:
+            # the signals are given, no indicator to compute
+            return
         self.rsi = bt.indicators.RelativeStrengthIndex(period=self.rsi_period)
 
+    @classmethod
+    def get_param_space(cls, data):
+        return ParamSpace(
+            dict(
+                rsi_period=(2, max(min(30, len(data) // 4), 2)),
+                rsi_lower=(10, 45),
+                rsi_upper=(55, 90),
+            ),
+            log_scale=['rsi_period']
+        )
+
+    @classmethod
+    def get_signals(cls, indicators, params_list):
+        params_list = cls.get_params_dicts(params_list)
+        rsi = indicators.rsi([p['rsi_period'] for p in params_list])
+        rsi_lower = np.array([p['rsi_lower'] for p in params_list])
+        rsi_upper = np.array([p['rsi_upper'] for p in params_list])
+
+        return rsi < rsi_lower, rsi > rsi_upper
+
+    @classmethod
+    def get_signal_state(cls, indicators, params_list):
+        return RSISignalState(indicators, cls.get_params_dicts(params_list))
+
     def buy_signal(self):
         return self.rsi[0] < self.rsi_lower
 
     def sell_signal(self):
-        return self.rsi[0] > self.rsi_upper
\ No newline at end of file
+        return self.rsi[0] > self.rsi_upper
+
+
+class RSISignalState(SignalState):
+    """
+    Signal state of `RSIStrategy`: the last close and the smoothed up and down moves.
+    """
+
+    def __init__(self, indicators, params_list):
+        buy_signal, sell_signal = RSIStrategy.get_signals(indicators, params_list)
+        super().__init__(params_list, len(indicators.close), buy_signal[-1], sell_signal[-1])
+        rsi_periods = [p['rsi_period'] for p in params_list]
+        periods = sorted(set(rsi_periods))
+        self.columns = [periods.index(p) for p in rsi_periods]
+        self.rsi_lower = np.array([p['rsi_lower'] for p in params_list])
+        self.rsi_upper = np.array([p['rsi_upper'] for p in params_list])
+        self.rsi = StreamingRSI(indicators.close, periods)
+
+    @property
+    def warm(self):
+        return self.rsi.warm
+
+    def next(self, close):
+        rsi = self.rsi.update(close)[self.columns]
+
+        return rsi < self.rsi_lower, rsi > self.rsi_upper
@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+import itertools
+
+import numpy as np
+
+
+class ParamSpace(object):
+    """
+    Integer parameter space of a strategy: an inclusive range per param and
+    the relations the params must satisfy, e.g. fast period < slow period.
+    Periods are better searched on a log scale: the small values are covered as densely
+    as the large ones relative to their size, the steps of these params are relative.
+    Attributes:
+        ranges(dict): param name -> (low, high), inclusive.
+        less_than(list): (name, other) pairs, `params[name] < params[other]`.
+        fixed(dict): params set to the same value in every param set.
+        log_scale(list): params searched on a log scale.
+    """
+
+    def __init__(self, ranges, less_than=None, fixed=None, log_scale=None):
+        self.ranges = {name: (int(low), int(high)) for name, (low, high) in ranges.items()}
+        self.less_than = list(less_than or [])
+        self.fixed = dict(fixed or {})
+        self.log_scale = set(log_scale or [])
+
+    @property
+    def names(self):
+        return list(self.ranges)
+
+    def is_valid(self, params):
+        """
+        :param params(dict): one param set.
+        :return: bool
+        """
+        for name, (low, high) in self.ranges.items():
+            if not low <= params[name] <= high:
+                return False
+
+        return all(params[name] < params[other] for name, other in self.less_than)
+
+    def _param_sets(self, values):
+        param_sets = []
+        for combination in itertools.product(*(values[name] for name in self.names)):
+            params = dict(zip(self.names, combination), **self.fixed)
+            if self.is_valid(params):
+                param_sets.append(params)
+
+        return param_sets
+
+    def _step(self, name, value, step):
+        # absolute step of a param at `value`, the steps of log scale params are relative
+        if name in self.log_scale:
+            return max(int(round(value * step)), 1)
+        return max(int(round(step)), 1)
+
+    def coarse_steps(self, points):
+        """
+        Steps of a grid with about `points` values per param.
+        :param points(int): values per param.
+        :return: dict(param name -> step), relative for the log scale params.
+        """
+        steps = {}
+        for name, (low, high) in self.ranges.items():
+            if name in self.log_scale:
+                steps[name] = (high / max(low, 1)) ** (1.0 / max(points - 1, 1)) - 1.0
+            else:
+                steps[name] = max((high - low) / max(points - 1, 1), 1.0)
+
+        return steps
+
+    def is_fine(self, steps, params):
+        """
+        Whether every step is down to 1 around `params`.
+        :param steps(dict): param name -> step.
+        :param params(dict): param set.
+        :return: bool
+        """
+        return all(self._step(name, params[name], steps[name]) <= 1 and
+                   (name in self.log_scale or steps[name] <= 1) for name in self.names)
+
+    def grid(self, steps):
+        """
+        Regular grid of the space, geometric for the log scale params.
+        :param steps(dict): param name -> step, relative for the log scale params.
+        :return: list(dict)
+        """
+        values = {}
+        for name, (low, high) in self.ranges.items():
+            name_values = [low]
+            while name_values[-1] < high:
+                name_values.append(min(name_values[-1] + self._step(name, name_values[-1], steps[name]), high))
+            values[name] = name_values
+
+        return self._param_sets(values)
+
+    def neighbours(self, params, steps):
+        """
+        Param sets one step around `params`: every combination for up to 3 params,
+        one param moved at a time above that.
+        :param params(dict): center param set.
+        :param steps(dict): param name -> step, relative for the log scale params.
+        :return: list(dict)
+        """
+        moves = {}
+        for name, (low, high) in self.ranges.items():
+            center = params[name]
+            step = self._step(name, center, steps[name])
+            moves[name] = sorted({min(max(center + d * step, low), high) for d in (-1, 0, 1)})
+
+        if len(self.names) <= 3:
+            return self._param_sets(moves)
+
+        center = {name: params[name] for name in self.names}
+        param_sets = [dict(center, **self.fixed)]
+        for name in self.names:
+            for value in moves[name]:
+                if value != center[name]:
+                    params = dict(center, **self.fixed)
+                    params[name] = value
+                    if self.is_valid(params):
+                        param_sets.append(params)
+
+        return param_sets
+
+    def sample(self, rng, n, max_tries=100):
+        """
+        Random valid param sets, uniform over the ranges, log-uniform for the log scale params.
+        :param rng(Generator): numpy random generator.
+        :param n(int): number of param sets.
+        :param max_tries(int): draws of `n` candidates before giving up on constrained spaces.
+        :return: list(dict)
+        """
+        param_sets = []
+        for _ in range(max_tries):
+            draws = {}
+            for name, (low, high) in self.ranges.items():
+                if name in self.log_scale:
+                    draw = np.exp(rng.uniform(np.log(max(low, 1)), np.log(high + 1), size=n))
+                    draws[name] = np.clip(np.floor(draw).astype(np.int64), low, high)
+                else:
+                    draws[name] = rng.integers(low, high + 1, size=n)
+            for i in range(n):
+                params = dict({name: int(draws[name][i]) for name in self.names}, **self.fixed)
+                if self.is_valid(params):
+                    param_sets.append(params)
+                    if len(param_sets) == n:
+                        return param_sets
+
+        return param_sets
+
+    def size(self):
+        """
+        :return: number of points of the full space, constraints ignored(int)
+        """
+        return int(np.prod([high - low + 1 for low, high in self.ranges.values()]))
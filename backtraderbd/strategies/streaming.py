@@ -0,0 +1,262 @@
+# -*- coding: utf-8 -*-
+import math
+from fractions import Fraction
+
+import numpy as np
+
+from backtraderbd.strategies.indicators import BatchIndicators
+from backtraderbd.libs.log import get_logger
+
+logger = get_logger(__name__)
+
+
+class StreamingSMA(object):
+    """
+    Simple moving averages updated bar by bar in O(1): the window sums are kept exact,
+    so the values match `BatchIndicators.sma` (and `bt.ind.SMA`) bar for bar.
+    Attributes:
+        periods(list): SMA periods, one column per period.
+    """
+
+    def __init__(self, data, periods):
+        self.periods = list(periods)
+        data = np.asarray(data, dtype=np.float64)
+        size = max(self.periods, default=1)
+        # the values leaving the windows
+        self.tail = data[-size:].tolist()
+        self.size = size
+        self.bars = len(data)
+        self.exact = bool(np.isfinite(data[-size:]).all())
+        self.sums = [Fraction(0)] * len(self.periods)
+        if self.exact:
+            # every window sum from a single pass over the tail, the smallest period first
+            order = sorted(range(len(self.periods)), key=lambda j: self.periods[j])
+            total, start = Fraction(0), len(self.tail)
+            for j in order:
+                stop = max(len(self.tail) - self.periods[j], 0)
+                total += sum((Fraction(x) for x in self.tail[stop:start]), Fraction(0))
+                start = stop
+                self.sums[j] = total
+        self.value = self._value()
+
+    def _value(self):
+        value = np.full(len(self.periods), np.nan)
+        for j, period in enumerate(self.periods):
+            if self.bars < period:
+                continue
+            if self.exact:
+                value[j] = float(self.sums[j]) / float(period)
+            else:
+                value[j] = math.fsum(self.tail[-period:]) / period
+        return value
+
+    def update(self, x):
+        """
+        :param x(float): value of the new bar.
+        :return: sma of each period(ndarray)
+        """
+        x = float(x)
+        if self.exact and not math.isfinite(x):
+            # nan/inf can not be summed exactly, the windows are summed with fsum from now on
+            self.exact = False
+        if self.exact:
+            new = Fraction(x)
+            for j, period in enumerate(self.periods):
+                if self.bars >= period:
+                    self.sums[j] += new - Fraction(self.tail[-period])
+                else:
+                    self.sums[j] += new
+        self.tail.append(x)
+        if len(self.tail) > self.size:
+            del self.tail[0]
+        self.bars += 1
+        self.value = self._value()
+
+        return self.value
+
+
+class StreamingSmoothing(object):
+    """
+    Exponential smoothing (EMA, SMMA) resumed from its last values,
+    runs the float operations of `BatchIndicators.smoothing`.
+    Attributes:
+        value(ndarray): last smoothed value of each column, nan while not seeded.
+        alpha(ndarray): smoothing factor of each column.
+    """
+
+    def __init__(self, value, alphas):
+        self.value = np.array(value, dtype=np.float64)
+        self.alpha = np.asarray(alphas, dtype=np.float64)
+        self.alpha1 = 1.0 - self.alpha
+
+    @classmethod
+    def ema(cls, value, periods):
+        return cls(value, [2.0 / (1.0 + period) for period in periods])
+
+    @classmethod
+    def smma(cls, value, periods):
+        return cls(value, [1.0 / period for period in periods])
+
+    @property
+    def warm(self):
+        # the seed (mean of the first values) is only known from the whole history
+        return bool(np.isfinite(self.value).all())
+
+    def update(self, x):
+        """
+        :param x(float or ndarray): new value, shared or one per column.
+        :return: smoothed values(ndarray)
+        """
+        self.value = self.value * self.alpha1 + x * self.alpha
+        return self.value
+
+
+class StreamingRSI(object):
+    """
+    Relative strength index updated bar by bar, same values as `BatchIndicators.rsi`.
+    Attributes:
+        periods(list): RSI periods.
+    """
+
+    def __init__(self, data, periods):
+        data = np.asarray(data, dtype=np.float64)
+        self.periods = list(periods)
+        self.close = data[-1] if len(data) else np.nan
+        diff = np.full(len(data), np.nan)
+        diff[1:] = data[1:] - data[:-1]
+        upday = np.maximum(diff, 0.0)
+        downday = np.full(len(data), np.nan)
+        downday[1:] = np.maximum(data[:-1] - data[1:], 0.0)
+        self.maup = StreamingSmoothing.smma(self._last(BatchIndicators.smma(upday, periods, first=1)), periods)
+        self.madown = StreamingSmoothing.smma(self._last(BatchIndicators.smma(downday, periods, first=1)), periods)
+        self.value = self._value()
+
+    @classmethod
+    def _last(cls, values):
+        return values[-1] if len(values) else np.full(values.shape[1], np.nan)
+
+    @property
+    def warm(self):
+        return self.maup.warm and self.madown.warm
+
+    def _value(self):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            rs = self.maup.value / self.madown.value
+            return 100.0 - 100.0 / (1.0 + rs)
+
+    def update(self, x):
+        """
+        :param x(float): close of the new bar.
+        :return: rsi of each period(ndarray)
+        """
+        self.maup.update(max(x - self.close, 0.0))
+        self.madown.update(max(self.close - x, 0.0))
+        self.close = x
+        self.value = self._value()
+
+        return self.value
+
+
+class StreamingCrossOver(object):
+    """
+    Cross over of two lines resumed from the last non zero difference,
+    same as `BatchIndicators.crossover` once both lines are valid.
+    Attributes:
+        nzd(ndarray): last non zero difference of each column.
+    """
+
+    def __init__(self, data0, data1):
+        data0, data1 = np.broadcast_arrays(np.asarray(data0, dtype=np.float64),
+                                           np.asarray(data1, dtype=np.float64))
+        if data0.ndim == 1:
+            data0, data1 = data0[:, None], data1[:, None]
+        diff = data0 - data1
+
+        # the first valid difference seeds the non zero difference, as in the batch version
+        valid = ~np.isnan(diff)
+        index = np.arange(len(diff))[:, None]
+        start = np.where(valid.any(axis=0), valid.argmax(axis=0), len(diff))
+        keep = (diff != 0.0) | (index == start) | ~valid
+        if not len(diff):
+            self.nzd = np.full(diff.shape[1], np.nan)
+            return
+        last = len(diff) - 1 - keep[::-1].argmax(axis=0)
+        self.nzd = np.take_along_axis(diff, last[None], axis=0)[0]
+
+    @property
+    def warm(self):
+        return bool(np.isfinite(self.nzd).all())
+
+    def update(self, data0, data1):
+        """
+        :param data0(ndarray): first line(s) on the new bar.
+        :param data1(ndarray): second line(s) on the new bar.
+        :return: crossover(ndarray): 1.0 up, -1.0 down, 0.0 none.
+        """
+        up = (self.nzd < 0.0) & (data0 > data1)
+        down = (self.nzd > 0.0) & (data0 < data1)
+        diff = data0 - data1
+        self.nzd = np.where(diff != 0.0, diff, self.nzd)
+
+        return up.astype(np.float64) - down.astype(np.float64)
+
+
+class SignalState(object):
+    """
+    Resumable state of the `get_signals` of a strategy at the end of the history:
+    `update` computes the signals of one appended bar in O(1) for every param set.
+    Built with `Strategy.get_signal_state(indicators, params_list)`.
+    Attributes:
+        params_list(list): param sets of the columns.
+        bars(int): bars seen.
+        buy_signal(ndarray): buy signal of the last bar, one per param set.
+        sell_signal(ndarray): sell signal of the last bar, one per param set.
+    """
+
+    def __init__(self, params_list, bars, buy_signal, sell_signal):
+        self.params_list = list(params_list)
+        self.bars = bars
+        self.buy_signal = np.asarray(buy_signal, dtype=bool)
+        self.sell_signal = np.asarray(sell_signal, dtype=bool)
+
+    @property
+    def warm(self):
+        """
+        :return: whether every indicator is seeded, a state not warm yet can not be resumed(bool)
+        """
+        return True
+
+    def next(self, close):
+        """
+        Signals of the new bar, subclasses implement it.
+        :param close(float): close of the new bar.
+        :return: buy and sell signals(tuple of ndarray)
+        """
+        raise NotImplementedError
+
+    def update(self, close):
+        """
+        Append one bar.
+        :param close(float): close of the new bar.
+        :return: buy and sell signals of the new bar(tuple of ndarray)
+        """
+        buy_signal, sell_signal = self.next(float(close))
+        self.buy_signal = np.asarray(buy_signal, dtype=bool)
+        self.sell_signal = np.asarray(sell_signal, dtype=bool)
+        self.bars += 1
+
+        return self.buy_signal, self.sell_signal
+
+    def run(self, close):
+        """
+        Append several bars.
+        :param close(array): closes of the new bars.
+        :return: buy and sell signals(tuple of ndarray), shape (new bars, param sets).
+        """
+        n_sets = len(self.params_list)
+        buy_signal = np.zeros((len(close), n_sets), dtype=bool)
+        sell_signal = np.zeros((len(close), n_sets), dtype=bool)
+        for t, x in enumerate(np.asarray(close, dtype=np.float64)):
+            buy_signal[t], sell_signal[t] = self.update(x)
+
+        return buy_signal, sell_signal
@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 import math
+import logging
 
 import pandas as pd
 
@@ -28,6 +29,50 @@ class Utils(object):
 
         return data.iloc[:train_rows], data.iloc[-test_rows:]
 
+    @classmethod
+    def get_walk_forward_bounds(cls, rows, train_rows, test_rows, anchored=False, step=None):
+        """
+        Bounds of the walk forward windows: train on `train_rows` bars, test on the next `test_rows` bars,
+        then move forward by `step` bars. Anchored windows always train from the first bar.
+        :param rows(int): number of bars of the data.
+        :param train_rows(int or float): bars of the (first) training window, a float is a percent of the data.
+        :param test_rows(int or float): bars of each testing window, a float is a percent of the data.
+        :param anchored(bool): anchored (growing) instead of rolling training windows.
+        :param step(int): bars between two windows, default `test_rows`.
+        :return: list of ((train start, train end), (test start, test end)), ends excluded.
+        """
+
+        if isinstance(train_rows, float):
+            train_rows = math.floor(rows * train_rows)
+        if isinstance(test_rows, float):
+            test_rows = math.floor(rows * test_rows)
+        step = step or test_rows
+        if train_rows <= 0 or test_rows <= 0:
+            raise ValueError(f'walk forward windows need bars, train: {train_rows}, test: {test_rows}')
+
+        bounds = []
+        test_start = train_rows
+        while test_start + test_rows <= rows:
+            train_start = 0 if anchored else test_start - train_rows
+            bounds.append(((train_start, test_start), (test_start, test_start + test_rows)))
+            test_start += step
+
+        return bounds
+
+    @classmethod
+    def split_walk_forward(cls, data, train_rows, test_rows, anchored=False, step=None):
+        """
+        Split the data into walk forward windows, see `get_walk_forward_bounds`.
+        :param data(DataFrame): data to be split.
+        :return: list of (training data(DataFrame), testing data(DataFrame))
+        """
+
+        return [
+            (data.iloc[train_start:train_end], data.iloc[test_start:test_end])
+            for (train_start, train_end), (test_start, test_end)
+            in cls.get_walk_forward_bounds(len(data), train_rows, test_rows, anchored, step)
+        ]
+
     @classmethod
     def log(cls, txt, dt=None):
         """
@@ -36,7 +81,9 @@ class Utils(object):
         :param dt(datetime): datetime for bar.
         :return: None
         """
-        logger.debug('%s, %s' % (dt.isoformat(), txt))
+        # formatted only if the record is emitted
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('%s, %s', dt.isoformat() if dt is not None else '-', txt)
 
     @classmethod
     def get_best_params(cls, al_results):
@@ -61,14 +108,92 @@ class Utils(object):
         :return: None
         """
 
+        cls.write_daily_alerts(symbol, [dict(stock=stock_id, action=action)])
+
+    @classmethod
+    def write_daily_alerts(cls, symbol, alerts):
+        """
+        write many daily stock alerts to MongoDB in one append.
+        :param symbol: Arctic symbol
+        :param alerts: list of dict, like: [{'stock': '000651', 'action': 'buy/sell'}]
+        :return: None
+        """
+
+        if not alerts:
+            return
+
         lib = get_or_create_library(conf.DAILY_STOCK_ALERT_LIBNAME)
 
-        data = {
-            'stock': stock_id,
-            'action': action
-        }
-        df = pd.DataFrame([data], columns=data.keys())
-        if symbol in lib.list_symbols():
+        df = pd.DataFrame(alerts, columns=['stock', 'action'])
+        if lib.has_symbol(symbol):
             lib.append(symbol, df)
         else:
             lib.write(symbol, df)
+
+    @classmethod
+    def compact_daily_alert(cls, symbol=None):
+        """
+        Rewrite fragmented alert symbols (many small appends) in one write, so they are read in one piece.
+        :param symbol: Arctic symbol, None compacts all the alert symbols.
+        :return: None
+        """
+
+        lib = get_or_create_library(conf.DAILY_STOCK_ALERT_LIBNAME)
+        symbols = [symbol] if symbol is not None else lib.list_symbols()
+
+        for symbol in symbols:
+            data = lib.read(symbol).data.reset_index(drop=True)
+            lib.write(symbol, data, prune_previous_version=True)
+            logger.debug(f'compacted alert symbol: {symbol}, {len(data)} alerts.')
+
+
+class AlertWriter(object):
+    """
+    Collect the daily stock alerts of a scan and write them with one append per strategy symbol.
+    Use it as a context manager to flush on exit.
+    """
+
+    def __init__(self):
+        self._alerts = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        try:
+            self.flush()
+        except Exception:
+            if exc_type is None:
+                raise
+            # already logged, the error of the block is raised
+
+    def add(self, symbol, stock_id, action):
+        """
+        :param symbol: Arctic symbol, e.g. the strategy name
+        :param stock_id: str, stock id
+        :param action: str, 'buy' or 'sell'
+        :return: None
+        """
+
+        self._alerts.setdefault(symbol, []).append(dict(stock=stock_id, action=action))
+
+    def flush(self):
+        """
+        write the collected alerts, one symbol failing does not stop the others:
+        its alerts are kept for the next flush and the first error is raised once all the symbols were tried.
+        :return: None
+        """
+
+        alerts, self._alerts = self._alerts, {}
+        error = None
+        for symbol, symbol_alerts in alerts.items():
+            try:
+                Utils.write_daily_alerts(symbol, symbol_alerts)
+            except Exception as e:
+                logger.error(f'write {len(symbol_alerts)} alerts of symbol {symbol} failed: {e}', exc_info=True)
+                # kept ahead of the alerts added since
+                self._alerts[symbol] = symbol_alerts + self._alerts.get(symbol, [])
+                error = error or e
+
+        if error is not None:
+            raise error
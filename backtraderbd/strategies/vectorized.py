@@ -0,0 +1,449 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+
+from backtraderbd.settings import settings as conf
+from backtraderbd.libs.log import get_logger
+
+logger = get_logger(__name__)
+
+# BaseStrategy adds this allowance to the commission when sizing a buy (avoid margin)
+COMMISSION_ALLOWANCE = 0.001
+
+
+class EngineState(object):
+    """
+    State of a vectorized simulation on its last bar, `VectorizedBacktest.run` resumes from it
+    when bars are appended to the time serials. Every array has one item per param set.
+    Attributes:
+        cash(ndarray): broker cash on the last bar.
+        position(ndarray): position size on the last bar.
+        pprice(ndarray): position price on the last bar.
+        close(float): close of the last bar.
+        open(float): open of the last bar.
+        buy_signal(ndarray): buy signal of the last bar, its orders are only created on resume.
+        sell_signal(ndarray): sell signal of the last bar.
+        value(ndarray): portfolio value on the last bar.
+        peak(ndarray): highest value so far.
+        max_drawdown(ndarray): max draw down so far, in percent.
+        max_drawdown_period(ndarray): longest draw down streak so far, in bars.
+        streak(ndarray): running draw down streak on the last bar.
+        init_cash(float): starting cash of the broker.
+    """
+
+    def __init__(self, cash, position, pprice, close, open, buy_signal, sell_signal,
+                 value, peak, max_drawdown, max_drawdown_period, streak, init_cash):
+        self.cash = cash
+        self.position = position
+        self.pprice = pprice
+        self.close = close
+        self.open = open
+        self.buy_signal = buy_signal
+        self.sell_signal = sell_signal
+        self.value = value
+        self.peak = peak
+        self.max_drawdown = max_drawdown
+        self.max_drawdown_period = max_drawdown_period
+        self.streak = streak
+        self.init_cash = init_cash
+
+    def get_analysis(self):
+        """
+        Get the analysis data of the simulation up to the last bar.
+        :return: list(dict), one item per param set.
+        """
+        total_return_rate = self.value / self.init_cash - 1.0
+
+        return [
+            dict(
+                total_return_rate=float(total_return_rate[i]),
+                max_drawdown=float(self.max_drawdown[i]),
+                max_drawdown_period=int(self.max_drawdown_period[i])
+            )
+            for i in range(len(self.value))
+        ]
+
+
+class SimulationResult(object):
+    """
+    Output of one vectorized simulation, every array is shaped (bars, param sets).
+    Attributes:
+        cash(ndarray): broker cash at the end of each bar.
+        position(ndarray): position size at the end of each bar.
+        value(ndarray): portfolio value (equity curve) at the end of each bar.
+        buy_size(ndarray): executed buy size on each bar, 0 when nothing was bought.
+        buy_price(ndarray): execution price of the buy, nan when nothing was bought.
+        sell_size(ndarray): executed sell size on each bar, 0 when nothing was sold.
+        sell_price(ndarray): execution price of the sell, nan when nothing was sold.
+        commission(ndarray): commission paid on each bar.
+        init_cash(float): starting cash of the broker.
+        prior(EngineState): state the simulation was resumed from, None from the first bar.
+        last_bar(dict): broker, prices and signals of the last bar, set by `VectorizedBacktest.run`.
+    """
+
+    def __init__(self, cash, position, value, buy_size, buy_price,
+                 sell_size, sell_price, commission, init_cash, prior=None):
+        self.cash = cash
+        self.position = position
+        self.value = value
+        self.buy_size = buy_size
+        self.buy_price = buy_price
+        self.sell_size = sell_size
+        self.sell_price = sell_price
+        self.commission = commission
+        self.init_cash = init_cash
+        self.prior = prior
+        self.last_bar = None
+
+    @property
+    def total_return_rate(self):
+        """
+        Same figure as the `TimeReturn` analyzer with `NoTimeFrame`.
+        :return: total return rate of each param set(ndarray).
+        """
+        return self.value[-1] / self.init_cash - 1.0
+
+    @property
+    def peak(self):
+        """
+        :return: highest value so far on each bar(ndarray).
+        """
+        peak = np.maximum.accumulate(self.value, axis=0)
+        if self.prior is not None:
+            peak = np.maximum(peak, self.prior.peak)
+        return peak
+
+    @property
+    def max_drawdown(self):
+        """
+        Same figure as `TimeDrawDown` 'maxdrawdown', in percent.
+        :return: max draw down of each param set(ndarray).
+        """
+        peak = self.peak
+        max_drawdown = (100.0 * (peak - self.value) / peak).max(axis=0)
+        if self.prior is not None:
+            max_drawdown = np.maximum(max_drawdown, self.prior.max_drawdown)
+        return max_drawdown
+
+    def _streak(self):
+        # length of the running streak: bars since the last bar not in draw down
+        in_drawdown = self.peak > self.value
+        idx = np.arange(len(self.value))[:, None]
+        # a streak running on the last bar of the prior simulation goes on
+        start = -1 if self.prior is None else -1 - self.prior.streak
+        last_reset = np.maximum.accumulate(np.where(in_drawdown, start, idx), axis=0)
+        return np.where(in_drawdown, idx - last_reset, 0)
+
+    @property
+    def max_drawdown_period(self):
+        """
+        Same figure as `TimeDrawDown` 'maxdrawdownperiod', in bars.
+        :return: longest draw down streak of each param set(ndarray).
+        """
+        max_drawdown_period = self._streak().max(axis=0)
+        if self.prior is not None:
+            max_drawdown_period = np.maximum(max_drawdown_period, self.prior.max_drawdown_period)
+        return max_drawdown_period
+
+    @property
+    def state(self):
+        """
+        :return: state on the last bar, resumes the simulation on the next bars(EngineState)
+        """
+        if self.last_bar is None:
+            # no new bar
+            return self.prior
+
+        return EngineState(
+            value=self.value[-1].copy(),
+            peak=self.peak[-1],
+            max_drawdown=self.max_drawdown,
+            max_drawdown_period=self.max_drawdown_period,
+            streak=self._streak()[-1],
+            init_cash=self.init_cash,
+            **self.last_bar
+        )
+
+    def get_analysis(self):
+        """
+        Get the analysis data in the shape `Btask.train_strategy` collects them.
+        :return: list(dict), one item per param set.
+        """
+        total_return_rate = self.total_return_rate
+        max_drawdown = self.max_drawdown
+        max_drawdown_period = self.max_drawdown_period
+
+        return [
+            dict(
+                total_return_rate=float(total_return_rate[i]),
+                max_drawdown=float(max_drawdown[i]),
+                max_drawdown_period=int(max_drawdown_period[i])
+            )
+            for i in range(self.value.shape[1])
+        ]
+
+
+class VectorizedBacktest(object):
+    """
+    NumPy twin of `BaseStrategy.next` running on top of the default backtrader broker.
+    Bars are walked one by one (the cash is path dependent), while every param set is
+    a column of the signal arrays, so thousands of param sets are simulated by the same
+    array operations.
+    Attributes:
+        cash(float): starting cash of the broker.
+        commission(float): broker commission, `Btask.run_back_testing` sets
+            `COMMISSION_PER_TRANSACTION`, `Btask.train_strategy` keeps the broker default 0.
+        buy_prop(float): same as `BUY_PROP`.
+        sell_prop(float): same as `SELL_PROP`.
+        execution_type(string): same as `EXECUTION_TYPE`, 'close' or 'open'.
+    """
+
+    def __init__(self, cash=None, commission=None, buy_prop=None, sell_prop=None,
+                 execution_type=None):
+        self.cash = conf.DEFAULT_CASH if cash is None else cash
+        self.commission = conf.COMMISSION_PER_TRANSACTION if commission is None else commission
+        self.buy_prop = conf.BUY_PROP if buy_prop is None else buy_prop
+        self.sell_prop = conf.SELL_PROP if sell_prop is None else sell_prop
+        self.execution_type = conf.EXECUTION_TYPE if execution_type is None else execution_type
+
+    def run(self, close, buy_signal, sell_signal, open=None, state=None):
+        """
+        Simulate the orders `BaseStrategy.next` would create for the given signals.
+        :param close(array): close prices, shape (bars,).
+        :param buy_signal(array): bool, shape (bars,) or (bars, param sets),
+            must be False while the strategy is still in its warm up period.
+        :param sell_signal(array): bool, same shape rules as `buy_signal`.
+        :param open(array): open prices, shape (bars,), needed by the market orders.
+        :param state(EngineState): state of a previous run, the bars are then the ones appended since.
+        :return: SimulationResult, its `state` resumes the simulation on the next bars.
+        """
+        close = np.asarray(close, dtype=np.float64)
+        open_ = close if open is None else np.asarray(open, dtype=np.float64)
+        buy_signal = np.asarray(buy_signal, dtype=bool)
+        sell_signal = np.asarray(sell_signal, dtype=bool)
+        if buy_signal.ndim == 1:
+            buy_signal = buy_signal[:, None]
+        if sell_signal.ndim == 1:
+            sell_signal = sell_signal[:, None]
+        if state is not None:
+            # replay the last bar of the previous run: its orders were skipped as it was the last one
+            close = np.concatenate([[state.close], close])
+            open_ = np.concatenate([[state.open], open_])
+            buy_signal = np.vstack([np.broadcast_to(state.buy_signal, (1, buy_signal.shape[1])), buy_signal])
+            sell_signal = np.vstack([np.broadcast_to(state.sell_signal, (1, sell_signal.shape[1])), sell_signal])
+
+        n_bars = len(close)
+        n_sets = max(buy_signal.shape[1], sell_signal.shape[1])
+        buy_signal = np.broadcast_to(buy_signal, (n_bars, n_sets))
+        sell_signal = np.broadcast_to(sell_signal, (n_bars, n_sets))
+
+        out_cash = np.empty((n_bars, n_sets))
+        out_position = np.empty((n_bars, n_sets), dtype=np.int64)
+        out_value = np.empty((n_bars, n_sets))
+        out_buy_size = np.zeros((n_bars, n_sets), dtype=np.int64)
+        out_buy_price = np.full((n_bars, n_sets), np.nan)
+        out_sell_size = np.zeros((n_bars, n_sets), dtype=np.int64)
+        out_sell_price = np.full((n_bars, n_sets), np.nan)
+        out_commission = np.zeros((n_bars, n_sets))
+
+        cash = np.full(n_sets, float(self.cash))
+        position = np.zeros(n_sets, dtype=np.int64)
+        pprice = np.zeros(n_sets)
+        if state is not None:
+            cash[:], position[:], pprice[:] = state.cash, state.position, state.pprice
+        pending_buy = np.zeros(n_sets, dtype=np.int64)
+        pending_sell = np.zeros(n_sets, dtype=np.int64)
+        sizing = close * (1 + conf.COMMISSION_PER_TRANSACTION + COMMISSION_ALLOWANCE)
+        sell_at_close = self.execution_type == 'close'
+
+        for t in range(n_bars):
+            if t > 0 and (pending_buy.any() or pending_sell.any()):
+                # only the param sets with pending orders go through the broker
+                idx = np.flatnonzero(pending_buy | pending_sell)
+                sub_cash, sub_position, sub_pprice = cash[idx], position[idx], pprice[idx]
+
+                # broker checks the submitted orders against the creation price first
+                buy_ok, sell_ok = self._check_submitted(
+                    sub_cash, sub_position, sub_pprice, pending_buy[idx], pending_sell[idx],
+                    close[t - 1])
+
+                # market buy is filled at the open
+                size = np.where(buy_ok, pending_buy[idx], 0)
+                sub_cash, sub_position, sub_pprice, filled, comm = self._execute(
+                    sub_cash, sub_position, sub_pprice, size, open_[t])
+                out_buy_size[t, idx] = filled
+                out_buy_price[t, idx] = np.where(filled != 0, open_[t], np.nan)
+                out_commission[t, idx] += comm
+
+                # sell is filled at the close (exectype Close) or at the open (market)
+                sell_price = close[t] if sell_at_close else open_[t]
+                size = np.where(sell_ok, -pending_sell[idx], 0)
+                sub_cash, sub_position, sub_pprice, filled, comm = self._execute(
+                    sub_cash, sub_position, sub_pprice, size, sell_price)
+                out_sell_size[t, idx] = -filled
+                out_sell_price[t, idx] = np.where(filled != 0, sell_price, np.nan)
+                out_commission[t, idx] += comm
+
+                cash[idx], position[idx], pprice[idx] = sub_cash, sub_position, sub_pprice
+                pending_buy[:] = 0
+                pending_sell[:] = 0
+
+            value = self._get_value(cash, position, pprice, close[t])
+            out_cash[t] = cash
+            out_position[t] = position
+            out_value[t] = value
+
+            # Skip the last observation since purchases are based on next day prices,
+            # `BaseStrategy.len_data` counts one more item than there are bars
+            if t + 1 >= n_bars:
+                continue
+
+            # Only buy if there is enough cash for at least one stock
+            can_buy = (cash >= close[t]) & buy_signal[t]
+            if can_buy.any():
+                afforded_size = self._trunc(cash / sizing[t])
+                buy_prop_size = self._trunc(afforded_size * self.buy_prop)
+                if self.execution_type != 'close':
+                    afforded_size = self._trunc(
+                        cash / (open_[t + 1] * (1 + conf.COMMISSION_PER_TRANSACTION + COMMISSION_ALLOWANCE)))
+                pending_buy = np.where(can_buy, np.minimum(buy_prop_size, afforded_size), 0)
+
+            # Only sell if you hold least one unit of the stock
+            stock_value = value - cash
+            can_sell = (stock_value > 0) & sell_signal[t]
+            if can_sell.any():
+                if self.execution_type == 'close':
+                    if self.sell_prop == 1:
+                        sell_size = position
+                    else:
+                        sell_size = self._trunc((stock_value / close[t + 1]) * self.sell_prop)
+                else:
+                    sell_size = np.full(
+                        n_sets, self._trunc(np.float64(self.cash / open_[t + 1] * self.sell_prop)))
+                pending_sell = np.where(can_sell, sell_size, 0)
+
+        # the replayed bar belongs to the previous run
+        first = 0 if state is None else 1
+        result = SimulationResult(
+            cash=out_cash[first:],
+            position=out_position[first:],
+            value=out_value[first:],
+            buy_size=out_buy_size[first:],
+            buy_price=out_buy_price[first:],
+            sell_size=out_sell_size[first:],
+            sell_price=out_sell_price[first:],
+            commission=out_commission[first:],
+            init_cash=float(self.cash),
+            prior=state
+        )
+        if n_bars > first:
+            result.last_bar = dict(
+                cash=cash.copy(), position=position.copy(), pprice=pprice.copy(), close=close[-1],
+                open=open_[-1], buy_signal=buy_signal[-1].copy(), sell_signal=sell_signal[-1].copy()
+            )
+
+        return result
+
+    @classmethod
+    def _trunc(cls, x):
+        # int() of the strategy, truncate toward zero
+        return np.trunc(x).astype(np.int64)
+
+    @classmethod
+    def _update_position(cls, position, pprice, size, price):
+        """
+        Array version of `bt.Position.update`.
+        :return: new size, new price, opened and closed size(tuple of ndarray)
+        """
+        new_size = position + size
+        flat = new_size == 0
+        from_flat = position == 0
+        # same side: position increased, keep side: position reduced, otherwise reversed
+        same_side = (size > 0) == (position > 0)
+        keep_side = (new_size > 0) == (position > 0)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            average = (pprice * position + size * price) / new_size
+
+        opened = np.where(same_side, size, np.where(keep_side, 0, new_size))
+        closed = np.where(same_side, 0, np.where(keep_side, size, -position))
+        new_price = np.where(same_side, average, np.where(keep_side, pprice, price))
+
+        opened = np.where(from_flat, size, opened)
+        closed = np.where(from_flat, 0, closed)
+        new_price = np.where(from_flat, price, new_price)
+
+        opened = np.where(flat, 0, opened)
+        closed = np.where(flat, size, closed)
+        new_price = np.where(flat, 0.0, new_price)
+
+        return new_size, new_price, opened, closed
+
+    def _cash_after(self, cash, closed, opened, pprice_orig, price):
+        """
+        Cash accounting of `BackBroker._execute` for a stock like asset.
+        :return: cash after the closed part, cash after the opened part(tuple of ndarray)
+        """
+        # "Closing" totally or partially, cash is re-injected
+        closed_cash = cash + ((-closed) * pprice_orig + (-closed) * (price - pprice_orig) * 1.0)
+        closed_cash = closed_cash - np.abs(closed) * self.commission * price
+        cash = np.where(closed != 0, closed_cash, cash)
+
+        opened_cash = cash - opened * price
+        opened_cash = opened_cash - np.abs(opened) * self.commission * price
+        return cash, np.where(opened != 0, opened_cash, cash)
+
+    def _check_submitted(self, cash, position, pprice, pending_buy, pending_sell, price):
+        """
+        Pseudo execution of `BackBroker.check_submitted`, buy first then sell.
+        :return: accepted buy and accepted sell masks(tuple of ndarray)
+        """
+        accepted = []
+        for size in (pending_buy, -pending_sell):
+            active = size != 0
+            new_size, new_price, opened, closed = self._update_position(
+                position, pprice, size, price)
+            _, new_cash = self._cash_after(cash, closed, opened, price, price)
+            cash = np.where(active, new_cash, cash)
+            position = np.where(active, new_size, position)
+            pprice = np.where(active, new_price, pprice)
+            accepted.append(active & (cash >= 0.0))
+
+        return tuple(accepted)
+
+    def _execute(self, cash, position, pprice, size, price):
+        """
+        Real execution of `BackBroker._execute`, the opened part is nullified
+        (order margin) when it would make the cash negative.
+        :return: cash, position, position price, executed size, commission(tuple of ndarray)
+        """
+        active = size != 0
+        _, _, opened, closed = self._update_position(position, pprice, size, price)
+        closed_cash, opened_cash = self._cash_after(cash, closed, opened, pprice, price)
+
+        margin = opened_cash < 0.0
+        opened = np.where(margin, 0, opened)
+        new_cash = np.where(margin, closed_cash, opened_cash)
+        executed = np.where(active, closed + opened, 0)
+        new_size, new_price, _, _ = self._update_position(position, pprice, executed, price)
+
+        moved = executed != 0
+        comm = np.where(moved, np.abs(closed) * self.commission * price
+                        + np.abs(opened) * self.commission * price, 0.0)
+
+        return (
+            np.where(active, new_cash, cash),
+            np.where(moved, new_size, position),
+            np.where(moved, new_price, pprice),
+            executed,
+            comm
+        )
+
+    @classmethod
+    def _get_value(cls, cash, position, pprice, price):
+        """
+        Array version of `BackBroker._get_value` with short cash.
+        :return: portfolio value(ndarray)
+        """
+        dvalue = position * price
+        dunrealized = position * (price - pprice) * 1.0
+        long_value = 0.0 + ((dvalue - dunrealized) / 1.0) + dunrealized
+        return cash + np.where(position > 0, long_value, 0.0 + dvalue)
@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import backtraderbd.data.utils as bdu
+import backtraderbd.strategies.utils as bsu
+from backtraderbd.btask import Btask
+from backtraderbd.data.shared import SharedDataStore, SharedOHLCV
+from backtraderbd.strategies.indicators import IndicatorCache
+from backtraderbd.strategies.vectorized import VectorizedBacktest
+from backtraderbd.settings import settings as conf
+from backtraderbd.libs import profiling
+from backtraderbd.libs.log import get_logger
+
+logger = get_logger(__name__)
+
+
+def evaluate_out_of_sample(Strategy, data, params, start, end):
+    """
+    Back test one param set on the bars [start, end) with the broker of `run_back_testing`,
+    the indicators are warmed up on the bars before `start`.
+    :param Strategy(class): strategy to evaluate.
+    :param data(DataFrame): time serials, at least up to `end`.
+    :param params(dict): strategy params.
+    :param start(int): first bar of the test.
+    :param end(int): bar after the last bar of the test.
+    :return: dict(total_return_rate, max_drawdown, max_drawdown_period)
+    """
+    data = data.iloc[:end]
+    buy_signal, sell_signal = Strategy.get_signals(IndicatorCache(data), [params])
+    result = VectorizedBacktest().run(
+        data['close'].to_numpy()[start:], buy_signal[start:], sell_signal[start:],
+        open=data['open'].to_numpy()[start:]
+    )
+
+    return result.get_analysis()[0]
+
+
+def run_window(Strategy, stock_id, data, train_bounds, test_bounds, Search=None):
+    """
+    Work unit of the walk forward: train on one window, test on the next one.
+    :param Strategy(class): strategy to train.
+    :param stock_id(string): stock id.
+    :param data(DataFrame or SharedOHLCV): time serials of the stock or its shared memory handle.
+    :param train_bounds(tuple): (start, end) bars of the training window.
+    :param test_bounds(tuple): (start, end) bars of the testing window.
+    :param Search(class): param search class, None trains on the `get_strategy_params_list` grid.
+    :return: dict(window dates, params, in_sample and out_of_sample analysis)
+    """
+    with profiling.task('walk_forward_window'):
+        if isinstance(data, SharedOHLCV):
+            data = data.attach()
+        # the float32 prices of the compact schema are widened once for all the back tests
+        data = bdu.Utils.to_numeric(data)
+
+        training_data = data.iloc[train_bounds[0]:train_bounds[1]]
+        if Search is None:
+            params = Btask.train_strategy_vectorized(Strategy, training_data, stock_id)
+        else:
+            params = Search(Strategy).optimize(training_data, stock_id)
+        params = {name: value for name, value in params.items() if name != 'stock_id'}
+
+        return dict(
+            stock_id=stock_id,
+            train_start=data.index[train_bounds[0]],
+            train_end=data.index[train_bounds[1] - 1],
+            test_start=data.index[test_bounds[0]],
+            test_end=data.index[test_bounds[1] - 1],
+            params=params,
+            in_sample=evaluate_out_of_sample(Strategy, data, params, *train_bounds),
+            out_of_sample=evaluate_out_of_sample(Strategy, data, params, *test_bounds),
+        )
+
+
+class WalkForward(object):
+    """
+    Walk forward optimization: the strategy is trained on each window and tested on the next bars.
+    The windows run in a process pool, the data of the stock is loaded once and shared.
+    Attributes:
+        Strategy(class): strategy to train, e.g. SMACStrategy.
+        train_rows(int or float): bars of the (first) training window, a float is a percent of the data.
+        test_rows(int or float): bars of each testing window, a float is a percent of the data.
+        anchored(bool): anchored (growing) instead of rolling training windows.
+        step(int): bars between two windows, default `test_rows`.
+        Search(class): param search class, None trains on the `get_strategy_params_list` grid.
+        workers(int): number of processes, default `TRAINING_WORKERS` or one per cpu.
+    """
+
+    def __init__(self, Strategy, train_rows=0.3, test_rows=0.1, anchored=False, step=None,
+                 Search=None, workers=None):
+        self.Strategy = Strategy
+        self.train_rows = train_rows
+        self.test_rows = test_rows
+        self.anchored = anchored
+        self.step = step
+        self.Search = Search
+        self.workers = workers or conf.TRAINING_WORKERS or os.cpu_count() or 1
+
+    def run(self, stock_id, data=None):
+        """
+        Walk forward over the whole history of the stock.
+        :param stock_id(string): stock id.
+        :param data(DataFrame): time serials, default `Btask.get_data(stock_id)`.
+        :return: list of the windows results, see `run_window`.
+        """
+        if data is None:
+            data = Btask.get_data(stock_id)
+
+        bounds = bsu.Utils.get_walk_forward_bounds(
+            len(data), self.train_rows, self.test_rows, self.anchored, self.step)
+        if not bounds:
+            logger.warning(f'data of stock {stock_id} is too short to walk forward.')
+            return []
+
+        logger.debug(f'walk forward of {self.Strategy.__name__} on stock {stock_id}, {len(bounds)} windows.')
+        if self.workers == 1 or len(bounds) == 1:
+            return [run_window(self.Strategy, stock_id, data, train_bounds, test_bounds, self.Search)
+                    for train_bounds, test_bounds in bounds]
+
+        with SharedDataStore() as store, \
+                ProcessPoolExecutor(max_workers=min(self.workers, len(bounds))) as executor:
+            handle = store.put(stock_id, data)
+            futures = [
+                executor.submit(run_window, self.Strategy, stock_id, handle, train_bounds, test_bounds, self.Search)
+                for train_bounds, test_bounds in bounds
+            ]
+            return [future.result() for future in futures]
+
+    @classmethod
+    def summarize(cls, results):
+        """
+        Chain the out of sample windows.
+        :param results(list): windows results of `run`.
+        :return: dict(windows, total_return_rate, max_drawdown, win_rate)
+        """
+        returns = np.array([r['out_of_sample']['total_return_rate'] for r in results], dtype=np.float64)
+        drawdowns = [r['out_of_sample']['max_drawdown'] for r in results]
+
+        return dict(
+            windows=len(results),
+            total_return_rate=float(np.prod(1.0 + returns) - 1.0) if len(returns) else 0.0,
+            max_drawdown=max(drawdowns, default=0.0),
+            win_rate=float(np.mean(returns > 0)) if len(returns) else 0.0,
+        )
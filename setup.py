@@ -31,6 +31,7 @@ setup_args = dict(
 install_requires = [
     'beautifulsoup4',	
     'requests', 
+    'numpy',
     'pandas',
     'backtrader',
     'bdshare',
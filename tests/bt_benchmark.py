@@ -0,0 +1,511 @@
+# -*- coding: utf-8 -*-
+"""
+Performance benchmark on a synthetic DSE-like universe, no Mongo nor bdshare needed:
+the histories are generated from a fixed seed and stored in an in-process stand-in of the
+Arctic store, so the reports of two commits are comparable.
+
+    python tests/bt_benchmark.py --output before.json
+    python tests/bt_benchmark.py --output after.json --compare before.json
+"""
+import os
+import gc
+import sys
+import json
+import time
+import argparse
+import platform
+import tempfile
+import tracemalloc
+import contextlib
+import subprocess
+import warnings
+warnings.simplefilter(action='ignore', category=FutureWarning)
+
+import numpy as np
+import pandas as pd
+import backtrader as bt
+
+from backtraderbd.settings import settings as conf
+from backtraderbd.libs import models
+from backtraderbd.libs.log import get_logger
+
+logger = get_logger(__name__)
+
+# bump when the phases or the synthetic data change, reports of different versions are not comparable
+BENCHMARK_VERSION = 1
+# new sessions of every stock downloaded by the ingestion phase
+DELTA_BARS = 5
+
+
+class MemoryItem(object):
+
+    def __init__(self, data, version, metadata=None):
+        self.data = data
+        self.version = version
+        self.metadata = metadata
+
+
+class MemoryLibrary(object):
+    """
+    In-process stand-in of an arctic VersionStore library, the reads return a copy like a deserialization.
+    """
+
+    def __init__(self):
+        self._data = {}
+        self._versions = {}
+        self._metadata = {}
+
+    def read(self, symbol, **kwargs):
+        return MemoryItem(self._data[symbol].copy(), self._versions[symbol], self._metadata.get(symbol))
+
+    def read_metadata(self, symbol):
+        return MemoryItem(None, self._versions[symbol], self._metadata.get(symbol))
+
+    def write(self, symbol, data, metadata=None, **kwargs):
+        self._data[symbol] = data.copy()
+        self._metadata[symbol] = metadata
+        self._versions[symbol] = self._versions.get(symbol, 0) + 1
+        return MemoryItem(None, self._versions[symbol], metadata)
+
+    def append(self, symbol, data, metadata=None, **kwargs):
+        if metadata is not None:
+            self._metadata[symbol] = metadata
+        self._data[symbol] = pd.concat([self._data[symbol], data])
+        self._versions[symbol] += 1
+        return MemoryItem(None, self._versions[symbol], self._metadata.get(symbol))
+
+    def has_symbol(self, symbol):
+        return symbol in self._data
+
+    def list_symbols(self):
+        return list(self._data)
+
+    def delete(self, symbol):
+        self._data.pop(symbol, None)
+        self._versions.pop(symbol, None)
+        self._metadata.pop(symbol, None)
+
+
+class MemoryArctic(object):
+    """
+    In-process stand-in of `arctic.Arctic`.
+    """
+
+    def __init__(self, host=None, **kwargs):
+        self._libraries = {}
+
+    def list_libraries(self):
+        return list(self._libraries)
+
+    def initialize_library(self, lib_name, **kwargs):
+        self._libraries.setdefault(lib_name, MemoryLibrary())
+
+    def get_library(self, lib_name):
+        return self._libraries[lib_name]
+
+    def delete_library(self, lib_name):
+        self._libraries.pop(lib_name, None)
+
+    def reset(self):
+        pass
+
+
+class MemorySource(object):
+    """
+    Stand-in of bdshare for the delta ingestion, serves the new sessions of every stock.
+    Attributes:
+        delta(dict): stock id -> new sessions(DataFrame).
+    """
+
+    def __init__(self, delta):
+        self.delta = delta
+
+    def get_basic_hist_data(self, start, end, code, index='date'):
+        data = self.delta[code]
+        data = data[(data.index >= pd.Timestamp(start)) & (data.index <= pd.Timestamp(end))].copy()
+        # dates as strings, like bdshare
+        data.index = data.index.strftime('%Y-%m-%d')
+        data.index.name = index
+        return data
+
+
+def make_delta(rng, stock_ids, bars):
+    """
+    New sessions of the stocks after the end of their synthetic histories.
+    :param rng(Generator): numpy random generator.
+    :param stock_ids(list): stock ids.
+    :param bars(int): new sessions of every stock.
+    :return: dict(stock id -> new sessions(DataFrame))
+    """
+    index = pd.bdate_range(start='2021-01-01', periods=bars, freq='C', weekmask='Sun Mon Tue Wed Thu')
+    delta = {}
+    for stock_id in stock_ids:
+        data = make_history(rng, bars)
+        data.index = index
+        delta[stock_id] = data
+
+    return delta
+
+
+def install_memory_store():
+    """
+    Make `libs.models` connect to the in-process store.
+    :return: None
+    """
+    models.reset_store()
+    models.arctic.Arctic = MemoryArctic
+
+
+def make_history(rng, bars):
+    """
+    Synthetic daily history of one DSE stock: Sunday to Thursday sessions, prices in 0.1 taka ticks,
+    flat stretches of an illiquid stock.
+    :param rng(Generator): numpy random generator.
+    :param bars(int): number of sessions.
+    :return: history(DataFrame), columns: open, high, low, close, volume.
+    """
+    index = pd.bdate_range(end='2020-12-31', periods=bars, freq='C', weekmask='Sun Mon Tue Wed Thu')
+    returns = rng.normal(0.0002, 0.022, bars)
+    # no trade on some sessions, the close does not move
+    returns[rng.random(bars) < 0.05] = 0.0
+    close = np.maximum(np.round(rng.uniform(10, 500) * np.exp(np.cumsum(returns)), 1), 0.1)
+    open_ = np.maximum(np.round(close * np.exp(rng.normal(0, 0.01, bars)), 1), 0.1)
+    high = np.round(np.maximum(open_, close) * (1 + np.abs(rng.normal(0, 0.01, bars))), 1)
+    low = np.maximum(np.round(np.minimum(open_, close) * (1 - np.abs(rng.normal(0, 0.01, bars))), 1), 0.1)
+    volume = rng.integers(0, 500000, bars).astype(np.float64)
+
+    return pd.DataFrame(dict(open=open_, high=high, low=low, close=close, volume=volume), index=index)
+
+
+def make_universe(stocks, bars, seed):
+    """
+    Store the synthetic histories through the ingestion path of `DseHisData`.
+    :param stocks(int): number of stocks.
+    :param bars(int): longest history, the others are shorter like the recent listings.
+    :param seed(int): seed of the data.
+    :return: stock ids(list)
+    """
+    import backtraderbd.data.bdshare as bds
+
+    rng = np.random.default_rng(seed)
+    stock_ids = []
+    for i in range(stocks):
+        stock_id = f'BENCH{i:03d}'
+        length = bars if i % 4 else int(rng.integers(bars // 5, bars))
+        bds.DseHisData(stock_id).write_delta_data(make_history(rng, length))
+        stock_ids.append(stock_id)
+
+    return stock_ids
+
+
+class Benchmark(object):
+    """
+    Run the phases, each one timed `repeat` times (best run kept) then run once more under tracemalloc
+    for its peak memory.
+    Attributes:
+        repeat(int): timed runs of each phase.
+        memory(bool): measure the peak memory of each phase.
+    """
+
+    def __init__(self, repeat=3, memory=True):
+        self.repeat = repeat
+        self.memory = memory
+        self.results = {}
+
+    def run(self, name, phase, bars=0, backtests=0, setup=None):
+        """
+        :param name(string): phase name.
+        :param phase(callable): the timed work.
+        :param bars(int): bars processed by one run of the phase.
+        :param backtests(int): back tests run by one run of the phase.
+        :param setup(callable): called before every run, not timed.
+        :return: None
+        """
+        timings = []
+        try:
+            for _ in range(self.repeat):
+                if setup is not None:
+                    setup()
+                gc.collect()
+                start = time.perf_counter()
+                phase()
+                timings.append(time.perf_counter() - start)
+
+            peak = None
+            if self.memory:
+                if setup is not None:
+                    setup()
+                gc.collect()
+                tracemalloc.start()
+                phase()
+                peak = tracemalloc.get_traced_memory()[1] / 2 ** 20
+                tracemalloc.stop()
+        except Exception as e:
+            tracemalloc.stop()
+            logger.error(f'benchmark phase {name} failed: {e}', exc_info=True)
+            self.results[name] = dict(error=f'{type(e).__name__}: {e}')
+            return
+
+        seconds = min(timings)
+        self.results[name] = dict(
+            seconds=seconds,
+            bars=bars,
+            backtests=backtests,
+            bars_per_sec=bars / seconds if bars and seconds else None,
+            backtests_per_sec=backtests / seconds if backtests and seconds else None,
+            peak_memory_mb=peak,
+        )
+
+
+def get_peak_rss_mb():
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on linux, bytes on macos
+    return peak / 2 ** 20 if sys.platform == 'darwin' else peak / 2 ** 10
+
+
+def get_compact_precision(Strategy, histories, compact_histories):
+    """
+    Compare the back tests of the compact (float32) data with the float64 ones.
+    :param Strategy(class): strategy back tested.
+    :param histories(dict): stock_id -> float64 time serials.
+    :param compact_histories(dict): stock_id -> the same time serials with the compact schema.
+    :return: dict(backtests, max_abs_error, same_best_params, data_bytes, compact_data_bytes)
+    """
+    from backtraderbd.btask import Btask
+
+    max_abs_error, same_best_params, backtests = 0.0, True, 0
+    for stock_id, compact_data in compact_histories.items():
+        data = histories[stock_id]
+        params_list = Btask.get_strategy_params_list(data, stock_id)
+        wide = Btask.evaluate_params_vectorized(Strategy, data, params_list, use_cache=False)
+        narrow = Btask.evaluate_params_vectorized(Strategy, compact_data, params_list, use_cache=False)
+        backtests += len(params_list)
+        for a, b in zip(wide, narrow):
+            for name in ('total_return_rate', 'max_drawdown', 'max_drawdown_period'):
+                max_abs_error = max(max_abs_error, abs(a[name] - b[name]))
+        same_best_params &= Btask.get_best_params(wide, stock_id) == Btask.get_best_params(narrow, stock_id)
+
+    return dict(
+        backtests=backtests,
+        max_abs_error=max_abs_error,
+        same_best_params=same_best_params,
+        data_bytes=int(sum(histories[s].memory_usage().sum() for s in compact_histories)),
+        compact_data_bytes=int(sum(data.memory_usage().sum() for data in compact_histories.values())),
+    )
+
+
+def get_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(args):
+    """
+    Generate the universe, run the phases and write the report.
+    :param args(Namespace): command line arguments.
+    :return: report(dict)
+    """
+    from backtraderbd.btask import Btask, STRATEGY_MAPPING
+    import backtraderbd.data.utils as bdu
+    import backtraderbd.data.bdshare as bds
+    from backtraderbd.data.cache import LocalCache
+    from backtraderbd.portfolio import Portfolio
+
+    work_dir = tempfile.mkdtemp(prefix='bt_benchmark_')
+    conf.LOCAL_CACHE_DIR = os.path.join(work_dir, 'cache')
+    conf.TRANSACTION_JOURNAL_DIR = None
+    # every back test is run, none is served from the result cache
+    conf.RESULT_CACHE_ENABLED = False
+    # no window while timing the back testing
+    bt.Cerebro.plot = lambda self, *args, **kwargs: None
+    install_memory_store()
+
+    stock_ids = make_universe(args.stocks, args.bars, args.seed)
+    histories = {stock_id: bds.DseHisData(stock_id).get_data() for stock_id in stock_ids}
+    universe_bars = sum(len(data) for data in histories.values())
+    longest = [s for s in stock_ids if len(histories[s]) == args.bars]
+    train_ids = longest[:args.train_stocks]
+    back_test_ids = longest[:args.back_test_stocks]
+    back_test_bars = sum(len(histories[s]) for s in back_test_ids)
+
+    bench = Benchmark(repeat=args.repeat, memory=not args.no_memory)
+
+    def clear_cache():
+        for stock_id in stock_ids:
+            LocalCache(conf.BD_STOCK_LIBNAME).invalidate(stock_id)
+
+    def get_all_data():
+        for stock_id in stock_ids:
+            bds.DseHisData(stock_id).get_data()
+
+    conf.LOCAL_CACHE_ENABLED = False
+    bench.run('get_data', get_all_data, bars=universe_bars)
+    conf.LOCAL_CACHE_ENABLED = True
+    bench.run('get_data_cache_cold', get_all_data, bars=universe_bars, setup=clear_cache)
+    bench.run('get_data_cache_warm', get_all_data, bars=universe_bars)
+
+    def to_feed():
+        for stock_id in back_test_ids:
+            cerebro = bt.Cerebro(stdstats=False)
+            cerebro.adddata(bt.feeds.PandasData(dataname=bdu.Utils.to_numeric(histories[stock_id])))
+            cerebro.run()
+
+    bench.run('data_to_feed', to_feed, bars=back_test_bars)
+
+    # the cerebro optimization (`optstrategy`, `optreturn`) is timed by the evaluate_params_cerebro phase
+    # on part of the grid, the whole grid would take hours
+    grid_sizes = {s: len(Btask.get_strategy_params_list(histories[s], s)) for s in train_ids}
+    grid_size = sum(grid_sizes.values())
+    grid_bars = sum(len(histories[s]) * grid_sizes[s] for s in train_ids)
+
+    Strategy = STRATEGY_MAPPING['smac']
+
+    def train_strategy_vectorized():
+        for stock_id in train_ids:
+            Btask.train_strategy_vectorized(Strategy, histories[stock_id], stock_id)
+
+    bench.run('train_strategy_vectorized', train_strategy_vectorized, bars=grid_bars, backtests=grid_size)
+
+    # float32 prices as stored, widened back when the back tests start
+    compact_histories = {stock_id: bdu.Utils.compact(histories[stock_id]) for stock_id in train_ids}
+
+    def train_strategy_vectorized_compact():
+        for stock_id in train_ids:
+            Btask.train_strategy_vectorized(Strategy, compact_histories[stock_id], stock_id)
+
+    bench.run('train_strategy_vectorized_compact', train_strategy_vectorized_compact,
+              bars=grid_bars, backtests=grid_size)
+    precision = get_compact_precision(Strategy, histories, compact_histories)
+
+    def evaluate_params_cerebro():
+        for stock_id in train_ids:
+            params_list = Btask.get_strategy_params_list(histories[stock_id], stock_id)[:args.cerebro_params]
+            Btask.evaluate_params_cerebro(Strategy, histories[stock_id], params_list)
+
+    cerebro_runs = {s: min(grid_sizes[s], args.cerebro_params) for s in train_ids}
+    bench.run('evaluate_params_cerebro', evaluate_params_cerebro,
+              bars=sum(len(histories[s]) * cerebro_runs[s] for s in train_ids),
+              backtests=sum(cerebro_runs.values()))
+
+    def run_back_testing():
+        for name in STRATEGY_MAPPING:
+            for stock_id in back_test_ids:
+                Btask.run_back_testing(name, stock_id)
+
+    # the strategies print their arguments and the portfolio values
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        bench.run('run_back_testing', run_back_testing, bars=back_test_bars * len(STRATEGY_MAPPING),
+                  backtests=len(back_test_ids) * len(STRATEGY_MAPPING))
+
+    portfolio = Portfolio(Strategy)
+    default_params = {stock_id: {} for stock_id in stock_ids}
+
+    def portfolio_back_test():
+        portfolio.run(stock_ids, histories, default_params)
+
+    bench.run('portfolio_back_test', portfolio_back_test, bars=universe_bars, backtests=1)
+
+    # last phase, it appends to the stored histories
+    library = models.get_or_create_library(conf.BD_STOCK_LIBNAME)
+    stored = {stock_id: library.read(stock_id) for stock_id in stock_ids}
+    ingestor = bds.DeltaIngestor(rate=0, retries=0,
+                                 source=MemorySource(make_delta(np.random.default_rng(args.seed), stock_ids, DELTA_BARS)))
+
+    def restore_histories():
+        for stock_id, item in stored.items():
+            library.write(stock_id, item.data, metadata=item.metadata)
+
+    def ingest_delta():
+        result = ingestor.run(stock_ids)
+        if len(result['updated']) != len(stock_ids):
+            raise RuntimeError(f'delta ingestion failed: {result["failed"]}')
+
+    bench.run('ingest_delta', ingest_delta, bars=len(stock_ids) * DELTA_BARS, setup=restore_histories)
+
+    return dict(
+        benchmark_version=BENCHMARK_VERSION,
+        commit=get_commit(),
+        python=platform.python_version(),
+        platform=platform.platform(),
+        numpy=np.__version__,
+        pandas=pd.__version__,
+        backtrader=bt.__version__,
+        params=dict(stocks=args.stocks, bars=args.bars, seed=args.seed, repeat=args.repeat,
+                    train_stocks=len(train_ids), back_test_stocks=len(back_test_ids),
+                    cerebro_params=args.cerebro_params),
+        phases=bench.results,
+        compact_precision=precision,
+        peak_rss_mb=get_peak_rss_mb(),
+    )
+
+
+def print_report(report, baseline=None):
+    """
+    Print the phases, with the speed up over the baseline report if given.
+    :param report(dict): report of `main`.
+    :param baseline(dict): report of an other commit.
+    :return: None
+    """
+    print(f"benchmark of commit {report['commit']}, {report['params']}")
+    header = f"{'phase':<36}{'seconds':>10}{'bars/sec':>14}{'backtests/sec':>15}{'peak MB':>10}"
+    if baseline is not None:
+        header += f"{'speed up':>10}"
+    print(header)
+    for name, result in report['phases'].items():
+        if 'error' in result:
+            print(f"{name:<36}  failed: {result['error']}")
+            continue
+        line = (f"{name:<36}{result['seconds']:>10.3f}"
+                f"{result['bars_per_sec'] or 0:>14,.0f}{result['backtests_per_sec'] or 0:>15,.1f}"
+                f"{result['peak_memory_mb'] or 0:>10.1f}")
+        if baseline is not None:
+            base = baseline['phases'].get(name, {})
+            line += f"{base['seconds'] / result['seconds']:>9.2f}x" if 'seconds' in base else f"{'-':>10}"
+        print(line)
+    precision = report.get('compact_precision')
+    if precision:
+        print(f"compact data: {precision['compact_data_bytes'] / 2 ** 10:.1f} KB "
+              f"instead of {precision['data_bytes'] / 2 ** 10:.1f} KB, "
+              f"max error {precision['max_abs_error']:g} over {precision['backtests']} back tests, "
+              f"same best params: {precision['same_best_params']}")
+    print(f"peak rss: {report['peak_rss_mb']:.1f} MB" if report['peak_rss_mb'] else '')
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='backtraderbd performance benchmark')
+    parser.add_argument('--stocks', type=int, default=350, help='stocks of the universe')
+    parser.add_argument('--bars', type=int, default=3000, help='sessions of the longest histories')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the synthetic data')
+    parser.add_argument('--repeat', type=int, default=3, help='timed runs of each phase, the best is kept')
+    parser.add_argument('--train-stocks', type=int, default=2, help='stocks trained')
+    parser.add_argument('--back-test-stocks', type=int, default=5, help='stocks back tested with each strategy')
+    parser.add_argument('--cerebro-params', type=int, default=50, help='param sets of the cerebro optimization')
+    parser.add_argument('--no-memory', action='store_true', help='skip the peak memory runs')
+    parser.add_argument('--output', help='write the json report to this file')
+    parser.add_argument('--compare', help='json report of an other commit to compare with')
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    report = main(args)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if baseline.get('benchmark_version') != BENCHMARK_VERSION or baseline.get('params') != report['params']:
+            logger.warning('the baseline report was made with other benchmark params, the speed ups are not comparable.')
+
+    print_report(report, baseline)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, default=str)
@@ -5,6 +5,7 @@ warnings.simplefilter(action='ignore', category=FutureWarning)
 
 
 from backtraderbd.data.bdshare import DseHisData as bds
+from backtraderbd.data.shared import SharedDataStore, init_worker
 import backtraderbd.tasks as btasks
 from backtraderbd.libs.log import get_logger
 from backtraderbd.settings import settings as conf
@@ -52,15 +53,18 @@ def main(Strategy, stock_pools):
     :param stock_pools: list, the stock code list.
     :return: None
     """
-    i=1
-    pool = multiprocessing.Pool()
-    for stock in stock_pools:
-        #bds.download_one_delta_data(stock)
-        pool.apply_async(back_test, args=(Strategy, stock, ))
-        print('Process No: {0} - Stock Code: {1} :: Done'.format(i,  stock))
-        i +=1
-    pool.close()
-    pool.join()
+    # load every stock once, the workers attach to the shared memory
+    with SharedDataStore() as store:
+        store.load(stock_pools)
+        i=1
+        pool = multiprocessing.Pool(initializer=init_worker, initargs=(store.handles, ))
+        for stock in stock_pools:
+            #bds.download_one_delta_data(stock)
+            pool.apply_async(back_test, args=(Strategy, stock, ))
+            print('Process No: {0} - Stock Code: {1} :: Done'.format(i,  stock))
+            i +=1
+        pool.close()
+        pool.join()
 
 
 if __name__ == '__main__':
@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 import backtraderbd.strategies.smac as bsm
 import backtraderbd.tasks as btasks
+from backtraderbd.scheduler import TrainingScheduler
 from backtraderbd.libs.log import get_logger
 from backtraderbd.settings import settings as conf
 from backtraderbd.libs import models
@@ -25,13 +26,16 @@ def train(stock):
 
 def main(stock_pools):
     """
-    Get all stocks and train params for each stock.
+    Get all stocks and train params for each stock on all the cores,
+    the params of all the stocks are saved in one write at the end.
     :param stock_pools: list, the stock code list.
     :return: None
     """
 
-    for stock in stock_pools:
-        train(stock)
+    with models.ParamsWriter(bsm.SMACStrategy.name) as writer:
+        scheduler = TrainingScheduler(
+            bsm.SMACStrategy, on_result=lambda stock, params: writer.add(params))
+        scheduler.run(stock_pools)
 
 
 if __name__ == '__main__':